@@ -0,0 +1,3 @@
+from .server import SyncServer
+from .client import SyncClient
+from .protocol import ProtocolError
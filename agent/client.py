@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import queue
+import socket
+import logging
+import threading
+from rule.rule import Rule
+from walker import Walker
+from . import protocol
+from .protocol import ProtocolError, frame, read_frame
+
+# 小于这个大小的文件和帧头一起一次发送，大文件用socket.sendfile
+SMALL_FILE_SIZE = 64 * 1024
+
+
+class SyncClient(object):
+    """
+    sync-agent客户端，在原文件夹所在的机器上遍历，通过SyncServer同步到远程的目标
+        1. 每batch_size个条目合成一个MANIFEST发送，服务端在本地比较后只回复需要的文件，
+           一批文件只需要一次往返，而且不等回复就继续遍历和发送下一批，最多window批在途
+        2. 发送线程按顺序发送MANIFEST和文件数据，接收线程处理NEED和ACK，遍历、比较和传输同时进行
+        3. 文件数据紧跟在FILE帧后面发送，大文件用sendfile，不需要逐块确认
+        4. 服务端只根据大小和修改时间比较(相当于compare=meta)
+        5. 连接后用共享密钥(secret)回应服务端的质询，相对路径总是用/分隔
+    """
+    def __init__(self, sync_tool, host, port, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+        self.host = host
+        self.port = port
+        self.batch_size = max(kwargs.pop('batch_size', 256), 1)
+        self.window = max(kwargs.pop('window', 16), 1)
+        self.timeout = kwargs.pop('timeout', 30)
+        self.secret = kwargs.pop('secret', '')
+        self.copy_count = 0
+        self.failed_count = 0
+        # 服务端的统计: (写入的文件数, 字节数, 失败数)
+        self.server_stats = None
+        self.error = None
+        self._sock = None
+        self._out = None
+        self._batches = {}
+        self._files = {}
+        self._next_batch = 0
+        self._next_file = 0
+        self._pending_batches = 0
+        self._pending_files = 0
+        self._window = None
+        self._cond = threading.Condition()
+
+    def sync_tree(self, source_path, target_path=''):
+        """
+        :param target_path: 目标在服务端root下的相对路径
+        :return: 拷贝的文件数
+        """
+        sync_tool = self.sync_tool
+        source_path = os.path.abspath(source_path)
+        sync_tool._rule = Rule(source_path, logger=self.logger)
+        walker = Walker(sync_tool._rule, logger=self.logger, metrics=sync_tool.metrics, on_list=sync_tool._on_list)
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rfile = self._sock.makefile('rb', buffering=1024 * 1024)
+        try:
+            self._hello(rfile, target_path)
+            self._out = queue.Queue()
+            self._window = threading.Semaphore(self.window)
+            sender = threading.Thread(target=self._send_loop, daemon=True)
+            receiver = threading.Thread(target=self._recv_loop, args=(rfile,), daemon=True)
+            sender.start()
+            receiver.start()
+            try:
+                self._walk(walker, source_path)
+            finally:
+                with self._cond:
+                    self._cond.wait_for(lambda: self.error is not None or (
+                        not self._pending_batches and not self._pending_files))
+                self._out.put((protocol.DONE, None))
+                if self.error is not None:
+                    # 让阻塞在读写上的线程退出
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                sender.join()
+                receiver.join()
+        finally:
+            rfile.close()
+            self._sock.close()
+        if self.error is not None:
+            raise self.error
+        if self.server_stats is not None:
+            self.logger.info('[远程同步] 服务端写入{}个文件/{}字节, 失败{}个'.format(*self.server_stats))
+        return self.copy_count
+
+    def _hello(self, rfile, target_path):
+        mtime_window_ns = self.sync_tool.mtime_window_ns
+        self._sock.sendall(frame(protocol.HELLO, protocol.HELLO_HEAD.pack(protocol.VERSION, mtime_window_ns) +
+                                 protocol.to_wire(target_path).encode('utf-8')))
+        kind, payload = read_frame(rfile)
+        if kind == protocol.CHALLENGE:
+            self._sock.sendall(frame(protocol.AUTH, protocol.auth_digest(self.secret, payload)))
+            kind, payload = read_frame(rfile)
+        if kind == protocol.ERROR:
+            raise ProtocolError(payload.decode('utf-8', 'replace'))
+        if kind != protocol.WELCOME:
+            raise ProtocolError('expect WELCOME, got {}'.format(kind))
+
+    def _walk(self, walker, source_path):
+        source_stat = os.stat(source_path)
+        batch = []
+        batch_bytes = 0
+        if not os.path.isdir(source_path):
+            batch.append((os.path.basename(source_path), False, source_stat, source_path))
+        else:
+            stack = [(source_path, self.sync_tool.rule.dir_matcher(source_path))]
+            while stack and self.error is None:
+                dir_path, matcher = stack.pop()
+                listed = walker._list_source(dir_path, matcher)
+                if listed is None:
+                    continue
+                matcher, _, kept, _, _ = listed
+                if walker.metrics is not None:
+                    walker.metrics.incr('files', sum(1 for _, is_dir, _ in kept if not is_dir))
+                for item, is_dir, st in kept:
+                    relpath = protocol.to_wire(os.path.relpath(item.path, source_path))
+                    batch.append((relpath, is_dir, st, item.path))
+                    batch_bytes += protocol.ENTRY.size + len(relpath.encode('utf-8'))
+                    if is_dir:
+                        stack.append((item.path, matcher.child(item.name)))
+                    # 路径很长时按字节数提前发送，不超过服务端的帧长度上限
+                    if len(batch) >= self.batch_size or batch_bytes >= protocol.MAX_MANIFEST_SIZE // 2:
+                        self._send_manifest(batch)
+                        batch = []
+                        batch_bytes = 0
+        if batch:
+            self._send_manifest(batch)
+        if self.sync_tool._progress is not None:
+            self.sync_tool._progress.scanning = False
+
+    def _send_manifest(self, batch):
+        # 在途的批次数达到window时等待服务端回复
+        while not self._window.acquire(timeout=1):
+            if self.error is not None:
+                return
+        with self._cond:
+            batch_id = self._next_batch
+            self._next_batch += 1
+            self._batches[batch_id] = batch
+            self._pending_batches += 1
+        self._out.put((protocol.MANIFEST, protocol.encode_manifest(
+            batch_id, [(relpath, is_dir, st) for relpath, is_dir, st, _ in batch])))
+
+    def _fail(self, e):
+        with self._cond:
+            if self.error is None:
+                self.error = e
+            self._cond.notify_all()
+
+    def _send_loop(self):
+        try:
+            while True:
+                kind, item = self._out.get()
+                if kind == protocol.DONE:
+                    self._sock.sendall(frame(protocol.DONE))
+                    return
+                if self.error is not None:
+                    continue
+                if kind == protocol.MANIFEST:
+                    self._sock.sendall(item)
+                else:
+                    self._send_file(*item)
+        except (OSError, ProtocolError) as e:
+            self._fail(e)
+
+    def _send_file(self, relpath, path):
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            self.logger.error('[远程拷贝失败] {}, {}'.format(path, e))
+            with self._cond:
+                self.failed_count += 1
+                self._pending_files -= 1
+                self._cond.notify_all()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            with self.sync_tool._timer('copy', size):
+                self._send_data(f, st, relpath)
+        self.sync_tool._add_io(size)
+
+    def _send_data(self, f, st, relpath):
+        size = st.st_size
+        with self._cond:
+            file_id = self._next_file
+            self._next_file += 1
+            self._files[file_id] = relpath
+        header = frame(protocol.FILE, protocol.FILE_HEAD.pack(file_id, size, st.st_mtime_ns, st.st_mode & 0o7777) +
+                       relpath.encode('utf-8'))
+        if size < SMALL_FILE_SIZE:
+            data = f.read(size)
+            sent = len(data)
+            data += b'\0' * (size - sent)
+            changed = sent != size or os.fstat(f.fileno()).st_mtime_ns != st.st_mtime_ns
+            self._sock.sendall(header + data + frame(protocol.END, protocol.STATUS.pack(changed)))
+            return
+        self._sock.sendall(header)
+        sent = self._sock.sendfile(f, 0, size)
+        if sent < size:
+            # 原文件变小了，补齐数据，让服务端丢弃这个文件
+            self._sock.sendall(b'\0' * (size - sent))
+        changed = sent != size or os.fstat(f.fileno()).st_mtime_ns != st.st_mtime_ns
+        self._sock.sendall(frame(protocol.END, protocol.STATUS.pack(changed)))
+
+    def _recv_loop(self, rfile):
+        try:
+            while True:
+                kind, payload = read_frame(rfile, protocol.MAX_MANIFEST_SIZE)
+                if kind == protocol.NEED:
+                    self._need(payload)
+                elif kind == protocol.ACK:
+                    self._ack(payload)
+                elif kind == protocol.BYE:
+                    self.server_stats = protocol.BYE_BODY.unpack(payload)
+                    return
+                elif kind == protocol.ERROR:
+                    raise ProtocolError(payload.decode('utf-8', 'replace'))
+                else:
+                    raise ProtocolError('unexpected frame: {}'.format(kind))
+        except (OSError, ProtocolError) as e:
+            self._fail(e)
+
+    def _need(self, payload):
+        batch_id, indexes = protocol.decode_need(payload)
+        with self._cond:
+            batch = self._batches.pop(batch_id)
+            self._pending_files += len(indexes)
+            self._pending_batches -= 1
+            self._cond.notify_all()
+        self._window.release()
+        # 服务端比较完了整个批次
+        self.sync_tool._decided(sum(1 for _, is_dir, _, _ in batch if not is_dir))
+        for index in indexes:
+            relpath, _, st, path = batch[index]
+            if self.sync_tool.metrics is not None:
+                self.sync_tool.metrics.incr('copy_bytes', st.st_size)
+            self._out.put((protocol.FILE, (relpath, path)))
+
+    def _ack(self, payload):
+        file_id, status = protocol.ACK_HEAD.unpack_from(payload)
+        with self._cond:
+            relpath = self._files.pop(file_id)
+            if status == 0:
+                self.copy_count += 1
+            else:
+                self.failed_count += 1
+            self._pending_files -= 1
+            self._cond.notify_all()
+        if status == 0:
+            self.logger.info('[远程拷贝] %s', relpath)
+        else:
+            self.logger.error('[远程拷贝失败] {}, {}'.format(
+                relpath, payload[protocol.ACK_HEAD.size:].decode('utf-8', 'replace')))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import hmac
+import struct
+import hashlib
+
+# sync-agent的二进制协议，所有整数都是网络字节序
+#     帧: 类型(1字节) + 长度(4字节) + 内容
+#     HELLO    客户端 -> 服务端: 版本(H) + 修改时间允许的误差(Q, 纳秒) + 目标子路径(UTF-8)
+#     CHALLENGE 服务端 -> 客户端: 随机数(32字节)
+#     AUTH     客户端 -> 服务端: HMAC-SHA256(共享密钥, 随机数)，验证通过后服务端回复WELCOME，否则回复ERROR
+#     WELCOME  服务端 -> 客户端: 版本(H)
+#     MANIFEST 客户端 -> 服务端: 批次号(I) + 条目数(I) + 条目 * [标志(B) + 大小(Q) + 修改时间(q) + 权限(I) + 路径长度(H) + 相对路径]
+#     NEED     服务端 -> 客户端: 批次号(I) + 条目数(I) + 需要的条目序号 * [I]
+#     FILE     客户端 -> 服务端: 文件号(I) + 大小(Q) + 修改时间(q) + 权限(I) + 相对路径，紧跟着"大小"个字节的原始数据(不分帧)
+#     END      客户端 -> 服务端: 状态(B)，0表示数据完整，1表示读取时原文件被修改，服务端丢弃
+#     ACK      服务端 -> 客户端: 文件号(I) + 状态(B) + 错误信息(UTF-8)
+#     DONE     客户端 -> 服务端: 没有内容
+#     BYE      服务端 -> 客户端: 写入的文件数(Q) + 字节数(Q) + 失败数(I)
+#     ERROR    双向: 错误信息(UTF-8)，发送后关闭连接
+# 相对路径总是用/分隔，接收方拒绝绝对路径和包含..的路径
+# 帧的长度有上限，超过时直接断开，避免没有通过验证的对方让接收方分配很大的内存
+VERSION = 2
+
+HELLO = 1
+WELCOME = 2
+MANIFEST = 3
+NEED = 4
+FILE = 5
+END = 6
+ACK = 7
+DONE = 8
+BYE = 9
+ERROR = 10
+CHALLENGE = 11
+AUTH = 12
+
+NONCE_SIZE = 32
+
+# 控制帧(HELLO、AUTH、END、ACK等)和MANIFEST/NEED的最大长度
+MAX_CONTROL_SIZE = 64 * 1024
+MAX_MANIFEST_SIZE = 16 * 1024 * 1024
+
+# 条目标志
+FLAG_DIR = 1
+
+FRAME = struct.Struct('!BI')
+HELLO_HEAD = struct.Struct('!HQ')
+WELCOME_HEAD = struct.Struct('!H')
+BATCH_HEAD = struct.Struct('!II')
+ENTRY = struct.Struct('!BQqIH')
+INDEX = struct.Struct('!I')
+FILE_HEAD = struct.Struct('!IQqI')
+STATUS = struct.Struct('!B')
+ACK_HEAD = struct.Struct('!IB')
+BYE_BODY = struct.Struct('!QQI')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def frame(kind, payload=b''):
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+def read_exact(rfile, size):
+    data = rfile.read(size)
+    if len(data) != size:
+        raise ProtocolError('connection closed')
+    return data
+
+
+def read_frame(rfile, max_size=MAX_CONTROL_SIZE):
+    """
+    :param max_size: 内容的最大长度
+    :return: (类型, 内容)
+    :raise ProtocolError: 内容超过max_size
+    """
+    kind, size = FRAME.unpack(read_exact(rfile, FRAME.size))
+    if size > max_size:
+        raise ProtocolError('frame too large: {} > {}'.format(size, max_size))
+    return kind, read_exact(rfile, size) if size else b''
+
+
+def auth_digest(secret, nonce):
+    return hmac.new(secret.encode('utf-8'), nonce, hashlib.sha256).digest()
+
+
+def check_auth(secret, nonce, digest):
+    return hmac.compare_digest(auth_digest(secret, nonce), digest)
+
+
+def to_wire(relpath):
+    """
+    本地的相对路径转成协议里用/分隔的路径
+    """
+    return relpath.replace(os.sep, '/') if os.sep != '/' else relpath
+
+
+def from_wire(relpath):
+    """
+    协议里的相对路径转成本地的相对路径
+    :return: 本地的相对路径，空路径返回''
+    :raise ProtocolError: 绝对路径、包含..或者本地的路径分隔符/盘符
+    """
+    if not relpath:
+        return ''
+    parts = relpath.split('/')
+    for part in parts:
+        if part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part) or \
+                os.path.splitdrive(part)[0] or os.path.isabs(part):
+            raise ProtocolError('invalid path: {}'.format(relpath))
+    return os.path.join(*parts)
+
+
+def encode_manifest(batch_id, entries):
+    """
+    :param entries: [(相对路径, 是否是文件夹, stat)]
+    """
+    parts = [BATCH_HEAD.pack(batch_id, len(entries))]
+    for path, is_dir, st in entries:
+        name = path.encode('utf-8')
+        parts.append(ENTRY.pack(FLAG_DIR if is_dir else 0, 0 if is_dir else st.st_size, st.st_mtime_ns,
+                                st.st_mode & 0o7777, len(name)))
+        parts.append(name)
+    return frame(MANIFEST, b''.join(parts))
+
+
+def decode_manifest(payload):
+    """
+    :return: (批次号, [(相对路径, 是否是文件夹, 大小, 修改时间, 权限)])
+    """
+    batch_id, count = BATCH_HEAD.unpack_from(payload)
+    offset = BATCH_HEAD.size
+    entries = []
+    for _ in range(count):
+        flags, size, mtime_ns, mode, length = ENTRY.unpack_from(payload, offset)
+        offset += ENTRY.size
+        entries.append((payload[offset:offset + length].decode('utf-8'), bool(flags & FLAG_DIR), size, mtime_ns, mode))
+        offset += length
+    return batch_id, entries
+
+
+def encode_need(batch_id, indexes):
+    return frame(NEED, BATCH_HEAD.pack(batch_id, len(indexes)) + b''.join(INDEX.pack(i) for i in indexes))
+
+
+def decode_need(payload):
+    batch_id, count = BATCH_HEAD.unpack_from(payload)
+    return batch_id, [INDEX.unpack_from(payload, BATCH_HEAD.size + i * INDEX.size)[0] for i in range(count)]
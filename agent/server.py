@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import socket
+import logging
+import tempfile
+import threading
+import ipaddress
+from . import protocol
+from .protocol import ProtocolError, frame, read_frame
+
+# 接收文件数据的缓冲区大小
+RECV_SIZE = 1024 * 1024
+
+
+class SyncServer(object):
+    """
+    sync-agent服务端，运行在目标所在的机器上，所有目标都在root下
+        1. 每个连接一个线程，按顺序处理客户端发来的帧
+        2. 收到MANIFEST时在本地stat比较(大小和修改时间)，创建文件夹，回复需要的文件，不需要额外的往返
+        3. 文件数据写到同一文件夹下的临时文件，完整收到后设置修改时间和权限，再用os.replace原子替换
+        4. 写入失败(比如磁盘满了)时继续读完这个文件的数据，只回复这个文件失败，连接可以继续使用
+        5. 相对路径不能是绝对路径或者包含..，解析符号链接后也不能在root外面，不能写到root外面
+        6. 客户端需要用共享密钥(secret)通过质询-响应验证，密钥本身不会在网络上传输;
+           没有设置密钥时只能监听本机地址
+    """
+    def __init__(self, root, host='127.0.0.1', port=0, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        if not root:
+            # 空路径会被当成当前文件夹
+            raise ValueError('a root directory is required')
+        self.secret = kwargs.pop('secret', '')
+        if not self.secret and not self.is_loopback(host):
+            raise ValueError('a secret is required when listening on {!r}'.format(host))
+        self.root = os.path.abspath(root)
+        self.sock = socket.create_server((host, port), reuse_port=False)
+        self.address = self.sock.getsockname()[:2]
+        self.alive = True
+        self._threads = []
+
+    @staticmethod
+    def is_loopback(host):
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    def serve_forever(self):
+        self.logger.info('[同步服务] 监听{}:{}, 目标: {}'.format(self.address[0], self.address[1], self.root))
+        while self.alive:
+            try:
+                conn, peer = self.sock.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self._serve, args=(conn, peer), daemon=True)
+            thread.start()
+            self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+
+    def start(self):
+        """
+        在后台线程里运行
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.alive = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for thread in self._threads:
+            thread.join()
+
+    def _serve(self, conn, peer):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rfile = conn.makefile('rb', buffering=RECV_SIZE)
+        try:
+            _Session(self, conn, rfile, peer).run()
+        except (ProtocolError, OSError) as e:
+            self.logger.error('[同步服务] {}, {}'.format(peer, e))
+            try:
+                conn.sendall(frame(protocol.ERROR, str(e).encode('utf-8')))
+            except OSError:
+                pass
+        finally:
+            rfile.close()
+            conn.close()
+
+
+class _Session(object):
+    def __init__(self, server, conn, rfile, peer):
+        self.server = server
+        self.logger = server.logger
+        self.conn = conn
+        self.rfile = rfile
+        self.peer = peer
+        self.root = None
+        self.real_root = None
+        self.mtime_window_ns = 0
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.buf = bytearray(RECV_SIZE)
+
+    def run(self):
+        kind, payload = read_frame(self.rfile)
+        if kind != protocol.HELLO:
+            raise ProtocolError('expect HELLO, got {}'.format(kind))
+        version, self.mtime_window_ns = protocol.HELLO_HEAD.unpack_from(payload)
+        if version != protocol.VERSION:
+            raise ProtocolError('unsupported version: {}'.format(version))
+        target_path = payload[protocol.HELLO_HEAD.size:].decode('utf-8')
+        nonce = os.urandom(protocol.NONCE_SIZE)
+        self.conn.sendall(frame(protocol.CHALLENGE, nonce))
+        kind, payload = read_frame(self.rfile)
+        if kind != protocol.AUTH:
+            raise ProtocolError('expect AUTH, got {}'.format(kind))
+        if not protocol.check_auth(self.server.secret, nonce, payload):
+            raise ProtocolError('authentication failed')
+        self.real_root = os.path.realpath(self.server.root)
+        self.root = self._path(self.server.root, target_path)
+        # 创建文件夹会跟随符号链接，先检查
+        if not self._inside(self.root, follow=True):
+            raise ProtocolError('path outside root: {}'.format(target_path))
+        os.makedirs(self.root, exist_ok=True)
+        self.conn.sendall(frame(protocol.WELCOME, protocol.WELCOME_HEAD.pack(protocol.VERSION)))
+        self.logger.info('[同步服务] {}连接, 目标: {}'.format(self.peer, self.root))
+        while True:
+            kind, payload = read_frame(self.rfile, protocol.MAX_MANIFEST_SIZE)
+            if kind == protocol.MANIFEST:
+                self._manifest(payload)
+            elif kind == protocol.FILE:
+                self._file(payload)
+            elif kind == protocol.DONE:
+                self.conn.sendall(frame(protocol.BYE, protocol.BYE_BODY.pack(self.files, self.bytes, self.errors)))
+                self.logger.info('[同步服务] {}完成, 写入{}个文件/{}字节, 失败{}个'.format(
+                    self.peer, self.files, self.bytes, self.errors))
+                return
+            elif kind == protocol.ERROR:
+                raise ProtocolError(payload.decode('utf-8', 'replace'))
+            else:
+                raise ProtocolError('unexpected frame: {}'.format(kind))
+
+    @staticmethod
+    def _path(root, relpath):
+        relpath = protocol.from_wire(relpath)
+        return os.path.join(root, relpath) if relpath else root
+
+    def _inside(self, path, follow=False):
+        """
+        解析符号链接后path是否还在root下
+        :param follow: 是否解析最后一级，文件用os.replace替换，只替换链接本身，不会跟随最后一级
+        """
+        if follow:
+            path = os.path.realpath(path)
+        else:
+            path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        return path == self.real_root or path.startswith(self.real_root.rstrip(os.sep) + os.sep)
+
+    def _manifest(self, payload):
+        batch_id, entries = protocol.decode_manifest(payload)
+        need = []
+        for index, (relpath, is_dir, size, mtime_ns, mode) in enumerate(entries):
+            path = self._path(self.root, relpath)
+            if not self._inside(path, follow=is_dir):
+                self.errors += 1
+                self.logger.error('[同步服务] 路径在root外面, 忽略: {}'.format(path))
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if is_dir:
+                if st is None:
+                    try:
+                        os.makedirs(path, exist_ok=True)
+                    except OSError as e:
+                        self.logger.error('[同步服务] 创建文件夹失败: {}, {}'.format(path, e))
+                continue
+            if st is None or st.st_size != size or abs(st.st_mtime_ns - mtime_ns) > self.mtime_window_ns:
+                need.append(index)
+        self.conn.sendall(protocol.encode_need(batch_id, need))
+
+    def _file(self, payload):
+        file_id, size, mtime_ns, mode = protocol.FILE_HEAD.unpack_from(payload)
+        relpath = payload[protocol.FILE_HEAD.size:].decode('utf-8')
+        path = self._path(self.root, relpath)
+        error = None
+        fd = tmp_path = None
+        if not self._inside(path):
+            # 继续读完数据，只回复这个文件失败
+            error = 'path outside root'
+        else:
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.synctmp')
+            except OSError as e:
+                error = e
+        try:
+            error = self._receive(fd, size, error)
+            kind, status = read_frame(self.rfile)
+            if kind != protocol.END:
+                raise ProtocolError('expect END, got {}'.format(kind))
+        except (ProtocolError, OSError):
+            if fd is not None:
+                os.close(fd)
+                os.unlink(tmp_path)
+            raise
+        if error is None and protocol.STATUS.unpack(status)[0] != 0:
+            error = '原文件在传输过程中被修改'
+        if fd is not None:
+            os.close(fd)
+        if error is None:
+            try:
+                os.chmod(tmp_path, mode)
+                os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+                os.replace(tmp_path, path)
+            except OSError as e:
+                error = e
+        if error is not None:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            self.errors += 1
+            self.logger.error('[同步服务] 写入失败: {}, {}'.format(path, error))
+            self.conn.sendall(frame(protocol.ACK, protocol.ACK_HEAD.pack(file_id, 1) + str(error).encode('utf-8')))
+            return
+        self.files += 1
+        self.bytes += size
+        self.conn.sendall(frame(protocol.ACK, protocol.ACK_HEAD.pack(file_id, 0)))
+
+    def _receive(self, fd, size, error):
+        """
+        读出size个字节的文件数据，没有出错时写到fd，出错后继续读完(保持和客户端同步)
+        :return: 写入的错误
+        """
+        view = memoryview(self.buf)
+        remain = size
+        while remain:
+            n = self.rfile.readinto(view[:min(remain, RECV_SIZE)])
+            if not n:
+                raise ProtocolError('connection closed')
+            remain -= n
+            if error is None:
+                try:
+                    written = 0
+                    while written < n:
+                        written += os.write(fd, view[written:n])
+                except OSError as e:
+                    error = e
+        return error
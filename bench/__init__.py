@@ -0,0 +1,2 @@
+from .tree import SHAPES, TreeGenerator
+from .bench import BenchConfig, Benchmark
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import shutil
+import filecmp
+import tempfile
+
+from common.log import logger
+from common.config import ConfigTemplate, DefaultConfig
+from bench.tree import TreeGenerator
+
+
+class AgentCheckConfig(DefaultConfig):
+    def __init__(self, **kwargs):
+        self.Agent = ConfigTemplate(
+            root=os.path.join(tempfile.gettempdir(), 'sync-tool-agent-check'),
+            shape='mixed',
+            scale=0.02,
+            seed=1,
+            keep=False
+        )
+        super(AgentCheckConfig, self).__init__(**kwargs)
+
+
+def _diff(source, target):
+    """
+    :return: 两个文件夹不一致的相对路径
+    """
+    diffs = []
+    stack = [filecmp.dircmp(source, target)]
+    while stack:
+        cmp = stack.pop()
+        base = os.path.relpath(cmp.left, source)
+        diffs.extend(os.path.normpath(os.path.join(base, name))
+                     for name in cmp.left_only + cmp.right_only + cmp.diff_files + cmp.funny_files)
+        # dircmp只比较stat，内容再逐个比较
+        _, mismatch, errors = filecmp.cmpfiles(cmp.left, cmp.right, cmp.common_files, shallow=False)
+        diffs.extend(os.path.normpath(os.path.join(base, name)) for name in mismatch + errors)
+        stack.extend(cmp.subdirs.values())
+    return sorted(set(diffs))
+
+
+def check_agent(config):
+    """
+    在本机启动sync-agent服务端并用SyncTool.sync_remote同步，检查:
+        1. 目标和原文件夹完全一致
+        2. 没有改动时再同步一次不拷贝任何文件
+        3. 密钥不对时服务端拒绝连接
+    :return: 失败的检查项，全部通过时为空
+    """
+    from sync_tool import SyncTool
+    from agent import SyncServer, SyncClient, ProtocolError
+    source = os.path.join(config.root, 'source')
+    server_root = os.path.join(config.root, 'server')
+    shutil.rmtree(server_root, ignore_errors=True)
+    os.makedirs(server_root)
+    generator = TreeGenerator(source, config.shape, seed=config.seed, scale=config.scale)
+    files, size = generator.generate()
+    logger.info('[sync-agent检查] 原文件夹: {}个文件/{}字节'.format(files, size))
+    secret = os.urandom(16).hex()
+    server = SyncServer(server_root, '127.0.0.1', 0, secret=secret, logger=logger)
+    server.start()
+    address = '{}:{}'.format(*server.address)
+    failures = []
+    try:
+        copied = SyncTool(None, secret=secret, assume_yes=True).sync_remote(source, address, 'target')
+        diffs = _diff(source, os.path.join(server_root, 'target'))
+        if copied != files or diffs:
+            failures.append('首次同步: 拷贝{}个(应为{}个), 不一致: {}'.format(copied, files, diffs[:10]))
+        copied = SyncTool(None, secret=secret, assume_yes=True).sync_remote(source, address, 'target')
+        if copied != 0:
+            failures.append('再次同步: 拷贝{}个(应为0个)'.format(copied))
+        client = SyncClient(SyncTool(None), server.address[0], server.address[1], secret=secret + 'x', logger=logger)
+        try:
+            client.sync_tree(source, 'wrong')
+            failures.append('错误的密钥: 服务端没有拒绝')
+        except ProtocolError as e:
+            logger.info('[sync-agent检查] 错误的密钥被拒绝: {}'.format(e))
+        if os.path.exists(os.path.join(server_root, 'wrong')):
+            failures.append('错误的密钥: 服务端创建了目标文件夹')
+    finally:
+        server.shutdown()
+        if not config.keep:
+            shutil.rmtree(config.root, ignore_errors=True)
+    return failures
+
+
+if __name__ == '__main__':
+    config = AgentCheckConfig(logger=logger)
+    config.show()
+    failures = check_agent(config.Agent)
+    for failure in failures:
+        logger.error('[sync-agent检查] 失败: {}'.format(failure))
+    if not failures:
+        logger.info('[sync-agent检查] 全部通过')
+    logger.flush()
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import itertools
+import subprocess
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from common.log import logger
+from common.config import ConfigTemplate, DefaultConfig
+from bench.tree import SHAPES, TreeGenerator
+
+PHASES = ('cold', 'noop', 'warm')
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchConfig(DefaultConfig):
+    def __init__(self, **kwargs):
+        self.Bench = ConfigTemplate(
+            root=os.path.join(tempfile.gettempdir(), 'sync-tool-bench'),
+            shapes='tiny,huge,deep,wide',
+            scale=1.0,
+            changed=0.1,
+            seed=1,
+            threads='10',
+            compare='meta',
+            copy_strategy='auto',
+            engine='thread',
+            hash_cache=True,
+            repeat=1,
+            strace=False,
+            drop_caches=False,
+            keep=False,
+            log_level='WARNING',
+            report=''
+        )
+        super(BenchConfig, self).__init__(**kwargs)
+
+
+def _read_proc_io():
+    """
+    Linux下读写类系统调用的次数(read/pread/readv/sendfile/copy_file_range等都计在内)
+    """
+    try:
+        with open('/proc/self/io') as f:
+            data = dict(line.split(': ') for line in f.read().splitlines())
+        return int(data['syscr']) + int(data['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_sync(options):
+    """
+    在当前进程里同步一次，返回测量结果，由子进程调用
+    """
+    from sync_tool import SyncTool
+    from common.pool import ThreadPool
+    from cache import HashCache
+    logger.setLevel(getattr(logger, options['log_level'].upper(), logger.WARNING))
+    hash_cache = HashCache(options['db_path'], logger=logger) if options['hash_cache'] else None
+    pool = ThreadPool(options['threads'], 10000) if options['threads'] > 0 else None
+    sync_tool = SyncTool(pool, compare=options['compare'], copy_strategy=options['copy_strategy'],
+                         engine=options['engine'], hash_cache=hash_cache, assume_yes=True)
+    io_before = _read_proc_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None
+    start = time.perf_counter()
+    copied = sync_tool.sync(options['source'], options['target'])
+    seconds = time.perf_counter() - start
+    io_after = _read_proc_io()
+    if hash_cache is not None:
+        hash_cache.close()
+    result = {
+        'seconds': seconds,
+        'copied': copied,
+        'bytes': sum(sync_tool.copier.bytes.values()) + (sync_tool.chunked.bytes if sync_tool.chunked else 0),
+        'io_syscalls': io_after - io_before if io_before is not None and io_after is not None else None,
+    }
+    if usage_before is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # Linux下ru_maxrss的单位是KiB，macOS下是字节
+        result['peak_rss_mb'] = usage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+        result['cpu_seconds'] = usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime
+    return result
+
+
+def child_main(options_file):
+    with open(options_file) as f:
+        options = json.load(f)
+    result = run_sync(options)
+    with open(options['result_file'], 'w') as f:
+        json.dump(result, f)
+
+
+class Benchmark(object):
+    """
+    同步性能测试
+        1. 每种形状生成一次原文件夹(见bench.tree.SHAPES)，然后对线程数、比较模式、拷贝方式、引擎的每种组合测量3次:
+            cold: 目标文件夹为空，全部拷贝
+            noop: 没有任何改动
+            warm: 按changed比例改动原文件后再同步
+        2. 每次同步在单独的子进程里执行，峰值内存(peak RSS)互不影响，不会受前一次的缓存影响
+        3. 结果: 用时、文件/秒(原文件夹的文件数/用时)、MB/秒(拷贝的字节数/用时)、读写系统调用次数、峰值内存，
+           strace为True且安装了strace时还统计所有系统调用的次数
+    """
+    def __init__(self, config):
+        self.config = config.Bench
+        self.results = []
+
+    def _matrix(self):
+        def _split(value, cast=str):
+            return [cast(v.strip()) for v in str(value).split(',') if v.strip()]
+        return [dict(zip(('threads', 'compare', 'copy_strategy', 'engine'), combo)) for combo in itertools.product(
+            _split(self.config.threads, int), _split(self.config.compare), _split(self.config.copy_strategy),
+            _split(self.config.engine))]
+
+    def _drop_caches(self):
+        if not self.config.drop_caches:
+            return
+        try:
+            os.sync()
+            with open('/proc/sys/vm/drop_caches', 'w') as f:
+                f.write('3')
+        except OSError as e:
+            logger.warning('[性能测试] 无法清空页缓存(需要Linux和root权限): {}'.format(e))
+
+    def _run_child(self, options):
+        work = self.config.root
+        options_file = os.path.join(work, 'options.json')
+        options['result_file'] = os.path.join(work, 'result.json')
+        with open(options_file, 'w') as f:
+            json.dump(options, f)
+        cmd = [sys.executable, '-c', 'import sys; from bench.bench import child_main; child_main(sys.argv[1])',
+               options_file]
+        strace_file = None
+        if self.config.strace and shutil.which('strace'):
+            strace_file = os.path.join(work, 'strace.txt')
+            cmd = ['strace', '-f', '-c', '-o', strace_file] + cmd
+        subprocess.run(cmd, cwd=PROJECT_DIR, check=True)
+        with open(options['result_file']) as f:
+            result = json.load(f)
+        result['syscalls'] = self._parse_strace(strace_file) if strace_file else None
+        return result
+
+    @staticmethod
+    def _parse_strace(path):
+        """
+        strace -c的最后一行: 100.00    0.123456    1    12345    67    total
+        """
+        try:
+            with open(path) as f:
+                for line in reversed(f.read().splitlines()):
+                    if line.rstrip().endswith('total'):
+                        numbers = re.findall(r'\d+(?:\.\d+)?', line)
+                        return int(numbers[3]) if len(numbers) >= 4 else int(numbers[-1])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def run(self):
+        os.makedirs(self.config.root, exist_ok=True)
+        shapes = [shape.strip() for shape in self.config.shapes.split(',') if shape.strip()]
+        for shape in shapes:
+            if shape not in SHAPES:
+                logger.error('[性能测试] 不支持的形状: {}, 支持: {}'.format(shape, ', '.join(SHAPES)))
+                continue
+            source = os.path.join(self.config.root, 'source-' + shape)
+            target = os.path.join(self.config.root, 'target')
+            generator = TreeGenerator(source, shape, seed=self.config.seed, scale=self.config.scale)
+            files, size = generator.generate()
+            logger.info('[性能测试] 生成{}: {}个文件, {:.1f}MiB'.format(shape, files, size / 1048576.0))
+            for combo in self._matrix():
+                for repeat in range(self.config.repeat):
+                    self._run_combo(shape, generator, source, target, combo, repeat)
+            if not self.config.keep:
+                generator.remove()
+                shutil.rmtree(target, ignore_errors=True)
+        self.report()
+        return self.results
+
+    def _run_combo(self, shape, generator, source, target, combo, repeat):
+        shutil.rmtree(target, ignore_errors=True)
+        db_path = os.path.join(self.config.root, 'sync-tool.db')
+        for path in (db_path, db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        for phase in PHASES:
+            if phase == 'warm':
+                generator.mutate(self.config.changed)
+            if phase == 'cold':
+                self._drop_caches()
+            options = dict(combo, source=source, target=target, db_path=db_path, hash_cache=self.config.hash_cache,
+                           log_level=self.config.log_level)
+            result = self._run_child(options)
+            seconds = max(result['seconds'], 1e-9)
+            result.update(combo, shape=shape, phase=phase, repeat=repeat, files=len(generator.files),
+                          files_per_s=len(generator.files) / seconds, mb_per_s=result['bytes'] / 1048576.0 / seconds)
+            self.results.append(result)
+            logger.info('[性能测试] {}'.format(self._format(result)))
+
+    @staticmethod
+    def _format(result):
+        return '{shape} {phase} threads={threads} compare={compare} copy={copy_strategy} engine={engine}: ' \
+               '{seconds:.3f}s, {files_per_s:.0f}文件/s, {mb_per_s:.1f}MB/s, 拷贝{copied}个, ' \
+               '读写调用{io_syscalls}, 系统调用{syscalls}, 峰值内存{peak_rss_mb:.1f}MB'.format(
+                    **dict(result, peak_rss_mb=result.get('peak_rss_mb') or 0))
+
+    def report(self):
+        path = self.config.report or os.path.join(self.config.root, 'bench-report.json')
+        with open(path, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                       'platform': sys.platform, 'config': dict(self.config.__dict__), 'results': self.results},
+                      f, indent=2, ensure_ascii=False)
+        logger.info('[性能测试] 结果已保存到{}'.format(path))
+
+
+if __name__ == '__main__':
+    config = BenchConfig(logger=logger)
+    config.show()
+    Benchmark(config).run()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import time
+import random
+import shutil
+import struct
+
+MiB = 1024 * 1024
+
+# files: 文件数, min_size/max_size: 文件大小范围(字节), width: 每个文件夹的文件数,
+# fanout: 每个文件夹的子文件夹数, depth: 文件夹的最大层数(0表示所有文件都在根目录)
+SHAPES = {
+    'tiny': dict(files=20000, min_size=0, max_size=4096, width=100, fanout=10, depth=3),
+    'huge': dict(files=4, min_size=256 * MiB, max_size=256 * MiB, width=4, fanout=1, depth=0),
+    'deep': dict(files=2000, min_size=1024, max_size=64 * 1024, width=10, fanout=1, depth=200),
+    'wide': dict(files=20000, min_size=0, max_size=4096, width=20000, fanout=1, depth=0),
+    'mixed': dict(files=5000, min_size=0, max_size=8 * MiB, width=50, fanout=4, depth=4),
+}
+
+
+class TreeGenerator(object):
+    """
+    生成测试用的原文件夹，同样的形状和seed生成的文件夹结构、文件大小和内容都一样
+        1. 文件夹按广度优先生成，每个文件夹最多fanout个子文件夹，最多depth层
+        2. 文件按顺序轮流放到各个文件夹里
+        3. 文件大小在[min_size, max_size]之间按对数均匀分布，小文件占多数
+        4. mutate按比例改动一部分文件，大小不变，只改几个位置的内容并更新修改时间
+    """
+    def __init__(self, root, shape='tiny', seed=1, scale=1.0, **kwargs):
+        """
+        :param scale: 文件数的缩放比例，比如0.1表示只生成形状里10%的文件
+        :param kwargs: 覆盖形状里的参数(files、min_size、max_size、width、fanout、depth)
+        """
+        if shape not in SHAPES:
+            raise ValueError('unsupported shape: {}, support: {}'.format(shape, tuple(SHAPES)))
+        params = dict(SHAPES[shape])
+        params.update(kwargs)
+        self.root = root
+        self.shape = shape
+        self.seed = seed
+        self.file_count = max(1, int(round(params['files'] * scale)))
+        self.min_size = params['min_size']
+        self.max_size = max(params['max_size'], self.min_size)
+        self.width = max(params['width'], 1)
+        self.fanout = max(params['fanout'], 1)
+        self.depth = params['depth']
+        self.files = []
+        self.total_size = 0
+        self._mutations = 0
+
+    def _dirs(self):
+        need = (self.file_count + self.width - 1) // self.width
+        dirs = [('', 0)]
+        index = 0
+        while len(dirs) < need and index < len(dirs):
+            parent, level = dirs[index]
+            index += 1
+            if level >= self.depth:
+                continue
+            for i in range(self.fanout):
+                if len(dirs) >= need:
+                    break
+                dirs.append((os.path.join(parent, 'd{}_{}'.format(level, i)), level + 1))
+        return [path for path, _ in dirs]
+
+    def _size(self, rnd):
+        if self.max_size <= self.min_size:
+            return self.min_size
+        low = max(self.min_size, 1)
+        size = int(round(2 ** rnd.uniform(low.bit_length() - 1, self.max_size.bit_length() - 1)))
+        return min(max(size, self.min_size), self.max_size)
+
+    @staticmethod
+    def _write(path, size, rnd):
+        """
+        小文件直接写随机内容，大文件重复写同一个随机块，每MiB开头写入偏移，避免出现完全一样的块
+        """
+        with open(path, 'wb') as f:
+            if size <= MiB:
+                f.write(rnd.randbytes(size))
+                return
+            block = bytearray(rnd.randbytes(MiB))
+            for offset in range(0, size, MiB):
+                struct.pack_into('<Q', block, 0, offset)
+                f.write(block[:min(MiB, size - offset)])
+
+    def generate(self):
+        """
+        删除并重新生成原文件夹
+        :return: (文件数, 总字节数)
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root)
+        rnd = random.Random(self.seed)
+        dirs = self._dirs()
+        for path in dirs[1:]:
+            os.makedirs(os.path.join(self.root, path), exist_ok=True)
+        self.files = []
+        self.total_size = 0
+        for i in range(self.file_count):
+            size = self._size(rnd)
+            path = os.path.join(self.root, dirs[i % len(dirs)], 'f{}.bin'.format(i))
+            self._write(path, size, rnd)
+            self.files.append((path, size))
+            self.total_size += size
+        self._mutations = 0
+        return len(self.files), self.total_size
+
+    def mutate(self, fraction):
+        """
+        改动fraction比例的文件(至少1个)，每次调用改动的文件不一样但可以重现
+        :return: (改动的文件数, 改动的文件的总字节数)
+        """
+        if not self.files or fraction <= 0:
+            return 0, 0
+        self._mutations += 1
+        rnd = random.Random(self.seed * 1000003 + self._mutations)
+        count = min(len(self.files), max(1, int(round(len(self.files) * fraction))))
+        now = time.time()
+        changed = 0
+        for path, size in rnd.sample(self.files, count):
+            if size > 0:
+                with open(path, 'r+b') as f:
+                    for _ in range(min(4, size)):
+                        f.seek(rnd.randrange(size))
+                        f.write(bytes([rnd.randrange(256)]))
+            # 修改时间往后推，避免和原来的一样
+            os.utime(path, (now + 2, now + 2))
+            changed += size
+        return count, changed
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
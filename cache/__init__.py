@@ -0,0 +1,4 @@
+from .cache import HashCache
+from .snapshot import DirRecord, DirSnapshot
+from .index import ContentIndex
+from .journal import TransferJournal
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import sqlite3
+import logging
+import threading
+
+
+class HashCache(object):
+    """
+    文件摘要缓存，保存在sqlite数据库里
+        1. 以路径为键，同时记录计算摘要时文件的(size, mtime_ns, ctime_ns, inode)
+        2. 只有文件当前的stat和记录的一致时才复用摘要，否则需要重新计算;
+           保留修改时间的原地覆盖(copy2、utime、touch -r)也会改变ctime
+        3. 遍历列出文件夹时通过prune_dir清理这个文件夹下已经不存在的记录，不需要额外stat
+    """
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, db_path, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+
+        self.db_path = db_path
+        self.algo = kwargs.pop('algo', 'md5')
+        self.hit_count = 0
+        self.miss_count = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(file_hash)')]
+        if columns and 'ctime_ns' not in columns:
+            # 旧版本的缓存没有ctime，不能再信任，重新建立
+            self._conn.execute('DROP TABLE file_hash')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS file_hash ('
+                           'path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, '
+                           'ino INTEGER, algo TEXT, digest TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS file_hash_dir ON file_hash (dir)')
+        self._conn.commit()
+
+    def get(self, path, st):
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, ctime_ns, ino, algo, digest FROM file_hash WHERE path=?',
+                                     (path,)).fetchone()
+            if row is not None and row[:5] == (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, self.algo):
+                self.hit_count += 1
+                return row[5]
+            self.miss_count += 1
+            return None
+
+    def put(self, path, st, digest):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (path, os.path.dirname(path), st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino,
+                                self.algo, digest))
+            self._pending += 1
+            if self._pending >= self.COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def remove(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._conn.execute('DELETE FROM file_hash WHERE path=?', (path,))
+            self._pending += 1
+
+    def prune_dir(self, dir_path, names):
+        """
+        清理dir_path下已经不存在的文件和文件夹的记录，只查询数据库，不stat
+        :param names: 刚列出的dir_path下所有的名字(包括被忽略的)
+        :return: 清理的记录数
+        """
+        dir_path = os.path.abspath(dir_path)
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM file_hash WHERE dir=?', (dir_path,)).fetchall()
+            missing = [(path,) for path, in rows if os.path.basename(path) not in names]
+            gone = [child for child in self._child_dirs(dir_path) if child not in names]
+            if not missing and not gone:
+                return 0
+            count = len(missing)
+            self._conn.executemany('DELETE FROM file_hash WHERE path=?', missing)
+            for child in gone:
+                child_path = os.path.join(dir_path, child)
+                prefix = child_path + os.sep
+                count += self._conn.execute('DELETE FROM file_hash WHERE dir=? OR (dir>=? AND dir<?)', (
+                    child_path, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).rowcount
+            self._pending += count
+        self.logger.debug('[摘要缓存] 清理{}条记录: {}'.format(count, dir_path))
+        return count
+
+    def _child_dirs(self, dir_path):
+        """
+        有记录的直接子文件夹的名字，按索引跳着查，查询次数只和子文件夹数有关
+        """
+        prefix = dir_path.rstrip(os.sep) + os.sep
+        # 以prefix开头的字符串都在[prefix, prefix的最后一个字符+1)这个区间
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        children = set()
+        start = prefix
+        while True:
+            row = self._conn.execute('SELECT MIN(dir) FROM file_hash WHERE dir>? AND dir<?', (start, upper)).fetchone()
+            if row is None or row[0] is None:
+                return children
+            child = row[0][len(prefix):].split(os.sep, 1)[0]
+            children.add(child)
+            child_prefix = prefix + child + os.sep
+            if not row[0].startswith(child_prefix):
+                start = row[0]
+                continue
+            # 跳过这个子文件夹下面的所有文件夹
+            start = self._conn.execute('SELECT MAX(dir) FROM file_hash WHERE dir>=? AND dir<?', (
+                child_prefix, child_prefix[:-1] + chr(ord(child_prefix[-1]) + 1))).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        self.logger.debug('[摘要缓存] 命中: {}, 未命中: {}'.format(self.hit_count, self.miss_count))
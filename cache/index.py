@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import stat
+import threading
+
+
+class ContentIndex(object):
+    """
+    目标里多出来的文件(原文件夹里已经没有)的内容索引，用来发现移动或重命名过的文件
+        1. 按大小分组，只有大小一样的文件才可能内容一样
+        2. 修改时间也一样时优先匹配，非strict时直接认为内容一样(拷贝会保留修改时间，和compare=meta的判断一致)，
+           否则调用check比较内容(比如比较摘要，有摘要缓存时复用)
+        3. 匹配上的文件从索引里移除，每个文件只会被用一次
+        4. 只保存在内存里，每次同步重新建立
+    """
+    def __init__(self, min_size=0):
+        self.min_size = min_size
+        self.count = 0
+        self._by_size = {}
+        self._lock = threading.Lock()
+
+    def add(self, path, st):
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+            return
+        with self._lock:
+            self._by_size.setdefault(st.st_size, []).append((path, st))
+            self.count += 1
+
+    def add_tree(self, path, matcher):
+        """
+        添加文件夹下所有没有被忽略的文件
+        :param matcher: path的匹配器(DirMatcher)
+        """
+        stack = [(path, matcher)]
+        while stack:
+            dir_path, dir_matcher = stack.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    items = list(it)
+            except OSError:
+                continue
+            for item in items:
+                if dir_matcher.check(item.name):
+                    continue
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append((item.path, dir_matcher.child(item.name)))
+                    else:
+                        self.add(item.path, item.stat(follow_symlinks=False))
+                except OSError:
+                    continue
+
+    def find(self, st, check, strict=False):
+        """
+        :param st: 要找的文件的stat
+        :param check: check(路径, stat)返回内容是否一样
+        :param strict: 为True时修改时间一样也要调用check
+        :return: 匹配的(路径, stat)，没有时返回None
+        """
+        with self._lock:
+            candidates = list(self._by_size.get(st.st_size, ()))
+        if not candidates:
+            return None
+        candidates.sort(key=lambda item: item[1].st_mtime_ns != st.st_mtime_ns)
+        for candidate in candidates:
+            path, candidate_stat = candidate
+            if strict or candidate_stat.st_mtime_ns != st.st_mtime_ns:
+                try:
+                    if not check(path, candidate_stat):
+                        continue
+                except OSError:
+                    continue
+            with self._lock:
+                group = self._by_size.get(st.st_size, [])
+                if candidate not in group:
+                    # 已经被其他线程用了
+                    continue
+                group.remove(candidate)
+                self.count -= 1
+            return candidate
+        return None
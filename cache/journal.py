@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import sqlite3
+import logging
+import threading
+
+
+class TransferJournal(object):
+    """
+    大文件拷贝的日志，保存在sqlite数据库里，用于中断(拔掉U盘、Ctrl+C、断电)后续传
+        1. 开始拷贝时记录目标、临时文件和原文件的(size, mtime_ns)
+        2. 临时文件的数据fdatasync之后才记录已完成的偏移，记录的偏移之前的数据一定已经写到磁盘上
+        3. 拷贝完成(原子替换目标)后删除记录
+        4. 续传时原文件的大小和修改时间必须和记录的一致，临时文件不能比记录的偏移短
+    """
+    def __init__(self, db_path, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS transfer_journal ('
+                           'target TEXT PRIMARY KEY, tmp TEXT, source TEXT, size INTEGER, mtime_ns INTEGER, '
+                           'offset INTEGER)')
+        self._conn.commit()
+
+    def resume_offset(self, target, tmp, source, source_stat, reset=False):
+        """
+        :param reset: 为True时不续传，直接重新开始记录
+        :return: 可以续传的偏移，不能续传时返回0(同时重新开始记录)
+        """
+        target = os.path.abspath(target)
+        tmp = os.path.abspath(tmp)
+        if not reset:
+            with self._lock:
+                row = self._conn.execute('SELECT tmp, source, size, mtime_ns, offset FROM transfer_journal '
+                                         'WHERE target=?', (target,)).fetchone()
+            if row is not None and row[4] and row[:4] == (tmp, os.path.abspath(source), source_stat.st_size,
+                                                          source_stat.st_mtime_ns):
+                try:
+                    if os.stat(tmp).st_size >= row[4]:
+                        return row[4]
+                except OSError:
+                    pass
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO transfer_journal VALUES (?, ?, ?, ?, ?, ?)',
+                               (target, tmp, os.path.abspath(source), source_stat.st_size,
+                                source_stat.st_mtime_ns, 0))
+            self._conn.commit()
+        return 0
+
+    def progress(self, target, offset):
+        """
+        记录已经写到磁盘上的偏移，调用前需要先fdatasync临时文件
+        """
+        with self._lock:
+            self._conn.execute('UPDATE transfer_journal SET offset=? WHERE target=?', (offset, os.path.abspath(target)))
+            self._conn.commit()
+
+    def finish(self, target):
+        with self._lock:
+            self._conn.execute('DELETE FROM transfer_journal WHERE target=?', (os.path.abspath(target),))
+            self._conn.commit()
+
+    def pending(self):
+        """
+        :return: 没有完成的拷贝[(目标, 临时文件, 已完成的偏移)]
+        """
+        with self._lock:
+            return self._conn.execute('SELECT target, tmp, offset FROM transfer_journal').fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class DirRecord(object):
+    """
+    一个原文件夹上次同步完成时的状态
+        mtime_ns: 原文件夹的修改时间(列出文件夹之前获取)
+        target_mtime_ns: 同步完成后目标文件夹的修改时间
+        fingerprint: 文件夹的忽略规则匹配器的指纹
+        has_ignore: 文件夹下是否有.syncignore
+        dirs: 未被忽略的子文件夹的名字
+    """
+    __slots__ = ('path', 'target', 'mtime_ns', 'target_mtime_ns', 'fingerprint', 'has_ignore', 'dirs')
+
+    def __init__(self, path, target, mtime_ns, target_mtime_ns, fingerprint, has_ignore, dirs):
+        self.path = path
+        self.target = target
+        self.mtime_ns = mtime_ns
+        self.target_mtime_ns = target_mtime_ns
+        self.fingerprint = fingerprint
+        self.has_ignore = has_ignore
+        self.dirs = dirs
+
+
+class DirSnapshot(object):
+    """
+    原文件夹的快照，保存在sqlite数据库里，用于增量遍历
+        1. 每个文件夹记录修改时间、目标文件夹的修改时间、匹配器指纹和未被忽略的子文件夹
+        2. 两边文件夹的修改时间和指纹都没变时，上次同步后文件夹里没有增删改名，
+           遍历时不需要再列出两边的文件夹，只需要stat子文件夹
+        3. 遍历时先用record记下，同步完成后commit时再获取目标文件夹的修改时间并保存，
+           有失败的文件夹(invalidate)不保存，下次重新遍历
+        4. 修改时间离当前时间太近(RACY_NS内)的文件夹不保存，避免同一个时间刻度内的改动被漏掉
+    """
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, db_path, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+
+        self.db_path = db_path
+        self.hit_count = 0
+        self.miss_count = 0
+        self._records = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS dir_snapshot ('
+                           'path TEXT PRIMARY KEY, target TEXT, mtime_ns INTEGER, target_mtime_ns INTEGER, '
+                           'fingerprint TEXT, has_ignore INTEGER, dirs TEXT)')
+        self._conn.commit()
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute('SELECT target, mtime_ns, target_mtime_ns, fingerprint, has_ignore, dirs '
+                                     'FROM dir_snapshot WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+        return DirRecord(path, row[0], row[1], row[2], row[3], bool(row[4]), json.loads(row[5]))
+
+    def lookup(self, path, target, source_stat, target_stat):
+        """
+        两边文件夹的修改时间和上次同步完成时一致时返回上次的记录，否则返回None
+        """
+        record = self.get(path) if target_stat is not None else None
+        if record is None or record.target != target or record.mtime_ns != source_stat.st_mtime_ns \
+                or record.target_mtime_ns != target_stat.st_mtime_ns:
+            return None
+        return record
+
+    def record(self, record, hit=False):
+        """
+        记下这次遍历得到的文件夹状态，commit时才保存
+        :param hit: 是否是复用的上次的记录
+        """
+        with self._lock:
+            if hit:
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+            self._records[record.path] = record
+
+    def invalidate(self, path):
+        """
+        path(原文件夹或目标文件夹)下有条目同步失败，这次不保存它的记录
+        """
+        with self._lock:
+            self._failed.add(path)
+
+    def commit(self):
+        """
+        同步完成后保存记录
+        :return: 保存的记录数
+        """
+        with self._lock:
+            records, failed = self._records, self._failed
+            self._records, self._failed = {}, set()
+        limit = time.time_ns() - self.RACY_NS
+        rows = []
+        for record in records.values():
+            if record.path in failed or record.target in failed or record.mtime_ns > limit:
+                continue
+            try:
+                target_mtime_ns = os.stat(record.target).st_mtime_ns
+            except OSError:
+                continue
+            if target_mtime_ns > limit or target_mtime_ns == record.target_mtime_ns:
+                continue
+            rows.append((record.path, record.target, record.mtime_ns, target_mtime_ns, record.fingerprint,
+                         int(record.has_ignore), json.dumps(record.dirs, ensure_ascii=False)))
+        with self._lock:
+            if failed:
+                self._conn.executemany('DELETE FROM dir_snapshot WHERE path=?', [(path,) for path in failed])
+            self._conn.executemany('INSERT OR REPLACE INTO dir_snapshot VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+        self.logger.debug('[文件夹快照] 复用: {}, 重新遍历: {}, 保存: {}'.format(self.hit_count, self.miss_count, len(rows)))
+        return len(rows)
+
+    def prune(self, root):
+        """
+        清理root下已经不存在的文件夹的记录
+        :return: 清理的记录数
+        """
+        root = os.path.abspath(root)
+        prefix = root.rstrip(os.sep) + os.sep
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM dir_snapshot WHERE path=? OR (path>=? AND path<?)',
+                                      (root, prefix, upper)).fetchall()
+        missing = [(path,) for path, in rows if not os.path.isdir(path)]
+        if missing:
+            with self._lock:
+                self._conn.executemany('DELETE FROM dir_snapshot WHERE path=?', missing)
+                self._conn.commit()
+            self.logger.debug('[文件夹快照] 清理{}条记录: {}'.format(len(missing), root))
+        return len(missing)
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -8,6 +8,10 @@
 
 import logging
 import functools
+import threading
+import atexit
+import queue
+import time
 import sys
 import os
 
@@ -16,9 +20,155 @@ LOGGET_FMT = '[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - - %(messag
 LOGGET_DATE_FMT = '%Y-%m-%d %H:%M:%S'
 
 
+class _Limit(object):
+    __slots__ = ('rate', 'sample', 'tokens', 'stamp', 'seen', 'dropped')
+
+    def __init__(self, rate, sample):
+        self.rate = rate
+        self.sample = sample
+        self.tokens = max(rate, 1)
+        self.stamp = time.monotonic()
+        self.seen = 0
+        self.dropped = 0
+
+    def allow(self):
+        self.seen += 1
+        if self.sample > 1 and (self.seen - 1) % self.sample:
+            return False
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1), self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    按分类(消息开头的[xxx])限制日志数量，WARNING及以上级别不限制
+        1. rate: 每秒最多输出的条数
+        2. sample: 每sample条只输出1条
+    被省略的条数会附加在下一条输出的同类日志后面
+    """
+    def __init__(self):
+        super(RateLimitFilter, self).__init__()
+        self.limits = {}
+        self._lock = threading.Lock()
+
+    def set(self, category, rate=0, sample=0):
+        if not category.startswith('['):
+            category = '[{}]'.format(category)
+        with self._lock:
+            if rate > 0 or sample > 1:
+                self.limits[category] = _Limit(rate, sample)
+            else:
+                self.limits.pop(category, None)
+
+    def filter(self, record):
+        if not self.limits or record.levelno >= logging.WARNING:
+            return True
+        msg = record.msg
+        if not isinstance(msg, str) or not msg.startswith('['):
+            return True
+        limit = self.limits.get(msg[:msg.find(']') + 1])
+        if limit is None:
+            return True
+        with self._lock:
+            if not limit.allow():
+                limit.dropped += 1
+                return False
+            dropped, limit.dropped = limit.dropped, 0
+        if dropped:
+            # 追加的文本不含%，不影响record.args的格式化
+            record.msg = '{} (省略了{}条同类日志)'.format(msg, dropped)
+        return True
+
+    def dropped(self):
+        with self._lock:
+            return dict((category, limit.dropped) for category, limit in self.limits.items() if limit.dropped)
+
+
+class BatchQueueHandler(logging.Handler):
+    """
+    只把日志放进队列，不格式化也不写，调用线程不会因为输出阻塞
+    """
+    def __init__(self, que):
+        super(BatchQueueHandler, self).__init__()
+        self.que = que
+
+    def emit(self, record):
+        self.que.put(record)
+
+
+class BatchListener(threading.Thread):
+    """
+    后台线程，从队列里批量取出日志，格式化后每个handler一次写入并flush
+    """
+    def __init__(self, que, handlers, batch_size=512):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.que = que
+        self.handlers = handlers
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            batch = [self.que.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.que.get_nowait())
+                except queue.Empty:
+                    break
+            self.write([item for item in batch if isinstance(item, logging.LogRecord)])
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if None in batch:
+                break
+
+    def write(self, records):
+        for handler in self.handlers:
+            lines = []
+            for record in records:
+                if record.levelno < handler.level:
+                    continue
+                try:
+                    lines.append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+            finally:
+                handler.release()
+
+    def flush(self, timeout=None):
+        """
+        等待队列里已有的日志都写完
+        """
+        if not self.is_alive():
+            return
+        event = threading.Event()
+        self.que.put(event)
+        event.wait(timeout)
+
+    def stop(self):
+        if self.is_alive():
+            self.que.put(None)
+            self.join()
+
+
 class Logger(logging.Logger):
     """
     自定义日志类，单例模式
+    日志先放进队列，由后台线程批量写到控制台和文件，工作线程不用等控制台输出
     """
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, '_logger'):
@@ -26,19 +176,36 @@ class Logger(logging.Logger):
             stream_handler = logging.StreamHandler(sys.stdout)
             stream_handler.setLevel(logging.DEBUG)
             stream_handler.setFormatter(logging.Formatter(LOGGET_FMT, LOGGET_DATE_FMT))
-            cls._logger.addHandler(stream_handler)
 
             file_path = os.path.join(os.getcwd(), 'sync-tool.log') if hasattr(sys, 'frozen') else \
                 os.path.join(os.getcwd(), 'spec', 'dist', 'sync-tool.log')
             file_handler = logging.FileHandler(file_path, mode='w')
             file_handler.setLevel(logging.DEBUG)
             file_handler.setFormatter(logging.Formatter(LOGGET_FMT, LOGGET_DATE_FMT))
-            cls._logger.addHandler(file_handler)
+
+            que = queue.SimpleQueue()
+            cls._limiter = RateLimitFilter()
+            queue_handler = BatchQueueHandler(que)
+            queue_handler.addFilter(cls._limiter)
+            cls._logger.addHandler(queue_handler)
+            cls._listener = BatchListener(que, [stream_handler, file_handler])
+            cls._listener.start()
+            atexit.register(cls._close)
 
         return cls._logger
 
+    @classmethod
+    def _close(cls):
+        for category, count in cls._limiter.dropped().items():
+            cls._logger.info('[日志] {}最后省略了{}条'.format(category, count))
+        cls._listener.stop()
+
 logger = Logger()
 logger.setLevel(logging.INFO)
+# 等待日志写完，比如等待用户输入之前
+logger.flush = Logger._listener.flush
+# 按分类限制日志数量，比如logger.set_rate_limit('拷贝', rate=100)
+logger.set_rate_limit = Logger._limiter.set
 
 
 # 新增日志级别VERBOSE
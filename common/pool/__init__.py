@@ -0,0 +1,2 @@
+from .pool import ThreadPool, WorkThread
+from .adaptive import AdaptiveTuner
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import sys
+import time
+import logging
+import threading
+
+
+class AdaptiveTuner(threading.Thread):
+    """
+    根据吞吐量自动调整线程池的线程数(爬山法)
+        1. 每interval秒计算一次得分 = 字节数/秒 + 任务数/秒 * OP_BYTES，小文件多时主要看任务数
+        2. 得分比上一次提高超过TOLERANCE时继续朝同一个方向调整，下降时反向，变化不大时减少线程
+        3. 每个任务的平均耗时上涨超过LATENCY_RATIO倍但得分没有提高时减少线程(磁盘已经饱和，线程多了只是在排队)
+        4. 没有积压的任务时(遍历跟不上)不调整，线程数不影响速度
+        5. 线程数限制在[min_size, max_size]之间，每次调整max(1, 线程数/4)个
+    """
+    OP_BYTES = 64 * 1024
+    TOLERANCE = 0.05
+    LATENCY_RATIO = 1.5
+
+    def __init__(self, pool, bytes_func=None, min_size=2, max_size=32, interval=1.0, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.pool = pool
+        self.bytes_func = bytes_func if bytes_func is not None else lambda: 0
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.interval = interval
+        self.direction = 1
+        # (线程数, 得分)，记录每次调整，可以用来分析
+        self.history = []
+        self._score = None
+        self._latency = None
+        self._stop_event = threading.Event()
+        size = min(max(pool.thread_size, self.min_size), self.max_size)
+        if size != pool.thread_size:
+            pool.set_thread_size(size)
+
+    def _sample(self):
+        pool = self.pool
+        return time.perf_counter(), self.bytes_func(), pool.success_count + pool.failed_count, pool.busy_time
+
+    def run(self):
+        last = self._sample()
+        while not self._stop_event.wait(self.interval):
+            now = self._sample()
+            self.step(now[0] - last[0], now[1] - last[1], now[2] - last[2], now[3] - last[3])
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def step(self, seconds, nbytes, ops, busy):
+        """
+        根据一个周期内的字节数、完成的任务数和任务累计耗时调整一次线程数
+        :return: 调整后的线程数
+        """
+        pool = self.pool
+        size = pool.thread_size
+        if not ops or pool._unfinished <= size:
+            # 没有任务或者没有积压，下一次重新建立基准
+            self._score = None
+            self._latency = None
+            return size
+        score = (nbytes + ops * self.OP_BYTES) / max(seconds, 1e-6)
+        latency = busy / ops
+        if self._score is not None:
+            change = (score - self._score) / max(self._score, 1e-6)
+            if change < -self.TOLERANCE:
+                self.direction = -self.direction
+            elif change <= self.TOLERANCE:
+                self.direction = -1
+            if latency > self._latency * self.LATENCY_RATIO and change <= self.TOLERANCE:
+                self.direction = -1
+        self._score = score
+        self._latency = latency
+        new_size = min(max(size + self.direction * max(1, size // 4), self.min_size), self.max_size)
+        if new_size == size:
+            # 到达边界，下一次反向试探
+            self.direction = -self.direction
+            return size
+        pool.set_thread_size(new_size)
+        self.history.append((new_size, score))
+        self.logger.debug('[线程数] {} -> {}, {:.1f}MB/s, {:.0f}个任务/秒, 平均{:.3f}毫秒'.format(
+            size, new_size, nbytes / max(seconds, 1e-6) / 1e6, ops / max(seconds, 1e-6), latency * 1000))
+        return new_size
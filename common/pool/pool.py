@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from ..log import logger
+
+
+class WorkThread(threading.Thread):
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.start()
+
+    def run(self):
+        pool = self.pool
+        while True:
+            pool._acquire_worker()
+            try:
+                item = pool.que.get()
+                if item is None:
+                    break
+                pool._run(item)
+            finally:
+                pool._release_worker()
+
+
+class ThreadPool(object):
+    """
+    线程池
+        1. 工作线程阻塞等待任务，没有轮询
+        2. queue_size大于0时，等待执行的任务数达到上限后add_task会阻塞（工作线程里提交的任务除外，避免死锁）
+        3. add_task返回concurrent.futures.Future，线程池本身不保存任务和结果，内存占用和任务总数无关
+        4. 任务函数返回整数时会累加到copy_count
+        5. 很多小任务可以通过add_batch合成一个批次，减少每个任务的排队和调度开销
+        6. 同时执行任务的线程数可以通过set_thread_size在运行时调整，减少时多出来的线程执行完当前任务后等待
+        7. add_helper提交的辅助任务(比如分块拷贝的其它块)不计入任务数、成功数、失败数和copy_count
+    """
+    def __init__(self, thread_size=10, queue_size=0):
+        self.que = queue.Queue()
+        self.alive = True
+        self.task_count = 0
+        self.success_count = 0
+        self.failed_count = 0
+        self.copy_count = 0
+        self.failures = []
+        self.thread_size = thread_size
+        # 任务的累计执行时间(秒)，用于计算平均延迟
+        self.busy_time = 0.0
+        self._slots = threading.Semaphore(queue_size) if queue_size > 0 else None
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self._active = 0
+        self._gate = threading.Condition()
+        self.threads = []
+        self._idents = set()
+        self.set_thread_size(thread_size)
+
+    def set_thread_size(self, thread_size):
+        """
+        调整同时执行任务的线程数，线程不够时创建新的线程
+        """
+        thread_size = max(1, thread_size)
+        with self._gate:
+            self.thread_size = thread_size
+            while len(self.threads) < thread_size:
+                thread = WorkThread(self)
+                self.threads.append(thread)
+                self._idents = self._idents | {thread.ident}
+            self._gate.notify_all()
+
+    def _acquire_worker(self):
+        with self._gate:
+            self._gate.wait_for(lambda: self._active < self.thread_size or not self.alive)
+            self._active += 1
+
+    def _release_worker(self):
+        with self._gate:
+            self._active -= 1
+            self._gate.notify()
+
+    def add_task(self, task, *args, **kwargs):
+        return self._submit(task, args, kwargs, None)
+
+    def add_batch(self, task, args_list):
+        """
+        把多个小任务合成一个批次提交，只占用一个队列位置，在同一个工作线程里依次执行
+        每个小任务单独计数，失败时也单独记录，不影响批次里的其它任务
+        :param args_list: [args]，每个args调用一次task(*args)
+        :return: Future，结果为每个小任务的结果(失败的为None)的列表
+        """
+        return self._submit(task, (), {}, list(args_list))
+
+    def add_helper(self, task, *args, **kwargs):
+        """
+        提交辅助任务，只占用线程，不计数，结果和异常只通过返回的Future传递
+        """
+        return self._submit(task, args, kwargs, None, counted=False)
+
+    def _submit(self, task, args, kwargs, batch, counted=True):
+        if not self.alive:
+            raise RuntimeError('ThreadPool is stopped')
+        bounded = self._slots is not None and threading.get_ident() not in self._idents
+        if bounded:
+            self._slots.acquire()
+        future = Future()
+        with self._cond:
+            if counted:
+                self.task_count += len(batch) if batch is not None else 1
+            self._unfinished += 1
+        self.que.put((future, bounded, task, args, kwargs, batch, counted))
+        return future
+
+    def _call(self, func, args, kwargs, counted=True):
+        if not counted:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            logger.error('[任务失败] {}{}, {}'.format(getattr(func, '__name__', func), args, e))
+            with self._cond:
+                self.busy_time += time.perf_counter() - start
+                self.failed_count += 1
+                self.failures.append((args, e))
+            raise
+        with self._cond:
+            self.busy_time += time.perf_counter() - start
+            self.success_count += 1
+            if isinstance(result, int):
+                self.copy_count += result
+        return result
+
+    def _run(self, item):
+        future, bounded, func, args, kwargs, batch, counted = item
+        if bounded:
+            self._slots.release()
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            if batch is not None:
+                results = []
+                for batch_args in batch:
+                    try:
+                        results.append(self._call(func, batch_args, {}))
+                    except Exception:
+                        results.append(None)
+                future.set_result(results)
+                return
+            try:
+                result = self._call(func, args, kwargs, counted)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        finally:
+            with self._cond:
+                self._unfinished -= 1
+                if self._unfinished == 0:
+                    self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        等待所有已提交的任务完成（包括任务执行过程中提交的任务）
+        :return: 是否全部完成
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def stop(self):
+        """
+        停止线程池，未开始执行的任务会被取消
+        """
+        if not self.alive:
+            return
+        self.alive = False
+        while True:
+            try:
+                item = self.que.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+                self._run(item)
+        self.shutdown()
+
+    def shutdown(self):
+        with self._gate:
+            self.alive = False
+            self._gate.notify_all()
+        for _ in self.threads:
+            self.que.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def wait_all_task_done(self):
+        self.wait()
+        self.shutdown()
+        logger.info('总任务数: {}, 成功: {}, 失败: {}'.format(self.task_count, self.success_count, self.failed_count))
+        return self.copy_count
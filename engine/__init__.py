@@ -0,0 +1,2 @@
+from .engine import AsyncEngine
+from .fanout import FanOutEngine, TargetResult
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import stat
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from rule.rule import Rule
+from walker import Walker, ExtraEntry
+
+
+class AsyncEngine(object):
+    """
+    基于asyncio的同步引擎，阻塞的文件操作交给两个有上限的线程池执行
+        1. 元数据操作(列出文件夹、stat、创建文件夹、删除)使用meta_concurrency个线程，
+           同时遍历meta_concurrency个文件夹，适合延迟高的网络文件夹
+        2. 数据操作(比较内容、计算摘要、拷贝)使用data_concurrency个线程，避免大量并发读写拖慢磁盘
+        3. 只根据stat就能判断没有改动的文件在事件循环里直接跳过，不占用线程
+        4. 等待拷贝的文件最多queue_size个，超过时遍历会暂停等待
+        5. 遍历、比较和拷贝的规则和SyncTool.sync_tree一致(忽略规则、镜像模式、文件夹快照)
+    """
+    def __init__(self, sync_tool, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+        self.meta_concurrency = max(kwargs.pop('meta_concurrency', 32), 1)
+        self.data_concurrency = max(kwargs.pop('data_concurrency', 4), 1)
+        self.queue_size = kwargs.pop('queue_size', 10000)
+        self.copy_count = 0
+        self.failed_count = 0
+        self._meta = None
+        self._data = None
+        self._walker = None
+
+    def sync_tree(self, source_path, target_path):
+        """
+        遍历并同步，阻塞直到完成
+        :return: 拷贝的文件数
+        """
+        return asyncio.run(self._sync_tree(os.path.abspath(source_path), os.path.abspath(target_path)))
+
+    async def _sync_tree(self, source_path, target_path):
+        sync_tool = self.sync_tool
+        sync_tool._rule = Rule(source_path, logger=self.logger)
+        self._walker = Walker(sync_tool._rule, logger=self.logger, mirror=sync_tool.mirror,
+                              snapshot=sync_tool.snapshot, metrics=sync_tool.metrics, on_list=sync_tool._on_list)
+        self.copy_count = self.failed_count = 0
+        self._meta = ThreadPoolExecutor(self.meta_concurrency, thread_name_prefix='meta')
+        self._data = ThreadPoolExecutor(self.data_concurrency, thread_name_prefix='data')
+        dirs = asyncio.Queue()
+        files = asyncio.Queue(self.queue_size if self.queue_size > 0 else 0)
+        if sync_tool.metrics is not None:
+            sync_tool.metrics.add_gauge('scan_queue', dirs.qsize)
+            sync_tool.metrics.add_gauge('copy_queue', files.qsize)
+        workers = [asyncio.ensure_future(self._dir_worker(dirs, files)) for _ in range(self.meta_concurrency)]
+        workers += [asyncio.ensure_future(self._file_worker(files)) for _ in range(self.data_concurrency)]
+        try:
+            root = await self._meta_call(self._root_entry, source_path, target_path)
+            if root is not None:
+                await self._handle(root, dirs, files)
+            await dirs.join()
+            if sync_tool._progress is not None:
+                sync_tool._progress.scanning = False
+            await files.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._meta.shutdown()
+            self._data.shutdown()
+        if sync_tool.snapshot is not None:
+            sync_tool.snapshot.commit()
+        self.logger.info('[异步引擎] 拷贝: {}, 失败: {}'.format(self.copy_count, self.failed_count))
+        return self.copy_count
+
+    def _root_entry(self, source_path, target_path):
+        # walk生成的第一个条目就是根目录(或者原路径是文件时的文件条目)，不会继续遍历
+        return next(self._walker.walk(source_path, target_path), None)
+
+    async def _meta_call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._meta, func, *args)
+
+    async def _data_call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._data, func, *args)
+
+    async def _handle(self, entry, dirs, files):
+        sync_tool = self.sync_tool
+        if isinstance(entry, ExtraEntry):
+            await self._meta_call(sync_tool._remove_extras, entry)
+            return
+        if entry.is_dir:
+            # 类型冲突和创建文件夹
+            await self._meta_call(sync_tool._dispatch, entry)
+            dirs.put_nowait(entry)
+            return
+        if entry.target_stat is not None and stat.S_ISDIR(entry.target_stat.st_mode):
+            await self._meta_call(sync_tool._resolve_conflict, entry)
+        if sync_tool.check_meta(entry.source_stat, entry.target_stat) is False:
+            sync_tool._decided()
+            return
+        await files.put(entry)
+
+    async def _dir_worker(self, dirs, files):
+        while True:
+            dir_entry = await dirs.get()
+            try:
+                entries = await self._meta_call(self._walker.scan_dir, dir_entry)
+                for entry in entries:
+                    try:
+                        await self._handle(entry, dirs, files)
+                    except Exception as e:
+                        self.logger.error('[处理失败] {}, {}'.format(getattr(entry, 'source', entry.target), e))
+                        self._invalidate(entry)
+            except Exception as e:
+                self.logger.error('[遍历文件夹失败] {}, {}'.format(dir_entry.source, e))
+            finally:
+                dirs.task_done()
+
+    async def _file_worker(self, files):
+        sync_tool = self.sync_tool
+        while True:
+            entry = await files.get()
+            try:
+                # 不能分块交给线程池，否则同时拷贝的线程数会超过data_concurrency
+                count = await self._data_call(sync_tool._check_copy, entry.source, entry.target,
+                                              entry.source_stat, entry.target_stat, False)
+                self.copy_count += count
+            except Exception as e:
+                self.logger.error('[任务失败] {}, {}'.format(entry.source, e))
+                self.failed_count += 1
+                self._invalidate(entry)
+            finally:
+                files.task_done()
+
+    def _invalidate(self, entry):
+        snapshot = self.sync_tool.snapshot
+        if snapshot is None:
+            return
+        if isinstance(entry, ExtraEntry):
+            snapshot.invalidate(entry.target)
+        else:
+            snapshot.invalidate(os.path.dirname(entry.source))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import stat
+import logging
+import threading
+from rule.rule import Rule
+from walker import Walker, SyncEntry, ExtraEntry
+
+
+class TargetResult(object):
+    """
+    一个目标的同步结果
+        failures: [(路径, 异常)]
+    """
+    def __init__(self, target):
+        self.target = target
+        self.copied = 0
+        self.deleted = 0
+        self.failures = []
+
+    @property
+    def failed(self):
+        return len(self.failures)
+
+
+class FanOutEngine(object):
+    """
+    一个原文件夹同步到多个目标
+        1. 原文件夹只遍历一次(Walker.scan_dir_multi)，每个目标文件夹分别列出、比较和删除多出来的条目
+        2. 一个文件需要拷贝到多个目标时用TeeCopier只读一次原文件，只有一个目标需要时和单目标同步一样(增量拷贝、分块拷贝)
+        3. 每个目标有自己的结果(TargetResult)，某个目标失败(比如磁盘满了)不影响其他目标，
+           目标文件夹创建失败时只跳过这个目标下的子树
+        4. 所有目标都只根据stat就能判断没有改动的文件不提交任务，小文件每batch_size个合成一个任务
+        5. 没有摘要缓存时，多个目标需要比较内容的文件先算一次原文件的摘要，每个目标只读目标文件
+    """
+    def __init__(self, sync_tool, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+        self.results = []
+        self._batch = []
+        self._lock = threading.Lock()
+
+    def sync_tree(self, source_path, target_paths):
+        """
+        遍历并同步，有线程池时提交完所有任务后等待完成
+        :return: 所有目标拷贝的文件数之和
+        """
+        sync_tool = self.sync_tool
+        source_path = os.path.abspath(source_path)
+        target_paths = [os.path.abspath(path) for path in target_paths]
+        self.results = [TargetResult(path) for path in target_paths]
+        sync_tool._rule = Rule(source_path, logger=self.logger)
+        walker = Walker(sync_tool._rule, logger=self.logger, mirror=sync_tool.mirror, metrics=sync_tool.metrics,
+                        on_list=sync_tool._on_list)
+        try:
+            source_stat = os.stat(source_path)
+        except OSError as e:
+            self.logger.error('[遍历文件夹失败] {}, {}'.format(source_path, e))
+            return 0
+        if not stat.S_ISDIR(source_stat.st_mode):
+            self._submit([SyncEntry(source_path, path, False, source_stat, walker._stat(path))
+                          for path in target_paths])
+        else:
+            matcher = sync_tool._rule.dir_matcher(source_path)
+            stack = [[self._prepare_dir(index, SyncEntry(source_path, path, True, source_stat,
+                                                          walker._stat(path), matcher))
+                      for index, path in enumerate(target_paths)]]
+            while stack:
+                group = stack.pop()
+                if all(entry is None for entry in group):
+                    continue
+                columns = []
+                for index, entries in enumerate(walker.scan_dir_multi(group)):
+                    for position, entry in enumerate(entries):
+                        if isinstance(entry, ExtraEntry):
+                            self._run(self._remove_extras, index, entry)
+                            continue
+                        if position >= len(columns):
+                            columns.append([None] * len(group))
+                        columns[position][index] = entry
+                for column in columns:
+                    first = next(entry for entry in column if entry is not None)
+                    if first.is_dir:
+                        stack.append([self._prepare_dir(index, entry) for index, entry in enumerate(column)])
+                    else:
+                        self._submit(column)
+        if sync_tool._progress is not None:
+            sync_tool._progress.scanning = False
+        if sync_tool.pool is not None:
+            self._flush_batch()
+            sync_tool.pool.wait()
+        return sum(result.copied for result in self.results)
+
+    def _run(self, func, *args):
+        if self.sync_tool.pool is not None:
+            self.sync_tool.pool.add_task(func, *args)
+        else:
+            func(*args)
+
+    def _add(self, index, copied=0, deleted=0):
+        with self._lock:
+            self.results[index].copied += copied
+            self.results[index].deleted += deleted
+
+    def _fail(self, index, path, e):
+        self.logger.error('[同步失败] {}, {}'.format(path, e))
+        with self._lock:
+            self.results[index].failures.append((path, e))
+
+    def _prepare_dir(self, index, entry):
+        """
+        处理类型冲突并创建目标文件夹
+        :return: 失败时返回None，不再遍历这个目标下的子树
+        """
+        if entry is None:
+            return None
+        try:
+            if entry.target_stat is not None and not stat.S_ISDIR(entry.target_stat.st_mode):
+                self._add(index, deleted=self.sync_tool._resolve_conflict(entry))
+            if entry.target_stat is None:
+                os.makedirs(entry.target, exist_ok=True)
+                self.logger.info('[创建文件夹] %s', entry.target)
+        except Exception as e:
+            self._fail(index, entry.target, e)
+            return None
+        return entry
+
+    def _remove_extras(self, index, entry):
+        try:
+            self._add(index, deleted=self.sync_tool._remove_items(entry))
+        except Exception as e:
+            self._fail(index, entry.target, e)
+        return 0
+
+    def _submit(self, column):
+        sync_tool = self.sync_tool
+        if all(entry is None or sync_tool.check_meta(entry.source_stat, entry.target_stat) is False
+               for entry in column):
+            sync_tool._decided()
+            return
+        if sync_tool.pool is None:
+            self._sync_file(column)
+            return
+        first = next(entry for entry in column if entry is not None)
+        if sync_tool.batch_size > 1 and first.source_stat.st_size < sync_tool.small_file_size:
+            self._batch.append((column,))
+            if len(self._batch) >= sync_tool.batch_size:
+                self._flush_batch()
+            return
+        sync_tool.pool.add_task(self._sync_file, column)
+
+    def _flush_batch(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            self.sync_tool.pool.add_batch(self._sync_file, batch)
+
+    def _source_digest(self, column):
+        """
+        没有摘要缓存且有多个目标需要比较内容时，原文件只读一次算出摘要，每个目标只读目标文件
+        :return: 原文件的摘要，不需要或者读取失败时返回None(逐个比较)
+        """
+        sync_tool = self.sync_tool
+        if sync_tool.hash_cache is not None:
+            return None
+        entries = [entry for entry in column if entry is not None and entry.target_stat is not None and
+                   not stat.S_ISDIR(entry.target_stat.st_mode) and
+                   sync_tool.check_meta(entry.source_stat, entry.target_stat) is None]
+        if len(entries) < 2:
+            return None
+        try:
+            with sync_tool._timer('compare'):
+                return sync_tool.get_file_hash(entries[0].source, entries[0].source_stat)
+        except OSError as e:
+            self.logger.debug('[计算摘要失败] %s, %s', entries[0].source, e)
+            return None
+
+    def _sync_file(self, column):
+        """
+        比较一个原文件和各个目标，再拷贝到需要的目标
+        :return: 拷贝的目标数
+        """
+        sync_tool = self.sync_tool
+        pending = []
+        source_digest = self._source_digest(column)
+        for index, entry in enumerate(column):
+            if entry is None:
+                continue
+            try:
+                if entry.target_stat is not None and stat.S_ISDIR(entry.target_stat.st_mode):
+                    self._add(index, deleted=sync_tool._resolve_conflict(entry))
+                with sync_tool._timer('compare'):
+                    changed = sync_tool.check_file_is_change(entry.source, entry.target, entry.source_stat,
+                                                             entry.target_stat, source_digest=source_digest)
+                if changed:
+                    pending.append((index, entry))
+            except Exception as e:
+                self._fail(index, entry.target, e)
+        sync_tool._decided()
+        if not pending:
+            return 0
+        source, source_stat = pending[0][1].source, pending[0][1].source_stat
+        size = source_stat.st_size
+        if sync_tool.metrics is not None:
+            sync_tool.metrics.incr('copy_bytes', size * len(pending))
+        # 只有一个目标需要拷贝，或者可以增量拷贝的目标，单独拷贝
+        single = [(index, entry) for index, entry in pending if len(pending) == 1 or (
+            sync_tool.delta is not None and entry.target_stat is not None and size >= sync_tool.delta_min_size)]
+        tee = [item for item in pending if item not in single]
+        count = 0
+        for index, entry in single:
+            try:
+                sync_tool.copy_file(source, entry.target, source_stat, entry.target_stat)
+            except Exception as e:
+                self._fail(index, entry.target, e)
+                continue
+            self._add(index, copied=1)
+            count += 1
+        if tee:
+            with sync_tool._timer('copy', size):
+                errors = sync_tool.tee.copy(source, [entry.target for _, entry in tee], source_stat)
+            sync_tool._add_io(size)
+            for index, entry in tee:
+                if entry.target in errors:
+                    self._fail(index, entry.target, errors[entry.target])
+                    continue
+                self.logger.info('[拷贝] 从%s到%s, tee', source, entry.target)
+                self._add(index, copied=1)
+                count += 1
+        return count
@@ -0,0 +1,7 @@
+from .hasher import BUFFER_SIZE, HASH_ALGORITHMS, new_hash, file_digest
+from .compare import compare_files
+from .copier import Copier
+from .delta import DeltaCopier
+from .chunked import ChunkedCopier
+from .tee import TeeCopier
+from .sparse import is_sparse, data_extents
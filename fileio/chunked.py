@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import shutil
+import threading
+from .hasher import BUFFER_SIZE
+from .copier import UNSUPPORTED_ERRNOS, temp_path, remove_quietly
+from .sparse import is_sparse, data_extents
+
+# 续传前比较临时文件和原文件在已完成偏移之前的这么多字节，不一样时从头开始
+VERIFY_SIZE = 1024 * 1024
+
+
+class _Job(object):
+    """
+    一个文件的分块拷贝任务，多个线程从里面领取块
+    """
+    def __init__(self, infd, outfd, size, chunk_size, start=0, journal=None, target=None, extents=None):
+        self.infd = infd
+        self.outfd = outfd
+        self.size = size
+        self.journal = journal
+        self.target = target
+        # 稀疏文件只拷贝数据段，空洞不用处理
+        self.chunks = []
+        for extent_start, length in extents if extents is not None else [(0, size)]:
+            end = extent_start + length
+            self.chunks.extend((offset, min(chunk_size, end - offset))
+                               for offset in range(max(extent_start, start), end, chunk_size))
+        self.bytes = sum(length for _, length in self.chunks)
+        self.next = 0
+        self.claimed = 0
+        self.done = 0
+        self.error = None
+        self.kernel = hasattr(os, 'copy_file_range')
+        self.cond = threading.Condition()
+        # 从文件开头连续完成的偏移(第一个没完成的块的偏移)，以及已经完成但前面还有没完成的块
+        self.completed = start
+        self.finished = set()
+        self._index = 0
+        self.sync_lock = threading.Lock()
+
+    def advance(self, offset):
+        """
+        :return: 连续完成的偏移有变化时返回新的偏移，否则返回None
+        """
+        with self.cond:
+            self.finished.add(offset)
+            index = self._index
+            while self._index < len(self.chunks) and self.chunks[self._index][0] in self.finished:
+                self.finished.discard(self.chunks[self._index][0])
+                self._index += 1
+            if self._index == index:
+                return None
+            self.completed = self.chunks[self._index][0] if self._index < len(self.chunks) else self.size
+            return self.completed
+
+    def claim(self):
+        with self.cond:
+            if self.error is not None or self.next >= len(self.chunks):
+                return None
+            chunk = self.chunks[self.next]
+            self.next += 1
+            self.claimed += 1
+            return chunk
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done += 1
+            if error is not None and self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+
+class ChunkedCopier(object):
+    """
+    大文件分块并行拷贝
+        1. 先在目标文件夹下创建临时文件并预分配空间，再按chunk_size分成多个块
+        2. 调用copy的线程和通过submit提交的辅助任务一起领取块，每个块用带偏移的
+           copy_file_range(不支持时用pread/pwrite)独立拷贝，互不影响
+        3. 调用线程自己也在拷贝，所以辅助任务排在队列后面没有执行时也不会死锁，
+           领取不到块的辅助任务直接结束
+        4. 所有块完成后保留修改时间等信息，再用os.replace原子替换目标，失败时删除临时文件
+        5. 稀疏文件只拷贝数据段，临时文件不预分配空间，保留同样的空洞
+        6. 指定journal(TransferJournal)时，连续完成的块fdatasync后记录偏移，失败或中断时保留临时文件，
+           下次从记录的偏移继续拷贝
+    """
+    def __init__(self, chunk_size=64 * 1024 * 1024, buffer_size=BUFFER_SIZE):
+        self.chunk_size = max(chunk_size, buffer_size)
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.bytes = 0
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def supported():
+        return hasattr(os, 'pread') and hasattr(os, 'pwrite')
+
+    def copy(self, source, target, source_stat, submit=None, workers=1, journal=None):
+        """
+        :param submit: submit(func, *args)，用于提交辅助任务(比如线程池的add_helper)，为None时只在当前线程拷贝
+        :param workers: 最多同时拷贝的线程数(包括当前线程)
+        :param journal: 拷贝日志(TransferJournal)，为None时不能续传
+        :return: (块数, 续传的偏移)
+        """
+        size = source_stat.st_size
+        tmp = temp_path(target)
+        infd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            start = 0
+            if journal is not None:
+                start = journal.resume_offset(target, tmp, source, source_stat)
+                if start and not self._verify(infd, tmp, start):
+                    start = journal.resume_offset(target, tmp, source, source_stat, reset=True)
+            flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+            outfd = os.open(tmp, flags if start else flags | os.O_TRUNC, 0o600)
+            try:
+                try:
+                    extents = data_extents(infd, size) if is_sparse(source_stat) else None
+                    if extents is None:
+                        self._preallocate(outfd, size)
+                    else:
+                        # 预分配会让空洞也占用空间，只设置大小
+                        os.ftruncate(outfd, size)
+                    job = _Job(infd, outfd, size, self.chunk_size, start, journal, target, extents)
+                    if submit is not None:
+                        for _ in range(min(workers, len(job.chunks)) - 1):
+                            submit(self._work, job)
+                    self._work(job)
+                    with job.cond:
+                        job.cond.wait_for(lambda: job.done == job.claimed)
+                    if job.error is not None:
+                        raise job.error
+                finally:
+                    os.close(outfd)
+                shutil.copystat(source, tmp)
+                os.replace(tmp, target)
+            except BaseException as e:
+                # 有拷贝日志时保留临时文件，下次续传; 原文件被截短时续传没有意义
+                if journal is None or isinstance(e, EOFError):
+                    remove_quietly(tmp)
+                    if journal is not None:
+                        journal.finish(target)
+                raise
+            if journal is not None:
+                journal.finish(target)
+        finally:
+            os.close(infd)
+        with self._lock:
+            self.count += 1
+            self.bytes += job.bytes
+            if start:
+                self.resumed += 1
+        return len(job.chunks), start
+
+    @staticmethod
+    def _verify(infd, tmp, offset):
+        """
+        比较临时文件和原文件在offset之前的最后一段数据
+        """
+        length = min(offset, VERIFY_SIZE)
+        try:
+            fd = os.open(tmp, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            return False
+        try:
+            return os.pread(fd, length, offset - length) == os.pread(infd, length, offset - length)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _preallocate(fd, size):
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, size)
+
+    def _work(self, job):
+        while True:
+            chunk = job.claim()
+            if chunk is None:
+                return
+            try:
+                self._copy_chunk(job, *chunk)
+                if job.journal is not None:
+                    self._record(job, chunk[0])
+            except Exception as e:
+                job.finish(e)
+            else:
+                job.finish()
+
+    @staticmethod
+    def _record(job, offset):
+        completed = job.advance(offset)
+        if completed is None:
+            return
+        with job.sync_lock:
+            # 其他线程可能已经记录了更大的偏移
+            if completed < job.completed:
+                return
+            # 先保证数据已经写到磁盘上，再记录偏移
+            if hasattr(os, 'fdatasync'):
+                os.fdatasync(job.outfd)
+            else:
+                os.fsync(job.outfd)
+            job.journal.progress(job.target, completed)
+
+    def _copy_chunk(self, job, offset, length):
+        end = offset + length
+        if job.kernel:
+            try:
+                while offset < end:
+                    n = os.copy_file_range(job.infd, job.outfd, end - offset, offset, offset)
+                    if n == 0:
+                        # 原文件被截短，或者文件系统不报错但返回0，交给下面的pread判断
+                        break
+                    offset += n
+                else:
+                    return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                job.kernel = False
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        while offset < end:
+            n = os.preadv(job.infd, [view[:min(len(buf), end - offset)]], offset) if hasattr(os, 'preadv') \
+                else self._pread_into(job.infd, view, min(len(buf), end - offset), offset)
+            if n == 0:
+                raise EOFError('source file truncated')
+            written = 0
+            while written < n:
+                written += os.pwrite(job.outfd, view[written:n], offset + written)
+            offset += n
+
+    @staticmethod
+    def _pread_into(fd, view, length, offset):
+        data = os.pread(fd, length, offset)
+        view[:len(data)] = data
+        return len(data)
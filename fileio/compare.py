@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+from .hasher import BUFFER_SIZE
+from .sparse import is_sparse, data_extents
+
+
+def _read_full(f, buf):
+    """
+    尽量读满buf，返回读到的字节数，只有到文件末尾时才会小于len(buf)
+    """
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+def compare_files(source, target, buffer_size=BUFFER_SIZE):
+    """
+    逐块比较两个文件的内容
+        1. 先比较大小，大小不一样直接返回
+        2. 两个文件同步往后读，遇到第一个不一样的块就返回，不需要读完整个文件
+        3. 两个稀疏文件的数据段位置一样时只比较数据段，空洞都是0不需要读
+    :return: 内容一样返回True，否则返回False
+    """
+    if os.path.getsize(source) != os.path.getsize(target):
+        return False
+    buf1 = bytearray(buffer_size)
+    buf2 = bytearray(buffer_size)
+    with open(source, 'rb', buffering=0) as f1, open(target, 'rb', buffering=0) as f2:
+        extents = _same_extents(f1, f2)
+        if extents is not None:
+            return _compare_extents(f1, f2, extents, buf1, buf2)
+        while True:
+            n1 = _read_full(f1, buf1)
+            n2 = _read_full(f2, buf2)
+            if n1 != n2:
+                return False
+            if n1 == buffer_size:
+                if buf1 != buf2:
+                    return False
+                continue
+            return buf1[:n1] == buf2[:n2]
+
+
+def _same_extents(f1, f2):
+    """
+    :return: 两个文件都是稀疏文件并且数据段一样时返回数据段，否则返回None
+    """
+    st1, st2 = os.fstat(f1.fileno()), os.fstat(f2.fileno())
+    if not is_sparse(st1) or not is_sparse(st2):
+        return None
+    extents = data_extents(f1.fileno(), st1.st_size)
+    if extents is None or extents != data_extents(f2.fileno(), st2.st_size):
+        return None
+    return extents
+
+
+def _compare_extents(f1, f2, extents, buf1, buf2):
+    view1, view2 = memoryview(buf1), memoryview(buf2)
+    for offset, length in extents:
+        f1.seek(offset)
+        f2.seek(offset)
+        while length > 0:
+            size = min(length, len(buf1))
+            n1 = _read_full(f1, view1[:size])
+            n2 = _read_full(f2, view2[:size])
+            if n1 != n2 or view1[:n1] != view2[:n2]:
+                return False
+            if n1 < size:
+                return True
+            length -= n1
+    return True
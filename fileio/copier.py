@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import errno
+import hashlib
+import shutil
+import threading
+from .hasher import BUFFER_SIZE
+from .sparse import is_sparse, data_extents
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 这些错误表示当前的拷贝方式在这对文件系统上不可用，需要换一种方式
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in (
+    'EXDEV', 'EINVAL', 'ENOSYS', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EBADF', 'EPERM') if hasattr(errno, name))
+
+# 拷贝时先写到目标文件夹下的临时文件(.文件名.synctmp)，完成后再原子替换目标
+TMP_SUFFIX = '.synctmp'
+# 大多数文件系统的文件名最多255字节，临时文件名超过时截短文件名并加上摘要
+NAME_MAX = 255
+
+
+def temp_name(name):
+    """
+    :return: 文件名对应的临时文件名，同一个文件名总是同一个临时文件名
+    """
+    tmp = '.' + name + TMP_SUFFIX
+    encoded = os.fsencode(tmp)
+    if len(encoded) <= NAME_MAX:
+        return tmp
+    digest = '~' + hashlib.sha1(os.fsencode(name)).hexdigest()[:16]
+    keep = NAME_MAX - len(os.fsencode('.' + digest + TMP_SUFFIX))
+    prefix = os.fsencode(name)[:keep].decode(sys.getfilesystemencoding(), 'ignore')
+    return '.' + prefix + digest + TMP_SUFFIX
+
+
+def temp_path(target):
+    """
+    :return: 目标对应的临时文件，同一个目标总是同一个临时文件，中断后下次可以覆盖或者续传
+    """
+    head, tail = os.path.split(target)
+    return os.path.join(head, temp_name(tail))
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class CopyUnsupported(Exception):
+    pass
+
+
+class Copier(object):
+    """
+    拷贝引擎，按顺序尝试以下拷贝方式，失败时自动换下一种
+        reflink: 写时复制克隆(Linux FICLONE)，同一个支持的文件系统(btrfs/xfs等)上几乎没有开销
+        sparse: 只用于稀疏文件，通过SEEK_DATA/SEEK_HOLE找到有数据的段，只拷贝数据段，目标保留同样的空洞
+        copy_file_range: 内核里拷贝，数据不经过用户态(Linux)
+        sendfile: 内核里拷贝，数据不经过用户态(Linux)
+        userspace: 使用大缓冲区在用户态拷贝，所有平台都可用
+    某种方式在某对(源设备, 目标设备)上不可用后，就不会再对这对设备尝试
+    数据先写到临时文件，保留修改时间等信息后用os.replace原子替换目标，中断时目标要么是旧文件要么是完整的新文件
+    """
+    STRATEGIES = ('reflink', 'sparse', 'copy_file_range', 'sendfile', 'userspace')
+    FICLONE = 0x40049409
+
+    def __init__(self, strategy='auto', buffer_size=BUFFER_SIZE):
+        if strategy == 'auto':
+            self.strategies = self.STRATEGIES
+        elif strategy in self.STRATEGIES:
+            self.strategies = (strategy, 'userspace') if strategy != 'userspace' else ('userspace',)
+        else:
+            raise ValueError('unsupported copy strategy: {}, support: {}'.format(strategy, self.STRATEGIES))
+        self.buffer_size = buffer_size
+        self.stats = dict((name, 0) for name in self.STRATEGIES)
+        self.bytes = dict((name, 0) for name in self.STRATEGIES)
+        self._unsupported = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def copy(self, source, target, source_stat=None):
+        """
+        拷贝文件内容，并保留修改时间和权限等信息
+        :return: 使用的拷贝方式
+        """
+        if source_stat is None:
+            source_stat = os.stat(source)
+        size = source_stat.st_size
+        tmp = temp_path(target)
+        try:
+            with open(source, 'rb', buffering=0) as fsrc, open(tmp, 'wb', buffering=0) as fdst:
+                key = (source_stat.st_dev, os.fstat(fdst.fileno()).st_dev)
+                extents = data_extents(fsrc.fileno(), size) if is_sparse(source_stat) else None
+                strategy = self._copy_fd(fsrc, fdst, size, key, extents)
+            shutil.copystat(source, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            remove_quietly(tmp)
+            raise
+        return strategy
+
+    def _copy_fd(self, fsrc, fdst, size, key, extents=None):
+        """
+        :param extents: 稀疏文件的数据段，为None时不使用sparse
+        """
+        for name in self.strategies:
+            if (name, key) in self._unsupported or (name == 'sparse' and extents is None):
+                continue
+            try:
+                if name == 'sparse':
+                    self._copy_sparse(fsrc, fdst, size, extents)
+                else:
+                    getattr(self, '_copy_' + name)(fsrc, fdst, size)
+            except CopyUnsupported:
+                pass
+            except OSError as e:
+                if name == 'userspace' or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+            else:
+                with self._lock:
+                    self.stats[name] += 1
+                    self.bytes[name] += size
+                return name
+            with self._lock:
+                self._unsupported.add((name, key))
+            # 换下一种方式之前回到文件开头，丢弃可能已经写入的部分
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        raise OSError(errno.EIO, 'all copy strategies failed')
+
+    def _copy_reflink(self, fsrc, fdst, size):
+        if fcntl is None or not sys.platform.startswith('linux'):
+            raise CopyUnsupported()
+        fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+
+    def _copy_sparse(self, fsrc, fdst, size, extents):
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        kernel = hasattr(os, 'copy_file_range')
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                if kernel:
+                    try:
+                        n = os.copy_file_range(infd, outfd, end - offset, offset, offset)
+                    except OSError as e:
+                        if e.errno not in UNSUPPORTED_ERRNOS:
+                            raise
+                        kernel = False
+                        continue
+                    if n == 0:
+                        kernel = False
+                        continue
+                else:
+                    data = os.pread(infd, min(self.buffer_size, end - offset), offset)
+                    if not data:
+                        raise EOFError('source file truncated')
+                    n = 0
+                    while n < len(data):
+                        n += os.pwrite(outfd, data[n:], offset + n)
+                offset += n
+        # 最后的空洞只需要设置大小
+        os.ftruncate(outfd, size)
+
+    def _copy_copy_file_range(self, fsrc, fdst, size):
+        if not hasattr(os, 'copy_file_range'):
+            raise CopyUnsupported()
+        self._kernel_copy(os.copy_file_range, fsrc, fdst, size)
+
+    def _copy_sendfile(self, fsrc, fdst, size):
+        # 只有Linux的sendfile支持输出到普通文件
+        if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+            raise CopyUnsupported()
+        self._kernel_copy(lambda i, o, n: os.sendfile(o, i, None, n), fsrc, fdst, size)
+
+    def _kernel_copy(self, func, fsrc, fdst, size):
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        # 每次最多拷贝1GiB，避免32位系统上溢出
+        chunk = min(max(size, 1), 1 << 30)
+        copied = 0
+        while True:
+            n = func(infd, outfd, chunk)
+            if n == 0:
+                break
+            copied += n
+        if copied == 0 and size > 0:
+            # 某些文件系统(如procfs、部分网络文件系统)不报错但返回0
+            raise CopyUnsupported()
+
+    def _copy_userspace(self, fsrc, fdst, size):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += fdst.write(view[written:n])
+
+    def summary(self):
+        return ', '.join('{}: {}个/{}字节'.format(name, self.stats[name], self.bytes[name])
+                         for name in self.STRATEGIES if self.stats[name])
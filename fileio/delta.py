@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import zlib
+import shutil
+import hashlib
+from .copier import temp_path, remove_quietly
+
+ADLER_MOD = 65521
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class DeltaCopier(object):
+    """
+    rsync风格的增量拷贝，用于大文件只改动了一小部分的情况
+        1. 把目标文件按块计算弱校验(adler32)和强校验(blake2b)
+        2. 在原文件上用可滚动的adler32查找和目标文件相同的块，得到"复用目标文件的块"和"需要写入的数据"两种操作
+        3. 所有复用的块都在原来的位置时直接在目标文件上改写不同的部分(改写前把目标的修改时间设成0，中断后下次同步会重新比较)，
+           否则通过临时文件重新组装后替换目标文件
+    逐字节滚动是纯Python实现，比较慢，所以先检查对齐的位置，并限制滚动的总字节数(ROLL_BUDGET)，
+    超过后只做对齐的块比较
+    """
+    BLOCK_SIZE = 128 * 1024
+    MAX_BLOCKS = 1 << 18
+    ROLL_BUDGET = 8 * 1024 * 1024
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+
+    def _block_size(self, size):
+        # 文件太大时增大块，避免签名表太大
+        block_size = self.block_size
+        while size // block_size > self.MAX_BLOCKS:
+            block_size *= 2
+        return block_size
+
+    @staticmethod
+    def signature(path, block_size):
+        """
+        :return: {弱校验: {强校验: 块偏移}}
+        """
+        table = {}
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if len(block) < block_size:
+                    # 最后不满一块的数据不参与匹配
+                    break
+                table.setdefault(zlib.adler32(block), {}).setdefault(_strong(block), offset)
+                offset += block_size
+        return table
+
+    def diff(self, source, table, block_size, size):
+        """
+        :return: 操作列表，按在新文件中的位置排序
+            ('copy', 目标文件偏移, 长度): 复用目标文件的数据
+            ('data', 原文件偏移, 长度): 写入原文件的数据
+        """
+        ops = []
+
+        def _emit(op, offset, length):
+            if length <= 0:
+                return
+            if ops and ops[-1][0] == op and ops[-1][1] + ops[-1][2] == offset:
+                ops[-1] = (op, ops[-1][1], ops[-1][2] + length)
+            else:
+                ops.append((op, offset, length))
+
+        def _match(block, weak):
+            strongs = table.get(weak)
+            if strongs is None:
+                return None
+            return strongs.get(_strong(block))
+
+        budget = self.ROLL_BUDGET
+        with open(source, 'rb') as f:
+            window = _Window(f, block_size)
+            p = 0
+            literal = 0
+            while p + block_size <= size:
+                block = window.get(p, block_size)
+                offset = _match(block, zlib.adler32(block))
+                if offset is not None:
+                    _emit('data', literal, p - literal)
+                    _emit('copy', offset, block_size)
+                    p += block_size
+                    literal = p
+                    continue
+                if budget <= 0 or p + 2 * block_size > size:
+                    p += block_size
+                    continue
+                # 下一个对齐的块匹配时说明只是原地修改，不需要滚动
+                nxt = window.get(p + block_size, block_size)
+                offset = _match(nxt, zlib.adler32(nxt))
+                if offset is not None:
+                    _emit('data', literal, p + block_size - literal)
+                    _emit('copy', offset, block_size)
+                    p += 2 * block_size
+                    literal = p
+                    continue
+                # 逐字节滚动查找偏移后的匹配(有插入或删除的情况)
+                rolling = window.get(p, 2 * block_size)
+                weak = zlib.adler32(rolling[:block_size])
+                a, b = weak & 0xffff, weak >> 16
+                found = None
+                for i in range(block_size):
+                    out_byte, in_byte = rolling[i], rolling[i + block_size]
+                    a = (a - out_byte + in_byte) % ADLER_MOD
+                    b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                    strongs = table.get((b << 16) | a)
+                    if strongs is not None:
+                        offset = strongs.get(_strong(rolling[i + 1:i + 1 + block_size]))
+                        if offset is not None:
+                            found = (p + i + 1, offset)
+                            break
+                budget -= block_size if found is None else found[0] - p
+                if found is None:
+                    p += block_size
+                    continue
+                p, offset = found
+                _emit('data', literal, p - literal)
+                _emit('copy', offset, block_size)
+                p += block_size
+                literal = p
+            _emit('data', literal, size - literal)
+        return ops
+
+    def copy(self, source, target, source_stat=None):
+        """
+        :return: 实际写入目标文件的字节数
+        """
+        if source_stat is None:
+            source_stat = os.stat(source)
+        size = source_stat.st_size
+        block_size = self._block_size(size)
+        table = self.signature(target, block_size)
+        ops = self.diff(source, table, block_size, size)
+        written = sum(op[2] for op in ops if op[0] == 'data')
+
+        pos = 0
+        in_place = True
+        for op, offset, length in ops:
+            if op == 'copy' and offset != pos:
+                in_place = False
+                break
+            pos += length
+        if in_place:
+            # 改写过程中被中断时目标只改了一部分，先把修改时间设成0，下次同步时不会被当成没有变化
+            os.utime(target, ns=(0, 0))
+            with open(source, 'rb') as fsrc, open(target, 'r+b') as fdst:
+                pos = 0
+                for op, offset, length in ops:
+                    if op == 'data':
+                        fsrc.seek(offset)
+                        fdst.seek(pos)
+                        _copy_range(fsrc, fdst, length)
+                    pos += length
+                fdst.truncate(size)
+        else:
+            tmp = temp_path(target)
+            try:
+                with open(source, 'rb') as fsrc, open(target, 'rb') as fold, open(tmp, 'wb') as fdst:
+                    for op, offset, length in ops:
+                        f = fsrc if op == 'data' else fold
+                        f.seek(offset)
+                        _copy_range(f, fdst, length)
+                os.replace(tmp, target)
+            except BaseException:
+                remove_quietly(tmp)
+                raise
+        shutil.copystat(source, target)
+        return written
+
+
+def _copy_range(fsrc, fdst, length, buffer_size=1024 * 1024):
+    while length > 0:
+        data = fsrc.read(min(length, buffer_size))
+        if not data:
+            break
+        fdst.write(data)
+        length -= len(data)
+
+
+class _Window(object):
+    """
+    原文件的滑动读取窗口，只缓存当前位置附近的数据
+    """
+    def __init__(self, f, block_size):
+        self.f = f
+        self.capacity = 8 * block_size
+        self.start = 0
+        self.data = b''
+
+    def get(self, offset, length):
+        end = offset + length
+        if offset < self.start or end > self.start + len(self.data):
+            self.f.seek(offset)
+            self.data = self.f.read(max(length, self.capacity))
+            self.start = offset
+        return self.data[offset - self.start:end - self.start]
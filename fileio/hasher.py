@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import zlib
+import hashlib
+from .sparse import is_sparse, data_extents, iter_regions
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 读文件的缓冲区大小
+BUFFER_SIZE = 1024 * 1024
+
+
+class Checksum(object):
+    """
+    把zlib.crc32/zlib.adler32包装成和hashlib一样的接口
+    """
+    def __init__(self, func, value):
+        self._func = func
+        self._value = value
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self._value & 0xffffffff)
+
+
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+    'crc32': lambda: Checksum(zlib.crc32, 0),
+    'adler32': lambda: Checksum(zlib.adler32, 1),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+
+
+def new_hash(algo='md5'):
+    if algo not in HASH_ALGORITHMS:
+        raise ValueError('unsupported hash algorithm: {}, support: {}'.format(algo, list(HASH_ALGORITHMS)))
+    return HASH_ALGORITHMS[algo]()
+
+
+def file_digest(file_path, algo='md5', buffer_size=BUFFER_SIZE):
+    """
+    计算文件的摘要
+    稀疏文件只读有数据的段，空洞直接按0计算，摘要和逐块读取的一样
+    :param algo: 摘要算法，见HASH_ALGORITHMS，crc32/adler32/xxh64不是加密摘要但速度快很多
+    :return: 十六进制的摘要
+    """
+    file_hash = new_hash(algo)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(file_path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        extents = data_extents(f.fileno(), st.st_size) if is_sparse(st) else None
+        if extents is not None:
+            _sparse_update(file_hash, f, extents, st.st_size, view)
+            return file_hash.hexdigest()
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            file_hash.update(view[:n])
+    return file_hash.hexdigest()
+
+
+def _sparse_update(file_hash, f, extents, size, view):
+    zeros = bytes(len(view))
+    for offset, length, is_data in iter_regions(extents, size):
+        if not is_data:
+            while length > 0:
+                n = min(length, len(zeros))
+                file_hash.update(zeros[:n] if n < len(zeros) else zeros)
+                length -= n
+            continue
+        f.seek(offset)
+        while length > 0:
+            n = f.readinto(view[:min(length, len(view))])
+            if not n:
+                # 文件被截短
+                return
+            file_hash.update(view[:n])
+            length -= n
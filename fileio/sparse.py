@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import errno
+
+# 占用的空间比大小至少少这么多字节时才认为是稀疏文件，避免对小文件(内联数据、压缩的文件系统)多做lseek
+SPARSE_MIN_HOLE = 1024 * 1024
+
+# 遍历数据段时遇到这些错误说明文件系统不支持SEEK_DATA/SEEK_HOLE
+_UNSUPPORTED = set(getattr(errno, name) for name in ('EINVAL', 'ENOTSUP', 'EOPNOTSUPP', 'ENOSYS')
+                   if hasattr(errno, name))
+
+
+def is_sparse(st):
+    """
+    根据stat判断文件是否可能有空洞(st_blocks是按512字节计算的占用空间)
+    """
+    if not hasattr(os, 'SEEK_DATA') or not hasattr(st, 'st_blocks'):
+        return False
+    return st.st_blocks * 512 + SPARSE_MIN_HOLE <= st.st_size
+
+
+def data_extents(fd, size):
+    """
+    用SEEK_DATA/SEEK_HOLE列出文件里有数据的段，空洞不占空间，读出来都是0
+    :return: [(偏移, 长度)]，不支持或者没有空洞时返回None
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # 后面都是空洞
+                break
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return None
+        raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    if extents == [(0, size)]:
+        return None
+    return extents
+
+
+def iter_regions(extents, size):
+    """
+    按顺序列出数据段和空洞
+    :return: 生成(偏移, 长度, 是否是数据)
+    """
+    offset = 0
+    for start, length in extents:
+        if start > offset:
+            yield offset, start - offset, False
+        yield start, length, True
+        offset = start + length
+    if offset < size:
+        yield offset, size - offset, False
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import shutil
+import threading
+from .hasher import BUFFER_SIZE
+from .copier import temp_path, remove_quietly
+from .sparse import is_sparse, data_extents, iter_regions
+
+
+class TeeCopier(object):
+    """
+    一个文件拷贝到多个目标，原文件只读一次
+        1. 每读一块就依次写到所有目标，原文件的读取量和目标数量无关
+        2. 某个目标写入失败时只放弃这个目标，其他目标继续
+        3. 稀疏文件只读写数据段，目标保留同样的空洞
+        4. 每个目标先写到自己的临时文件，全部写完后保留修改时间和权限等信息，再原子替换目标
+    """
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def copy(self, source, targets, source_stat=None):
+        """
+        :return: {目标: 异常}，全部成功时为空
+        """
+        if source_stat is None:
+            source_stat = os.stat(source)
+        errors = {}
+        outputs = []
+        for target in targets:
+            try:
+                outputs.append((target, open(temp_path(target), 'wb', buffering=0)))
+            except OSError as e:
+                errors[target] = e
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        size = source_stat.st_size
+        try:
+            with open(source, 'rb', buffering=0) as fsrc:
+                extents = data_extents(fsrc.fileno(), size) if is_sparse(source_stat) else None
+                if extents is None:
+                    self._tee(fsrc, outputs, errors, view)
+                else:
+                    for offset, length, is_data in iter_regions(extents, size):
+                        if is_data:
+                            fsrc.seek(offset)
+                            self._tee(fsrc, outputs, errors, view, length)
+                        else:
+                            for _, fdst in outputs:
+                                fdst.seek(offset + length)
+                    for target, fdst in list(outputs):
+                        # 最后的空洞只需要设置大小
+                        try:
+                            os.ftruncate(fdst.fileno(), size)
+                        except OSError as e:
+                            self._drop(outputs, errors, target, fdst, e)
+        except OSError as e:
+            # 原文件读取失败时所有目标都失败
+            for target, _ in outputs:
+                errors[target] = e
+        finally:
+            for _, fdst in outputs:
+                fdst.close()
+        for target, _ in outputs:
+            tmp = temp_path(target)
+            if target in errors:
+                remove_quietly(tmp)
+                continue
+            try:
+                shutil.copystat(source, tmp)
+                os.replace(tmp, target)
+            except OSError as e:
+                errors[target] = e
+                remove_quietly(tmp)
+                continue
+            with self._lock:
+                self.count += 1
+                self.bytes += source_stat.st_size
+        return errors
+
+    def _tee(self, fsrc, outputs, errors, view, length=None):
+        """
+        从原文件的当前位置读length个字节(为None时读到文件末尾)，写到所有目标
+        """
+        while outputs and (length is None or length > 0):
+            n = fsrc.readinto(view if length is None else view[:min(length, len(view))])
+            if not n:
+                break
+            if length is not None:
+                length -= n
+            for target, fdst in list(outputs):
+                try:
+                    written = 0
+                    while written < n:
+                        written += fdst.write(view[written:n])
+                except OSError as e:
+                    self._drop(outputs, errors, target, fdst, e)
+
+    @staticmethod
+    def _drop(outputs, errors, target, fdst, e):
+        errors[target] = e
+        outputs.remove((target, fdst))
+        fdst.close()
+        remove_quietly(temp_path(target))
@@ -0,0 +1 @@
+from .metrics import Histogram, Stage, Gauge, Metrics, Progress
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import sys
+import json
+import time
+import logging
+import threading
+
+
+class Histogram(object):
+    """
+    延迟直方图，第i个桶统计[2^(i-1), 2^i)微秒的次数，内存占用固定
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.counts[min(us.bit_length(), self.BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        """
+        :return: 第p百分位所在桶的上限(秒)
+        """
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        rank = total * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return (1 << i) / 1e6
+        return (1 << (self.BUCKETS - 1)) / 1e6
+
+    def to_dict(self):
+        return {
+            'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+            # 桶的上限(微秒): 次数
+            'buckets': dict((str(1 << i), count) for i, count in enumerate(self.counts) if count),
+        }
+
+
+class Stage(object):
+    """
+    一个阶段的统计: 次数、失败次数、条目数、字节数、总耗时和延迟直方图
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = Histogram()
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, items=1, nbytes=0, error=False):
+        with self._lock:
+            self.count += 1
+            self.items += items
+            self.bytes += nbytes
+            self.seconds += seconds
+            if seconds > self.max_seconds:
+                self.max_seconds = seconds
+            if error:
+                self.errors += 1
+            self.histogram.add(seconds)
+
+    def to_dict(self):
+        with self._lock:
+            result = {
+                'count': self.count, 'errors': self.errors, 'items': self.items, 'bytes': self.bytes,
+                'seconds': self.seconds, 'max_seconds': self.max_seconds,
+                'avg_seconds': self.seconds / self.count if self.count else 0.0,
+            }
+            result.update(self.histogram.to_dict())
+        return result
+
+
+class _Timer(object):
+    __slots__ = ('stage', 'items', 'nbytes', 'start')
+
+    def __init__(self, stage, items, nbytes):
+        self.stage = stage
+        self.items = items
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stage.observe(time.perf_counter() - self.start, self.items, self.nbytes, exc_type is not None)
+        return False
+
+
+class Gauge(object):
+    """
+    定时采样的值(比如队列长度)，记录最后一次、最大值和平均值
+    """
+    def __init__(self, func):
+        self.func = func
+        self.last = 0
+        self.max = 0
+        self.total = 0
+        self.samples = 0
+
+    def sample(self):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        self.last = value
+        self.max = max(self.max, value)
+        self.total += value
+        self.samples += 1
+
+    def to_dict(self):
+        return {'last': self.last, 'max': self.max, 'avg': self.total / self.samples if self.samples else 0}
+
+
+class Metrics(object):
+    """
+    同步过程的统计
+        1. 各阶段(scan: 列出文件夹, rule: 匹配忽略规则, compare: 比较文件, hash: 计算摘要, copy: 拷贝)
+           的次数、字节数和延迟直方图，用time(stage)计时
+        2. 计数器(counter)，比如遍历到的文件数、需要拷贝的字节数
+        3. 队列长度等通过add_gauge注册，由sample定时采样
+        4. to_dict/save输出JSON报告，可以用来判断慢在哪个阶段和对比不同版本
+    """
+    STAGES = ('scan', 'rule', 'compare', 'hash', 'copy')
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.stages = dict((name, Stage(name)) for name in self.STAGES)
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def time(self, stage, items=1, nbytes=0):
+        return _Timer(self.stages[stage], items, nbytes)
+
+    def observe(self, stage, seconds, items=1, nbytes=0, error=False):
+        self.stages[stage].observe(seconds, items, nbytes, error)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def add_gauge(self, name, func):
+        self.gauges[name] = Gauge(func)
+
+    def sample(self):
+        for gauge in list(self.gauges.values()):
+            gauge.sample()
+
+    def finish(self):
+        self.sample()
+        self.end_time = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def to_dict(self):
+        return {
+            'start_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time)),
+            'elapsed': self.elapsed,
+            'stages': dict((name, stage.to_dict()) for name, stage in self.stages.items()),
+            'counters': dict(self.counters),
+            'gauges': dict((name, gauge.to_dict()) for name, gauge in self.gauges.items()),
+        }
+
+    def save(self, path, **extra):
+        data = self.to_dict()
+        data.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+class Progress(threading.Thread):
+    """
+    每interval秒采样一次并输出进度: 遍历数量、拷贝速度、等待拷贝的数量和预计剩余时间
+    预计剩余时间 = 还没决定(只根据stat跳过或者比较完)的文件数/决定速度 + 还没拷贝的字节数/拷贝速度，遍历还没结束时只是下限
+    """
+    def __init__(self, metrics, interval=2.0, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.metrics = metrics
+        self.interval = interval
+        self.scanning = True
+        self._stop_event = threading.Event()
+        self._last = (time.time(), 0)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.metrics.sample()
+            self.logger.info('[进度] {}'.format(self.line()))
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def line(self):
+        metrics = self.metrics
+        compare, copy = metrics.stages['compare'], metrics.stages['copy']
+        now = time.time()
+        last_time, last_bytes = self._last
+        self._last = (now, copy.bytes)
+        rate = (copy.bytes - last_bytes) / max(now - last_time, 1e-6)
+        elapsed = max(metrics.elapsed, 1e-6)
+        files = metrics.get('files')
+        decided = metrics.get('decided')
+        copy_bytes = metrics.get('copy_bytes')
+        eta = 0.0
+        if decided and files > decided:
+            eta += (files - decided) / (decided / elapsed)
+        if copy.bytes and copy_bytes > copy.bytes:
+            eta += (copy_bytes - copy.bytes) / (copy.bytes / elapsed)
+        queues = ', '.join('{}: {}'.format(name, gauge.last) for name, gauge in metrics.gauges.items())
+        return '遍历{}: {}个文件夹/{}个文件, 比较: {}, 拷贝: {}个/{:.1f}MiB, {:.1f}MB/s, 队列({}), 预计剩余: {}{:.0f}秒'.format(
+            '中' if self.scanning else '完成', metrics.stages['scan'].count, files, compare.count, copy.count,
+            copy.bytes / 1048576.0, rate / 1e6, queues, '>' if self.scanning else '', eta)
@@ -0,0 +1 @@
+from .plan import Action, Plan, Planner, Executor
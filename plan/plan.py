@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import json
+import stat
+import time
+import logging
+import threading
+from rule.rule import Rule, DirMatcher
+from walker import Walker, ExtraEntry
+
+
+class Action(object):
+    """
+    同步计划里的一个动作
+        op: mkdir/copy/update/delete
+        source: 原文件路径，mkdir和delete为None
+        target: 目标路径
+        size: 涉及的字节数
+    """
+    __slots__ = ('op', 'source', 'target', 'size')
+
+    def __init__(self, op, source, target, size=0):
+        self.op = op
+        self.source = source
+        self.target = target
+        self.size = size
+
+    def to_list(self):
+        return [self.op, self.source, self.target, self.size]
+
+
+class Plan(object):
+    """
+    同步计划，可以保存成json文件，之后再加载执行
+        1. skip只统计数量和字节数，不保存具体的动作，计划的大小只和需要做的事情有关
+        2. totals: {动作: [数量, 字节数]}
+    """
+    OPS = ('mkdir', 'copy', 'update', 'delete', 'skip')
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.created = time.time()
+        self.actions = []
+        self.totals = dict((op, [0, 0]) for op in self.OPS)
+        self._lock = threading.Lock()
+
+    def add(self, op, source, target, size=0):
+        with self._lock:
+            self.totals[op][0] += 1
+            self.totals[op][1] += size
+            if op != 'skip':
+                self.actions.append(Action(op, source, target, size))
+
+    def summary(self):
+        return ', '.join('{}: {}个/{}字节'.format(op, count, size) for op, (count, size) in self.totals.items())
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'source': self.source,
+                'target': self.target,
+                'created': self.created,
+                'totals': self.totals,
+                'actions': [action.to_list() for action in self.actions]
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        plan = cls(data['source'], data['target'])
+        plan.created = data.get('created', plan.created)
+        plan.totals = dict((op, list(data['totals'].get(op, [0, 0]))) for op in cls.OPS)
+        plan.actions = [Action(*item) for item in data['actions']]
+        return plan
+
+
+class Planner(object):
+    """
+    只遍历和比较，不修改目标，生成同步计划
+        1. 比较方式和SyncTool一致，有线程池时在线程池里比较
+        2. 镜像模式下目标多出来的文件夹会展开成每个文件的delete(跳过被忽略的内容)，文件夹本身也是delete，执行时为空才删除
+    """
+    def __init__(self, sync_tool, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+
+    def _plan_delete(self, plan, path, is_dir, matcher):
+        if is_dir and os.path.islink(path):
+            # 指向文件夹的符号链接只删除链接本身
+            is_dir = False
+        if not is_dir:
+            try:
+                size = os.lstat(path).st_size
+            except OSError:
+                size = 0
+            plan.add('delete', None, path, size)
+            return
+        dirs = []
+        stack = [(path, matcher)]
+        while stack:
+            dir_path, dir_matcher = stack.pop()
+            dirs.append(dir_path)
+            with os.scandir(dir_path) as it:
+                for item in it:
+                    if dir_matcher.check(item.name):
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append((item.path, dir_matcher.child(item.name)))
+                    else:
+                        plan.add('delete', None, item.path, item.stat(follow_symlinks=False).st_size)
+        for dir_path in reversed(dirs):
+            plan.add('delete', None, dir_path)
+
+    def _plan_file(self, plan, entry):
+        if entry.target_stat is None:
+            plan.add('copy', entry.source, entry.target, entry.source_stat.st_size)
+        elif self.sync_tool.check_file_is_change(entry.source, entry.target, entry.source_stat, entry.target_stat,
+                                                 touch=False):
+            plan.add('update', entry.source, entry.target, entry.source_stat.st_size)
+        else:
+            plan.add('skip', entry.source, entry.target, entry.source_stat.st_size)
+
+    def build(self, source, target):
+        plan = Plan(os.path.abspath(source), os.path.abspath(target))
+        rule = Rule(source, logger=self.logger)
+        walker = Walker(rule, logger=self.logger, mirror=self.sync_tool.mirror)
+        pool = self.sync_tool.pool
+        for entry in walker.walk(source, target):
+            if isinstance(entry, ExtraEntry):
+                for path, is_dir in entry.items:
+                    self._plan_delete(plan, path, is_dir, entry.matcher.child(os.path.basename(path)))
+                continue
+            if entry.target_stat is not None and stat.S_ISDIR(entry.target_stat.st_mode) != entry.is_dir:
+                if not self.sync_tool.mirror:
+                    self.logger.error('[类型冲突] 目标已存在: {}'.format(entry.target))
+                    if entry.is_dir:
+                        # 不再遍历这个文件夹
+                        entry.matcher = DirMatcher(rule, None, ignore_all=True)
+                    continue
+                self._plan_delete(plan, entry.target, stat.S_ISDIR(entry.target_stat.st_mode),
+                                  rule.dir_matcher(entry.source))
+                entry.target_stat = None
+            if entry.is_dir:
+                if entry.target_stat is None:
+                    plan.add('mkdir', None, entry.target)
+            elif entry.target_stat is None or pool is None:
+                self._plan_file(plan, entry)
+            else:
+                pool.add_task(self._plan_file, plan, entry)
+        if pool is not None:
+            pool.wait()
+        return plan
+
+
+class Executor(object):
+    """
+    执行同步计划
+        1. 先执行delete(文件夹在里面的文件之后，不为空时保留)，再按路径顺序执行mkdir
+        2. 计划文件可能被修改过，目标不在计划的target下、原文件不在计划的source下的动作不执行
+        3. copy和update按order排序后交给线程池
+            size: 大文件优先，避免最后只剩一个大文件在拷贝
+            dir: 按目标路径排序，同一个文件夹的文件放在一起
+            none: 按计划里的顺序
+    """
+    ORDERS = ('size', 'dir', 'none')
+
+    def __init__(self, sync_tool, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+
+    @staticmethod
+    def _is_under(path, root):
+        """
+        path(不解析最后一级的符号链接，删除和替换都不会跟随它)是否在root下
+        """
+        root = os.path.realpath(root)
+        path = os.path.join(os.path.realpath(os.path.dirname(os.path.abspath(path))), os.path.basename(path))
+        return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+    def _check(self, plan, action):
+        if action.op not in Plan.OPS or not action.target or not self._is_under(action.target, plan.target) or (
+                action.op in ('copy', 'update') and not (action.source and self._is_under(action.source, plan.source))):
+            self.logger.error('[计划越界] 忽略: {} {} {}'.format(action.op, action.source, action.target))
+            return False
+        return True
+
+    def _delete(self, action):
+        try:
+            if os.path.isdir(action.target) and not os.path.islink(action.target):
+                os.rmdir(action.target)
+            else:
+                os.unlink(action.target)
+                self.sync_tool.delete_count += 1
+            self.logger.info('[删除] %s', action.target)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.debug('[删除失败] %s, %s', action.target, e)
+
+    def _copy(self, action):
+        try:
+            source_stat = os.stat(action.source)
+        except OSError:
+            self.logger.warning('[原文件不存在] {}'.format(action.source))
+            return 0
+        try:
+            target_stat = os.stat(action.target)
+        except OSError:
+            target_stat = None
+        return self.sync_tool.copy_file(action.source, action.target, source_stat, target_stat)
+
+    def execute(self, plan, order='size'):
+        """
+        :return: 拷贝的文件数
+        """
+        if order not in self.ORDERS:
+            self.logger.warning('[执行顺序] 不支持{}, 使用size'.format(order))
+            order = 'size'
+        actions = [action for action in plan.actions if self._check(plan, action)]
+        deletes = [action for action in actions if action.op == 'delete']
+        mkdirs = sorted((action for action in actions if action.op == 'mkdir'), key=lambda action: action.target)
+        copies = [action for action in actions if action.op in ('copy', 'update')]
+        if order == 'size':
+            copies.sort(key=lambda action: action.size, reverse=True)
+        elif order == 'dir':
+            copies.sort(key=lambda action: action.target)
+        metrics = self.sync_tool.metrics
+        if metrics is not None:
+            # 计划里的动作都已经决定好了，剩余时间只和还没拷贝的字节数有关
+            metrics.incr('files', len(copies))
+            metrics.incr('decided', len(copies))
+            metrics.incr('copy_bytes', sum(action.size for action in copies))
+
+        for action in deletes:
+            self._delete(action)
+        for action in mkdirs:
+            os.makedirs(action.target, exist_ok=True)
+            self.logger.info('[创建文件夹] %s', action.target)
+        pool = self.sync_tool.pool
+        count = 0
+        for action in copies:
+            if pool is not None:
+                pool.add_task(self._copy, action)
+            else:
+                try:
+                    count += self._copy(action)
+                except Exception as e:
+                    self.logger.error('[拷贝失败] {}, {}'.format(action.source, e))
+        if pool is not None:
+            count = pool.wait_all_task_done()
+        return count
@@ -8,9 +8,89 @@
 # Author: Vinman <vinman.cub@gmail.com>
 
 import os
+import re
 import sys
+import hashlib
 import logging
 
+# 忽略规则文件名，工作目录下的是全局规则，原文件夹里每个文件夹下的只对该文件夹生效
+IGNORE_FILE = '.syncignore'
+RULE_SETS = ('ignore_equals', 'ignore_startswith', 'ignore_endswith', 'ignore_contains',
+             'ignore_abs_startswith', 'ignore_abs_equals', 'include_abs_startswith', 'include_abs_equals')
+
+
+class PathNode(object):
+    """
+    绝对路径规则的前缀树节点，按路径的每一级分开存储
+        children: 下一级的节点
+        include_equals/ignore_equals: 绝对路径等于"当前节点路径/名字"的规则的名字
+        include_prefixes/ignore_prefixes: 绝对路径以"当前节点路径/名字前缀"开头的规则的名字前缀
+    """
+    __slots__ = ('children', 'include_equals', 'ignore_equals', 'include_prefixes', 'ignore_prefixes')
+
+    def __init__(self):
+        self.children = {}
+        self.include_equals = set()
+        self.ignore_equals = set()
+        self.include_prefixes = ()
+        self.ignore_prefixes = ()
+
+
+class DirMatcher(object):
+    """
+    某个文件夹下的匹配器，判断文件夹下的条目是否被忽略
+        1. 文件夹的路径只在创建时解析一次，子条目只需要按名字匹配
+        2. include_all为True时整个子树都不忽略，不再逐个匹配
+        3. 通过child得到子文件夹的匹配器，遍历时跟着文件夹往下传
+    """
+    __slots__ = ('rule', 'node', 'include_all', 'ignore_all')
+
+    def __init__(self, rule, node, include_all=False, ignore_all=False):
+        self.rule = rule
+        self.node = node
+        self.include_all = include_all
+        self.ignore_all = ignore_all
+
+    def check(self, name):
+        if self.include_all:
+            return False
+        node = self.node
+        if node is not None:
+            if name in node.include_equals or name.startswith(node.include_prefixes):
+                return False
+            if name in node.ignore_equals or name.startswith(node.ignore_prefixes):
+                return True
+        if self.ignore_all:
+            return True
+        return self.rule.check_name(name)
+
+    @property
+    def fingerprint(self):
+        """
+        匹配结果只和规则、路径有关，同一个文件夹的指纹一致时忽略的条目也一致
+        """
+        return '{}{:d}{:d}'.format(self.rule.fingerprint, self.include_all, self.ignore_all)
+
+    def extend(self, dir_path, rule_file):
+        """
+        文件夹下有规则文件时，在当前规则的基础上加上该文件的规则，得到新的匹配器
+        新的规则只编译一次，通过child传给所有子文件夹
+        整个子树都被忽略时(ignore_all)，新的规则不能让里面的条目重新生效
+        """
+        if self.ignore_all and self.node is None:
+            return self
+        matcher = self.rule.extend(dir_path, rule_file).dir_matcher(dir_path)
+        matcher.ignore_all = matcher.ignore_all or self.ignore_all
+        return matcher
+
+    def child(self, name):
+        node = self.node
+        if node is None:
+            return DirMatcher(self.rule, None, self.include_all, self.ignore_all)
+        return DirMatcher(self.rule, node.children.get(name),
+                          self.include_all or name.startswith(node.include_prefixes),
+                          self.ignore_all or name.startswith(node.ignore_prefixes))
+
 
 class Rule(object):
     def __init__(self, root, **kwargs):
@@ -35,20 +115,130 @@ class Rule(object):
 
         self.include_abs_startswith = set()  # 包含以xxx开头的
         self.include_abs_equals = set()  # 包含绝对路径等于xxx的
+
+        self._name_regex = None
+        self._fingerprint = None
+        self._trie = PathNode()
+        self._matchers = {}
         try:
             if self.root and os.path.exists(self.root):
                 self.read_ignore_config()
         except Exception as e:
-            logger.error(e)
+            self.logger.error(e)
+        self.compile()
+
+    def compile(self):
+        """
+        把规则编译成匹配器
+            1. 名字开头、结尾、包含的规则合并成一个正则表达式，名字等于的规则用集合
+            2. 绝对路径的规则按路径的每一级放到前缀树里
+        """
+        patterns = []
+        if self.ignore_startswith:
+            patterns.append('^(?:{})'.format('|'.join(map(re.escape, sorted(self.ignore_startswith)))))
+        if self.ignore_endswith:
+            patterns.append('(?:{})\\Z'.format('|'.join(map(re.escape, sorted(self.ignore_endswith)))))
+        if self.ignore_contains:
+            patterns.append('(?:{})'.format('|'.join(map(re.escape, sorted(self.ignore_contains)))))
+        self._name_regex = re.compile('|'.join(patterns), re.DOTALL).search if patterns else None
+
+        self._trie = PathNode()
+        for paths, attr in ((self.include_abs_equals, 'include_equals'), (self.ignore_abs_equals, 'ignore_equals')):
+            for path in paths:
+                node, name = self._trie_parent(path)
+                getattr(node, attr).add(name)
+        for paths, attr in ((self.include_abs_startswith, 'include_prefixes'),
+                            (self.ignore_abs_startswith, 'ignore_prefixes')):
+            for path in paths:
+                node, name = self._trie_parent(path)
+                setattr(node, attr, getattr(node, attr) + (name,))
+        self._matchers = {}
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """
+        规则内容的摘要，规则一样时摘要一样
+        """
+        if self._fingerprint is None:
+            md5 = hashlib.md5()
+            for attr in RULE_SETS:
+                md5.update(repr(sorted(getattr(self, attr))).encode('utf-8'))
+            self._fingerprint = md5.hexdigest()
+        return self._fingerprint
+
+    def extend(self, dir_path, rule_file):
+        """
+        复制当前的规则，再加上rule_file里的规则(以/开头的规则相对于dir_path)
+        :return: 新的规则，已编译
+        """
+        rule = Rule(None, logger=self.logger)
+        for attr in RULE_SETS:
+            setattr(rule, attr, set(getattr(self, attr)))
+        rule.root = dir_path
+        try:
+            rule.read_ignore_config(rule_file)
+        except Exception as e:
+            self.logger.error('[读取规则失败] {}, {}'.format(rule_file, e))
+        rule.compile()
+        return rule
 
-    def read_ignore_config(self):
-        path = os.path.join(os.getcwd(), '.syncignore') if hasattr(sys, 'frozen') \
-            else os.path.join(os.getcwd(), 'spec', 'dist', '.syncignore')
+    def _trie_parent(self, path):
+        parts = path.split(os.sep)
+        node = self._trie
+        for part in parts[:-1]:
+            node = node.children.setdefault(part, PathNode())
+        return node, parts[-1]
+
+    def dir_matcher(self, path):
+        """
+        得到文件夹path的匹配器
+        :param path: 文件夹的绝对路径
+        """
+        node = self._trie
+        include_all = ignore_all = False
+        for part in os.path.abspath(path).rstrip(os.sep).split(os.sep):
+            if node is None:
+                break
+            include_all = include_all or part.startswith(node.include_prefixes)
+            ignore_all = ignore_all or part.startswith(node.ignore_prefixes)
+            node = node.children.get(part)
+        return DirMatcher(self, node, include_all, ignore_all)
+
+    def check_name(self, name):
+        if name in self.ignore_equals:
+            return True
+        return self._name_regex is not None and self._name_regex(name) is not None
+
+    def read_ignore_config(self, path=None):
+        """
+        读取忽略规则文件
+        :param path: 规则文件路径，默认为工作目录下的.syncignore
+        """
+        if path is None:
+            path = os.path.join(os.getcwd(), IGNORE_FILE) if hasattr(sys, 'frozen') \
+                else os.path.join(os.getcwd(), 'spec', 'dist', IGNORE_FILE)
         if not os.path.exists(path):
             return
         with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            self.parse(f.readlines())
+
+        self.logger.debug('=' * 60)
+        self.logger.debug('规则文件: {}'.format(path))
+        self.logger.debug('忽略名字开头: {}'.format(self.ignore_startswith))
+        self.logger.debug('忽略名字结尾: {}'.format(self.ignore_endswith))
+        self.logger.debug('忽略名字包含: {}'.format(self.ignore_contains))
+        self.logger.debug('忽略名字等于: {}'.format(self.ignore_equals))
+        self.logger.debug('忽略绝对路径开头: {}'.format(self.ignore_abs_startswith))
+        self.logger.debug('忽略绝对路径等于: {}'.format(self.ignore_abs_equals))
+        self.logger.debug('包含绝对路径开头: {}'.format(self.include_abs_startswith))
+        self.logger.debug('包含绝对路径等于: {}'.format(self.include_abs_equals))
 
+    def parse(self, lines):
+        """
+        解析规则，以/开头的规则相对于self.root
+        规则里的路径不需要存在，不存在的路径不会匹配到任何条目
+        """
         for line in lines:
             line = line.strip()
             if not line or line.startswith('#'):
@@ -66,20 +256,16 @@ class Rule(object):
                         line = line[1:]
                         if not line:
                             continue
-                        p = os.path.abspath(os.path.join(self.root, line))
-                        if os.path.exists(p):
-                            self.include_abs_startswith.add(p)
-                    if os.path.exists(line) and os.path.isabs(line):
+                        self.include_abs_startswith.add(os.path.abspath(os.path.join(self.root, line)))
+                    elif os.path.isabs(line):
                         self.include_abs_startswith.add(os.path.abspath(line))
                 else:
                     if line.startswith('/'):
                         line = line[1:]
                         if not line:
                             continue
-                        p = os.path.abspath(os.path.join(self.root, line))
-                        if os.path.exists(p):
-                            self.include_abs_equals.add(p)
-                    elif os.path.exists(line) and os.path.isabs(line):
+                        self.include_abs_equals.add(os.path.abspath(os.path.join(self.root, line)))
+                    elif os.path.isabs(line):
                         self.include_abs_equals.add(os.path.abspath(line))
             else:
                 # 忽略的规则
@@ -103,10 +289,8 @@ class Rule(object):
                             line = line[1:]
                             if not line:
                                 continue
-                            p = os.path.abspath(os.path.join(self.root, line))
-                            if os.path.exists(p):
-                                self.ignore_abs_startswith.add(p)
-                        elif os.path.exists(line) and os.path.isabs(line):
+                            self.ignore_abs_startswith.add(os.path.abspath(os.path.join(self.root, line)))
+                        elif os.path.isabs(line):
                             self.ignore_abs_startswith.add(os.path.abspath(line))
                         else:
                             self.ignore_startswith.add(line)
@@ -114,46 +298,25 @@ class Rule(object):
                         line = line[1:]
                         if not line:
                             continue
-                        p = os.path.abspath(os.path.join(self.root, line))
-                        if os.path.exists(p):
-                            self.ignore_abs_equals.add(p)
-                    elif os.path.exists(line) and os.path.isabs(line):
+                        self.ignore_abs_equals.add(os.path.abspath(os.path.join(self.root, line)))
+                    elif os.path.isabs(line):
                         self.ignore_abs_equals.add(os.path.abspath(line))
                     else:
                         self.ignore_equals.add(line.rstrip('/'))
 
-        self.logger.debug('=' * 60)
-        self.logger.debug('忽略名字开头: {}'.format(self.ignore_startswith))
-        self.logger.debug('忽略名字结尾: {}'.format(self.ignore_endswith))
-        self.logger.debug('忽略名字包含: {}'.format(self.ignore_contains))
-        self.logger.debug('忽略名字等于: {}'.format(self.ignore_equals))
-        self.logger.debug('忽略绝对路径开头: {}'.format(self.ignore_abs_startswith))
-        self.logger.debug('忽略绝对路径等于: {}'.format(self.ignore_abs_equals))
-        self.logger.debug('包含绝对路径开头: {}'.format(self.include_abs_startswith))
-        self.logger.debug('包含绝对路径等于: {}'.format(self.include_abs_equals))
 
     def check_is_ignore(self, path, name=None):
-        if name is None:
-            name = os.path.split(path)[1]
-        path = os.path.abspath(path)
-        if path in self.include_abs_equals:
-            return False
-        if path.startswith(tuple(self.include_abs_startswith)):
-            return False
-        if path in self.ignore_abs_equals:
-            return True
-        if path.startswith(tuple(self.ignore_abs_startswith)):
-            return True
-        if name in self.ignore_equals:
-            return True
-        if name.startswith(tuple(self.ignore_startswith)):
-            return True
-        if name.endswith(tuple(self.ignore_endswith)):
-            return True
-        for item in self.ignore_contains:
-            if item in name:
-                return True
-        return False
+        """
+        判断path是否被忽略，同一个文件夹下的条目共用一个匹配器
+        遍历时应该直接使用dir_matcher得到的匹配器，不需要每次都解析路径
+        """
+        dir_path, base_name = os.path.split(os.path.abspath(path))
+        matcher = self._matchers.get(dir_path)
+        if matcher is None:
+            if len(self._matchers) > 4096:
+                self._matchers = {}
+            matcher = self._matchers[dir_path] = self.dir_matcher(dir_path)
+        return matcher.check(base_name if name is None else name)
 
 if __name__ == '__main__':
     rule = Rule('E:\\Vinman')
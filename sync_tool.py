@@ -11,87 +11,71 @@ import os
 import sys
 import time
 import stat
-import shutil
-import hashlib
 import threading
-import queue
+import contextlib
 from rule.rule import Rule
+from cache import HashCache, DirSnapshot, ContentIndex, TransferJournal
+from walker import Walker, SyncEntry, ExtraEntry
+from plan import Plan, Planner, Executor
+from watch import Watcher
+from engine import AsyncEngine, FanOutEngine
+from agent import SyncServer, SyncClient
+from fileio import HASH_ALGORITHMS, Copier, DeltaCopier, ChunkedCopier, TeeCopier, file_digest, compare_files
 from common.log import logger
 from common.config import ConfigTemplate, DefaultConfig
+from common.pool import ThreadPool, AdaptiveTuner
+from metrics import Metrics, Progress
 
-
-class WorkThread(threading.Thread):
-    def __init__(self, pool):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.alive = True
-        self.pool = pool
-        self.finished = True
-        self.success_count = 0
-        self.failed_count = 0
-        self.copy_count = 0
-        self.start()
-
-    def run(self):
-        while self.pool.alive:
-            try:
-                if self.pool.que.empty():
-                    time.sleep(0.1)
-                    continue
-                item = self.pool.que.get(timeout=1)
-                self.finished = False
-                func = item['func']
-                self.copy_count += func(*item['args'], **item['kwargs'])
-                self.success_count += 1
-                self.finished = True
-            except Exception as e:
-                logger.error('[任务失败] {}'.format(e))
-                self.failed_count += 1
-                time.sleep(0.1)
-
-
-class ThreadPool(object):
-    def __init__(self, thread_size=10):
-        self.que = queue.Queue()
-        self.alive = True
-        self.task_count = 0
-        self.thread_size = thread_size
-        self.threads = [WorkThread(self) for _ in range(thread_size)]
-
-    def stop(self):
-        self.alive = False
-
-    def add_task(self, task, *args, **kwargs):
-        self.que.put({
-            'func': task,
-            'args': args,
-            'kwargs': kwargs
-        })
-        self.task_count += 1
-
-    def wait_all_task_done(self):
-        while not self.que.empty():
-            time.sleep(0.1)
-        success_count = 0
-        failed_count = 0
-        copy_count = 0
-        for thread in self.threads:
-            while not thread.finished:
-                time.sleep(0.1)
-            success_count += thread.success_count
-            failed_count += thread.failed_count
-            copy_count += thread.copy_count
-        self.alive = False
-        logger.info('总任务数: {}, 成功: {}, 失败: {}'.format(self.task_count, success_count, failed_count))
-        return copy_count
+NULL_TIMER = contextlib.nullcontext()
 
 
 class Config(DefaultConfig):
     def __init__(self, **kwargs):
         self.Genernal = ConfigTemplate(
-            source=None,
-            target=None,
+            source='',
+            target='',
+            targets='',
+            remote='',
+            listen='',
+            secret='',
             thread_size=10,
+            adaptive=False,
+            min_threads=2,
+            max_threads=32,
+            tune_interval=1.0,
+            scan_threads=4,
+            engine='thread',
+            meta_concurrency=32,
+            data_concurrency=4,
+            queue_size=10000,
+            compare='meta',
+            verify=False,
+            mtime_window=0.0,
+            hash_cache=True,
+            hash_algo='md5',
+            copy_strategy='auto',
+            delta_min_size=0,
+            small_file_size=64,
+            batch_size=32,
+            split_size=256,
+            chunk_size=32,
+            resume_min_size=64,
+            mirror=False,
+            detect_moves=False,
+            move_min_size=1,
+            incremental=False,
+            dry_run=False,
+            plan_file='',
+            load_plan='',
+            order='size',
+            assume_yes=False,
+            progress_interval=0.0,
+            report_file='',
+            watch=False,
+            watch_delay=1.0,
+            watch_backend='auto',
+            poll_interval=5.0,
+            log_limit='',
             debug=False
         )
         super(Config, self).__init__(**kwargs)
@@ -99,85 +83,771 @@ class Config(DefaultConfig):
     def on_finish(self):
         if self.Genernal.debug:
             logger.setLevel(logger.DEBUG)
+        # 分类:每秒条数 或 分类:1/N(每N条输出1条)，多个用逗号分隔，比如 拷贝:100,删除:1/10
+        for item in filter(None, self.Genernal.log_limit.split(',')):
+            category, _, limit = item.strip().rpartition(':')
+            try:
+                if limit.startswith('1/'):
+                    logger.set_rate_limit(category, sample=int(limit[2:]))
+                else:
+                    logger.set_rate_limit(category, rate=float(limit))
+            except ValueError:
+                logger.warning('[日志限制] 格式错误: {}'.format(item))
 
 
 class SyncTool(object):
-    MAX_SIZE = 1024 * 1024
+    COMPARE_MODES = ('meta', 'hash')
+    ENGINES = ('thread', 'async')
 
-    def __init__(self, pool=None):
+    def __init__(self, pool=None, **kwargs):
         self.pool = pool
+        # meta: 先比较大小和修改时间，无法确定时才比较内容; hash: 总是比较内容
+        self.compare = kwargs.get('compare', 'meta')
+        if self.compare not in self.COMPARE_MODES:
+            logger.warning('[比较模式] 不支持{}, 使用meta'.format(self.compare))
+            self.compare = 'meta'
+        # 为True时即使元数据一致也要比较内容
+        self.verify = kwargs.get('verify', False)
+        # 修改时间允许的误差(秒)，FAT32等文件系统的时间精度只有2秒
+        self.mtime_window_ns = int(kwargs.get('mtime_window', 0) * 1e9)
+        # 摘要缓存(HashCache)，为None时直接逐块比较文件内容，否则比较(缓存的)摘要
+        self.hash_cache = kwargs.get('hash_cache', None)
+        # 有摘要缓存时以缓存的算法为准
+        self.hash_algo = self.hash_cache.algo if self.hash_cache is not None else kwargs.get('hash_algo', 'md5')
+        if self.hash_algo not in HASH_ALGORITHMS:
+            logger.warning('[摘要算法] 不支持{}, 使用md5'.format(self.hash_algo))
+            self.hash_algo = 'md5'
+        # 拷贝引擎，会保留修改时间，下次同步时可以直接通过元数据判断
+        self.copier = Copier(kwargs.get('copy_strategy', 'auto'))
+        # 大于等于delta_min_size(MiB)的文件在目标已存在时使用增量拷贝，为0时不使用
+        self.delta_min_size = kwargs.get('delta_min_size', 0) * 1024 * 1024
+        self.delta = DeltaCopier() if self.delta_min_size > 0 else None
+        # 小于small_file_size(KiB)的文件每batch_size个合成一个任务，batch_size不大于1时不合并
+        self.small_file_size = kwargs.get('small_file_size', 64) * 1024
+        self.batch_size = kwargs.get('batch_size', 32)
+        # 大于等于split_size(MiB)的文件分成chunk_size(MiB)的块，由多个线程同时拷贝，为0时不分块
+        self.split_size = kwargs.get('split_size', 256) * 1024 * 1024
+        # 拷贝日志(TransferJournal)，为None时不能续传，否则大于等于resume_min_size(MiB)的文件中断后从记录的偏移继续拷贝
+        self.journal = kwargs.get('journal', None)
+        self.resume_min_size = kwargs.get('resume_min_size', 64) * 1024 * 1024
+        self.chunked = ChunkedCopier(max(kwargs.get('chunk_size', 32), 1) * 1024 * 1024) \
+            if (self.split_size > 0 or self.journal is not None) and ChunkedCopier.supported() else None
+        # 同步到多个目标时，需要拷贝到多个目标的文件只读一次
+        self.tee = TeeCopier()
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        # 遍历线程数，只在有线程池时生效
+        self.scan_threads = kwargs.get('scan_threads', 4)
+        # thread: 线程池引擎; async: asyncio引擎，元数据操作和数据操作分别限制并发数
+        self.engine = kwargs.get('engine', 'thread')
+        if self.engine not in self.ENGINES:
+            logger.warning('[同步引擎] 不支持{}, 使用thread'.format(self.engine))
+            self.engine = 'thread'
+        self.meta_concurrency = kwargs.get('meta_concurrency', 32)
+        self.data_concurrency = kwargs.get('data_concurrency', 4)
+        self.queue_size = kwargs.get('queue_size', 10000)
+        # 远程同步时用来通过sync-agent服务端验证的共享密钥
+        self.secret = kwargs.get('secret', '')
+        # 镜像模式，删除目标里多出来的文件(被忽略的除外)
+        self.mirror = kwargs.get('mirror', False)
+        # 为True时，目标不存在且不小于move_min_size(MiB)的文件先在目标多出来的文件里找内容一样的，
+        # 找到时镜像模式下直接移动过去，否则在目标里克隆或拷贝，不用再从原文件拷贝(只在thread引擎下生效)
+        self.detect_moves = kwargs.get('detect_moves', False)
+        self.move_min_size = kwargs.get('move_min_size', 1) * 1024 * 1024
+        self.move_count = 0
+        self._moves = None
+        self._deferred = []
+        self._extras = []
+        # 文件夹快照(DirSnapshot)，为None时每次都完整遍历，否则跳过上次同步后没有变化的文件夹
+        self.snapshot = kwargs.get('snapshot', None)
+        # 为True时不需要输入确认，用于脚本和定时任务
+        self.assume_yes = kwargs.get('assume_yes', False)
+        # 每progress_interval秒输出一次进度，为0时不输出; 指定report_file时同步完成后保存JSON格式的统计报告
+        self.progress_interval = kwargs.get('progress_interval', 0)
+        self.report_file = kwargs.get('report_file', None)
+        self.metrics = Metrics() if self.progress_interval > 0 or self.report_file else None
+        self._progress = None
+        # 为True时根据吞吐量在[min_threads, max_threads]之间自动调整线程池的线程数，每tune_interval秒调整一次
+        self.adaptive = kwargs.get('adaptive', False)
+        self.min_threads = kwargs.get('min_threads', 2)
+        self.max_threads = kwargs.get('max_threads', 32)
+        self.tune_interval = kwargs.get('tune_interval', 1.0)
+        self._tuner = None
+        # 比较和拷贝读写的字节数，用于计算吞吐量
+        self.io_bytes = 0
+        self.delete_count = 0
+        self._rule = None
+        self._lock = threading.Lock()
+
+    def _check_copy(self, source, target, source_stat=None, target_stat=None, split=True):
+        """
+        :param split: 是否可以把大文件分块交给线程池一起拷贝，调用方自己限制了并发数时(异步引擎)为False
+        """
+        if source_stat is None:
+            try:
+                source_stat = os.stat(source)
+            except OSError:
+                return 0
+            try:
+                target_stat = os.stat(target)
+            except OSError:
+                target_stat = None
+        with self._timer('compare'):
+            changed = self.check_file_is_change(source, target, source_stat, target_stat)
+        self._decided()
+        if not changed:
+            return 0
+        if self.metrics is not None:
+            self.metrics.incr('copy_bytes', source_stat.st_size)
+        return self.copy_file(source, target, source_stat, target_stat, split)
+
+    def _decided(self, count=1):
+        """
+        记录已经决定是否拷贝的文件数(只根据stat跳过的也算)，用于计算预计剩余时间
+        """
+        if self.metrics is not None:
+            self.metrics.incr('decided', count)
+
+    def _timer(self, stage, nbytes=0):
+        return self.metrics.time(stage, nbytes=nbytes) if self.metrics is not None else NULL_TIMER
+
+    def copy_file(self, source, target, source_stat, target_stat=None, split=True):
+        """
+        不做比较，直接拷贝
+        :param target_stat: 目标的stat，为None表示目标不存在
+        :param split: 是否可以分块交给线程池一起拷贝
+        """
+        with self._timer('copy', source_stat.st_size):
+            count = self._copy_file(source, target, source_stat, target_stat, split)
+        self._add_io(source_stat.st_size)
+        return count
+
+    def _add_io(self, nbytes):
+        with self._lock:
+            self.io_bytes += nbytes
 
-    def _check_copy(self, source, target):
-        if self.check_file_is_change(source, target):
-            shutil.copy(source, target)
-            logger.info('[拷贝] 从{}到{}'.format(source, target))
-            return 1
+    def _copy_file(self, source, target, source_stat, target_stat, split=True):
+        if self.delta is not None and target_stat is not None and source_stat.st_size >= self.delta_min_size:
+            written = self.delta.copy(source, target, source_stat)
+            logger.info('[增量拷贝] 从%s到%s, 写入%d/%d字节', source, target, written, source_stat.st_size)
+        elif split and self.chunked is not None and self.pool is not None and \
+                0 < self.split_size <= source_stat.st_size:
+            chunks, start = self.chunked.copy(source, target, source_stat, self.pool.add_helper,
+                                              self.pool.thread_size, journal=self._journal(source_stat))
+            logger.info('[分块拷贝] 从%s到%s, %d块, 从%d字节开始', source, target, chunks, start)
+        elif self.chunked is not None and self._journal(source_stat) is not None:
+            _, start = self.chunked.copy(source, target, source_stat, journal=self.journal)
+            logger.info('[拷贝] 从%s到%s, 从%d字节开始', source, target, start)
+        else:
+            strategy = self.copier.copy(source, target, source_stat)
+            logger.info('[拷贝] 从%s到%s, %s', source, target, strategy)
+        return 1
+
+    def _journal(self, source_stat):
+        return self.journal if self.journal is not None and source_stat.st_size >= self.resume_min_size else None
+
+    def copy_summary(self):
+        summary = self.copier.summary()
+        if self.chunked is not None and self.chunked.count:
+            summary = ', '.join(filter(None, [summary, 'chunked: {}个/{}字节(续传{}个)'.format(
+                self.chunked.count, self.chunked.bytes, self.chunked.resumed)]))
+        if self.tee.count:
+            summary = ', '.join(filter(None, [summary, 'tee: {}个/{}字节'.format(self.tee.count, self.tee.bytes)]))
+        return summary
+
+    def _remove_tree(self, path, matcher):
+        """
+        删除目标里的文件夹，跳过被忽略的内容(有被忽略的内容时保留对应的文件夹)
+        :return: 删除的文件数
+        """
+        count = 0
+        dirs = []
+        stack = [(path, matcher)]
+        while stack:
+            dir_path, dir_matcher = stack.pop()
+            dirs.append(dir_path)
+            with os.scandir(dir_path) as it:
+                for item in it:
+                    if dir_matcher.check(item.name):
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append((item.path, dir_matcher.child(item.name)))
+                    else:
+                        os.unlink(item.path)
+                        count += 1
+        for dir_path in reversed(dirs):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+        return count
+
+    def _remove_extras(self, entry):
+        self._remove_items(entry)
         return 0
 
-    def sync(self, source_path, target_path):
-        rule = Rule(source_path, logger=logger)
-        print('将要复制{}到{}?'.format(source_path, target_path))
-        data = input('确定Y/N[N]')
-        if data.upper() != 'Y':
-            return 0
+    def _remove_items(self, entry):
+        """
+        删除镜像模式下目标多出来的条目(ExtraEntry)
+        :return: 删除的文件数
+        """
+        count = 0
+        for path, is_dir in entry.items:
+            if is_dir:
+                count += self._remove_tree(path, entry.matcher.child(os.path.basename(path)))
+            else:
+                os.unlink(path)
+                count += 1
+            logger.info('[删除] %s', path)
+        with self._lock:
+            self.delete_count += count
+        return count
+
+    def _resolve_conflict(self, entry):
+        """
+        原文件和目标一个是文件一个是文件夹时，镜像模式下删除目标，否则报错
+        :return: 删除的文件数
+        """
+        if not self.mirror:
+            raise OSError('类型冲突, 目标已存在: {}'.format(entry.target))
+        # 不能跟随符号链接，否则会删除链接指向的文件夹(可能在目标外面)里的内容
+        if stat.S_ISDIR(os.lstat(entry.target).st_mode):
+            count = self._remove_tree(entry.target, self._rule.dir_matcher(entry.source))
+            if os.path.exists(entry.target):
+                raise OSError('类型冲突, 目标文件夹里有被忽略的内容: {}'.format(entry.target))
+        else:
+            os.unlink(entry.target)
+            count = 1
+        logger.info('[删除] %s', entry.target)
+        with self._lock:
+            self.delete_count += count
+        entry.target_stat = None
+        return count
 
-        def _sync(source, target):
-            if not source or not target or not os.path.exists(source):
+    def _dispatch(self, entry):
+        if isinstance(entry, ExtraEntry):
+            if self._moves is not None:
+                # 等遍历完成后再建立内容索引，移动检测完成后再删除
+                with self._batch_lock:
+                    self._extras.append(entry)
                 return 0
-            if os.path.isfile(source):
-                if rule.check_is_ignore(source):
-                    # print('[IgnoreFile] {}'.format(source))
-                    return 0
-                if self.pool is not None:
-                    self.pool.add_task(self._check_copy, source, target)
+            if self.pool is not None:
+                self.pool.add_task(self._remove_extras, entry)
+                return 0
+            return self._remove_extras(entry)
+        if entry.target_stat is not None and stat.S_ISDIR(entry.target_stat.st_mode) != entry.is_dir:
+            self._resolve_conflict(entry)
+        if entry.is_dir:
+            if entry.target_stat is None:
+                os.makedirs(entry.target, exist_ok=True)
+                logger.info('[创建文件夹] %s', entry.target)
+            return 0
+        if self._moves is not None and entry.target_stat is None and entry.source_stat.st_size >= self.move_min_size:
+            with self._batch_lock:
+                self._deferred.append(entry)
+            return 0
+        if self.pool is None:
+            return self._check_copy(entry.source, entry.target, entry.source_stat, entry.target_stat)
+        if self.batch_size > 1 and entry.source_stat.st_size < self.small_file_size:
+            with self._batch_lock:
+                self._batch.append((entry.source, entry.target, entry.source_stat, entry.target_stat))
+                if len(self._batch) < self.batch_size:
                     return 0
-                else:
-                    return self._check_copy(source, target)
+                batch, self._batch = self._batch, []
+            self.pool.add_batch(self._check_copy, batch)
+            return 0
+        self.pool.add_task(self._check_copy, entry.source, entry.target, entry.source_stat, entry.target_stat)
+        return 0
+
+    def _relocate(self, entry):
+        """
+        在目标多出来的文件里找内容一样的文件，镜像模式下移动过来(反正要删除)，否则克隆或在目标里拷贝
+        不使用硬链接，避免以后修改一边时另一边也被修改
+        :return: 是否成功
+        """
+        source_stat = entry.source_stat
+        strict = self.compare == 'hash' or self.verify
+        found = self._moves.find(source_stat, lambda path, st: self.get_file_hash(
+            entry.source, source_stat) == self.get_file_hash(path, st), strict=strict)
+        if found is None:
+            return False
+        path = found[0]
+        try:
+            if self.mirror:
+                os.rename(path, entry.target)
+                how = 'rename'
             else:
-                if not os.path.exists(target):
-                    os.makedirs(target)
-                    logger.info('[创建文件夹] {}'.format(target))
-                count = 0
-                for item in os.listdir(source):
-                    p = os.path.join(source, item)
-                    if rule.check_is_ignore(p, item):
-                        # print('[Ignore] {}'.format(p))
-                        continue
-                    count += _sync(os.path.join(source, item), os.path.join(target, item))
-                return count
+                how = self.copier.copy(path, entry.target, found[1])
+            os.utime(entry.target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        except OSError as e:
+            logger.debug('[移动失败] %s, %s', path, e)
+            return False
+        logger.info('[移动] 从%s到%s, %s', path, entry.target, how)
+        with self._lock:
+            self.move_count += 1
+        return True
 
-        count = _sync(source_path, target_path)
+    def _relocate_or_copy(self, entry):
+        if self._relocate(entry):
+            self._decided()
+            return 0
+        return self._check_copy(entry.source, entry.target, entry.source_stat, None)
+
+    def _apply_moves(self):
+        """
+        遍历完成后处理等待移动检测的文件，全部完成后再删除目标多出来的条目(镜像模式)
+        :return: 没有线程池时拷贝的文件数
+        """
+        with self._batch_lock:
+            deferred, self._deferred = self._deferred, []
+            extras, self._extras = self._extras, []
+        if deferred:
+            for extra in extras:
+                for path, is_dir in extra.items:
+                    try:
+                        if is_dir:
+                            self._moves.add_tree(path, extra.matcher.child(os.path.basename(path)))
+                        else:
+                            self._moves.add(path, os.lstat(path))
+                    except OSError:
+                        continue
+        count = 0
+        for entry in deferred:
+            if self.pool is not None:
+                self.pool.add_task(self._relocate_or_copy, entry)
+            else:
+                count += self._relocate_or_copy(entry)
         if self.pool is not None:
-            return self.pool.wait_all_task_done()
-        else:
+            self.pool.wait()
+        if not self.mirror:
             return count
+        for entry in extras:
+            # 已经被移走的不再删除
+            entry.items = [(path, is_dir) for path, is_dir in entry.items if os.path.lexists(path)]
+            if not entry.items:
+                continue
+            if self.pool is not None:
+                self.pool.add_task(self._remove_extras, entry)
+            else:
+                self._remove_extras(entry)
+        return count
 
-    def check_file_is_change(self, source, target):
-        if os.path.exists(source):
-            if not os.path.exists(target):
-                return True
-            source_hash = self.get_file_md5(source)
-            target_hash = self.get_file_md5(target)
-            return source_hash != target_hash
+    def _flush_batch(self):
+        """
+        提交还没凑满的小文件批次
+        """
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self.pool.add_batch(self._check_copy, batch)
+
+    @property
+    def rule(self):
+        return self._rule
+
+    def sync_file(self, source, target):
+        """
+        同步单个文件(监视模式下使用)，有线程池时交给线程池
+        """
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            return 0
+        try:
+            target_stat = os.stat(target)
+        except OSError:
+            target_stat = None
+        count = self._dispatch(SyncEntry(source, target, False, source_stat, target_stat))
+        if self.pool is not None:
+            self._flush_batch()
+        return count
+
+    def remove_target(self, source, target, matcher=None):
+        """
+        原文件或文件夹已不存在时删除目标(只在镜像模式下使用)
+        :param matcher: 原文件夹的匹配器，为None时根据规则计算
+        """
+        try:
+            target_stat = os.lstat(target)
+        except OSError:
+            return 0
+        if stat.S_ISDIR(target_stat.st_mode):
+            count = self._remove_tree(target, matcher or self._rule.dir_matcher(source))
         else:
+            os.unlink(target)
+            count = 1
+        logger.info('[删除] %s', target)
+        with self._lock:
+            self.delete_count += count
+        return count
+
+    def confirm(self, source_path, target_path):
+        if self.assume_yes:
+            logger.info('将要复制{}到{}'.format(source_path, target_path))
+            return True
+        logger.flush()
+        print('将要复制{}到{}?'.format(source_path, target_path))
+        data = input('确定Y/N[N]')
+        return data.upper() == 'Y'
+
+    def check_paths(self, source_path, target_path):
+        """
+        同步前检查路径，不能同步时输出错误
+            1. 原文件夹和目标都不能为空(空路径会被当成当前文件夹)
+            2. 目标不能是原文件夹，也不能在原文件夹里面
+            3. 镜像模式下原文件夹不能在目标里面，否则会被当成多出来的条目删除
+        :return: 是否可以同步
+        """
+        if not source_path or not target_path:
+            logger.error('[路径错误] 原文件夹和目标都不能为空')
             return False
+        if not os.path.exists(source_path):
+            logger.error('[路径错误] 原文件夹不存在: {}'.format(source_path))
+            return False
+        source, target = os.path.realpath(source_path), os.path.realpath(target_path)
+        if _is_under(target, source):
+            logger.error('[路径错误] 目标不能是原文件夹或者在原文件夹里面: {}'.format(target_path))
+            return False
+        if self.mirror and _is_under(source, target):
+            logger.error('[路径错误] 镜像模式下原文件夹不能在目标里面: {}'.format(source_path))
+            return False
+        return True
 
-    def get_file_md5(self, file_path):
-        if not os.path.isfile(file_path):
-            return
-        file_hash = hashlib.md5()
-        size = os.stat(file_path)[stat.ST_SIZE]
-        with open(file_path, 'rb') as f:
-            if size < self.MAX_SIZE:
-                file_hash.update(f.read())
+    def plan(self, source_path, target_path):
+        """
+        只遍历和比较，生成同步计划(Plan)，不修改目标
+        """
+        if not self.check_paths(source_path, target_path):
+            return Plan(source_path, target_path)
+        return Planner(self, logger=logger).build(source_path, target_path)
+
+    def execute(self, plan, order='size'):
+        """
+        执行同步计划
+        :param order: 拷贝顺序，见Executor.ORDERS
+        :return: 拷贝的文件数
+        """
+        if not self.check_paths(plan.source, plan.target) or not self.confirm(plan.source, plan.target):
+            return 0
+        self.delete_count = 0
+        self._start_metrics()
+        if self._progress is not None:
+            # 不需要遍历
+            self._progress.scanning = False
+        self._start_tuner()
+        try:
+            count = Executor(self, logger=logger).execute(plan, order)
+        finally:
+            self._stop_tuner()
+        if count:
+            logger.info('[拷贝方式] {}'.format(self.copy_summary()))
+        if self.delete_count:
+            logger.info('删除文件数: {}'.format(self.delete_count))
+        self._finish_metrics(plan.source, plan.target, count, plan_created=plan.created)
+        return count
+
+    def sync_tree(self, source_path, target_path, matcher=None):
+        """
+        遍历并同步，不需要确认，有线程池时等待任务完成但不停止线程池
+        :param matcher: 同步某个子文件夹时传入该文件夹的匹配器，为None时表示source_path是同步的根目录
+        :return: 拷贝的文件数
+        """
+        if matcher is None or self._rule is None:
+            self._rule = Rule(source_path, logger=logger)
+        # 只有从根目录同步时才使用文件夹快照
+        snapshot = self.snapshot if matcher is None else None
+        # 检测移动时需要目标多出来的条目，非镜像模式下只用来建立索引，不会删除，目标的stat还是和非镜像模式一样
+        self._moves = ContentIndex(self.move_min_size) if self.detect_moves else None
+        walker = Walker(self._rule, logger=logger, mirror=self.mirror, list_extras=self.mirror or self.detect_moves,
+                        snapshot=snapshot, metrics=self.metrics, on_list=self._on_list)
+        counter = [0]
+        copy_count = self.pool.copy_count if self.pool is not None else 0
+        failed_count = len(self.pool.failures) if self.pool is not None else 0
+
+        def _callback(entry):
+            counter[0] += self._dispatch(entry)
+
+        # 有线程池时多个线程同时遍历，文件直接交给线程池，遍历和拷贝同时进行
+        walker.scan(source_path, target_path, _callback,
+                    threads=self.scan_threads if self.pool is not None else 1, matcher=matcher)
+        if self._progress is not None:
+            self._progress.scanning = False
+        if self.pool is not None:
+            self._flush_batch()
+            self.pool.wait()
+        if self._moves is not None:
+            counter[0] += self._apply_moves()
+            self._moves = None
+        if self.pool is not None:
+            self.pool.wait()
+            count = self.pool.copy_count - copy_count
+        else:
+            count = counter[0]
+        if snapshot is not None:
+            if self.pool is not None:
+                for args, _ in self.pool.failures[failed_count:]:
+                    if isinstance(args[0], ExtraEntry):
+                        snapshot.invalidate(args[0].target)
+                    elif isinstance(args[0], SyncEntry):
+                        snapshot.invalidate(os.path.dirname(args[0].source))
+                    elif isinstance(args[0], str):
+                        snapshot.invalidate(os.path.dirname(args[0]))
+            snapshot.commit()
+        return count
+
+    def sync(self, source_path, target_path):
+        if not self.check_paths(source_path, target_path) or not self.confirm(source_path, target_path):
+            return 0
+        self.delete_count = 0
+        self.move_count = 0
+        self._start_metrics()
+        if self.engine == 'async':
+            count = AsyncEngine(self, meta_concurrency=self.meta_concurrency, data_concurrency=self.data_concurrency,
+                                queue_size=self.queue_size, logger=logger).sync_tree(source_path, target_path)
+        else:
+            self._start_tuner()
+            try:
+                count = self.sync_tree(source_path, target_path)
+            finally:
+                self._stop_tuner()
+        if self.pool is not None:
+            if self.engine == 'async':
+                # 异步引擎不使用线程池
+                self.pool.shutdown()
             else:
-                while True:
-                    data = f.read(8096)
-                    if not data:
-                        break
-                    file_hash.update(data)
-            # print('[File] {}, size={}, md5={}'.format(file_path, size, file_hash.hexdigest()))
-            return file_hash.hexdigest()
+                count = self.pool.wait_all_task_done()
+        if self.snapshot is not None:
+            self.snapshot.prune(source_path)
+        if count:
+            logger.info('[拷贝方式] {}'.format(self.copy_summary()))
+        if self.mirror:
+            logger.info('删除文件数: {}'.format(self.delete_count))
+        if self.detect_moves:
+            logger.info('移动文件数: {}'.format(self.move_count))
+        self._finish_metrics(source_path, target_path, count)
+        return count
+
+    def sync_multi(self, source_path, target_paths):
+        """
+        同步到多个目标，原文件夹只遍历一次，需要拷贝到多个目标的文件只读一次
+        不使用异步引擎和文件夹快照，每个目标的拷贝数、删除数和失败数分别输出
+        :return: 所有目标拷贝的文件数之和
+        """
+        if not target_paths or not all(self.check_paths(source_path, target_path) for target_path in target_paths):
+            return 0
+        if not self.confirm(source_path, ', '.join(target_paths)):
+            return 0
+        self.delete_count = 0
+        self._start_metrics()
+        self._start_tuner()
+        engine = FanOutEngine(self, logger=logger)
+        try:
+            engine.sync_tree(source_path, target_paths)
+        finally:
+            self._stop_tuner()
+        if self.pool is not None:
+            self.pool.wait_all_task_done()
+        count = sum(result.copied for result in engine.results)
+        if count:
+            logger.info('[拷贝方式] {}'.format(self.copy_summary()))
+        for result in engine.results:
+            logger.info('[目标] {}: 拷贝{}个, 删除{}个, 失败{}个'.format(
+                result.target, result.copied, result.deleted, result.failed))
+        self._finish_metrics(source_path, target_paths, count, targets=[
+            {'target': result.target, 'copied': result.copied, 'deleted': result.deleted, 'failed': result.failed}
+            for result in engine.results])
+        return count
+
+    def sync_remote(self, source_path, address, target_path=''):
+        """
+        通过sync-agent服务端(SyncServer)同步到远程的目标
+        :param address: 服务端地址，host:port
+        :param target_path: 目标在服务端root下的相对路径
+        :return: 拷贝的文件数
+        """
+        if not source_path or not address:
+            logger.error('[路径错误] 原文件夹和服务端地址都不能为空')
+            return 0
+        if not os.path.exists(source_path):
+            logger.error('[路径错误] 原文件夹不存在: {}'.format(source_path))
+            return 0
+        if not self.confirm(source_path, '{}/{}'.format(address, target_path)):
+            return 0
+        host, port = parse_address(address)
+        if self.compare != 'meta' or self.verify:
+            logger.warning('[远程同步] 服务端只根据大小和修改时间比较')
+        self._start_metrics()
+        client = SyncClient(self, host, port, batch_size=max(self.batch_size, 1) * 8, secret=self.secret,
+                            logger=logger)
+        try:
+            count = client.sync_tree(source_path, target_path)
+        except Exception as e:
+            logger.error('[远程同步] 失败: {}'.format(e))
+            count = client.copy_count
+        if self.pool is not None:
+            self.pool.shutdown()
+        logger.info('[远程同步] 拷贝: {}, 失败: {}'.format(count, client.failed_count))
+        self._finish_metrics(source_path, '{}/{}'.format(address, target_path), count)
+        return count
+
+    def _start_tuner(self):
+        if not self.adaptive or self.pool is None:
+            return
+        self._tuner = AdaptiveTuner(self.pool, lambda: self.io_bytes, min_size=self.min_threads,
+                                    max_size=self.max_threads, interval=self.tune_interval, logger=logger)
+        self._tuner.start()
+
+    def _stop_tuner(self):
+        if self._tuner is None:
+            return
+        self._tuner.stop()
+        logger.info('[线程数] 调整{}次, 最后{}个线程'.format(len(self._tuner.history), self.pool.thread_size))
+        self._tuner = None
+
+    def _start_metrics(self):
+        if self.metrics is None:
+            return
+        self.metrics = Metrics()
+        if self.pool is not None and self.engine != 'async':
+            self.metrics.add_gauge('copy_queue', self.pool.que.qsize)
+            self.metrics.add_gauge('threads', lambda: self.pool.thread_size)
+        if self.progress_interval > 0:
+            self._progress = Progress(self.metrics, self.progress_interval, logger=logger)
+            self._progress.start()
+
+    def _finish_metrics(self, source_path, target_path, count, **extra):
+        """
+        输出各阶段的统计，指定了report_file时保存JSON报告
+        :param extra: 额外保存到报告里的内容
+        """
+        if self.metrics is None:
+            return
+        if self._progress is not None:
+            self._progress.stop()
+            self._progress = None
+        metrics = self.metrics
+        metrics.finish()
+        for name, stage in metrics.stages.items():
+            if not stage.count:
+                continue
+            logger.info('[统计] {}: {}次, {}个条目, {:.1f}MiB, 累计{:.3f}秒, 平均{:.3f}毫秒, p99<{:.3f}毫秒, 失败{}次'.format(
+                name, stage.count, stage.items, stage.bytes / 1048576.0, stage.seconds,
+                stage.seconds / stage.count * 1000, stage.histogram.percentile(99) * 1000, stage.errors))
+        if self.report_file:
+            pool = self.pool if self.engine != 'async' else None
+            metrics.save(self.report_file, source=source_path, target=target_path, engine=self.engine,
+                         copied=count, deleted=self.delete_count,
+                         failed=pool.failed_count if pool is not None else None,
+                         copy_strategies=dict(self.copier.stats),
+                         hash_cache={'hit': self.hash_cache.hit_count, 'miss': self.hash_cache.miss_count}
+                         if self.hash_cache is not None else None, **extra)
+            logger.info('[统计] 报告已保存到{}'.format(self.report_file))
+
+    def watch(self, source_path, target_path, delay=1.0, backend='auto', poll_interval=5.0):
+        """
+        先全量同步一次，然后持续监视原文件夹并同步改动，直到按Ctrl+C
+        """
+        if not self.check_paths(source_path, target_path) or not self.confirm(source_path, target_path):
+            return 0
+        self.delete_count = 0
+        self._start_tuner()
+        try:
+            count = self.sync_tree(source_path, target_path)
+            watcher = Watcher(self, source_path, target_path, delay=delay, backend=backend,
+                              poll_interval=poll_interval, logger=logger)
+            watcher.run()
+        finally:
+            self._stop_tuner()
+        if self.pool is not None:
+            count = self.pool.wait_all_task_done()
+        return count
+
+    @property
+    def _on_list(self):
+        """
+        遍历时列出文件夹后清理摘要缓存里已经不存在的记录
+        """
+        return self.hash_cache.prune_dir if self.hash_cache is not None else None
+
+    def check_meta(self, source_stat, target_stat):
+        """
+        只根据stat判断文件是否改动，不读文件
+        :param target_stat: 为None表示目标不存在
+        :return: True表示改动了，False表示没改动，None表示需要比较内容
+        """
+        if target_stat is None or source_stat.st_size != target_stat.st_size:
+            return True
+        same_mtime = abs(source_stat.st_mtime_ns - target_stat.st_mtime_ns) <= self.mtime_window_ns
+        if self.compare == 'meta' and same_mtime and not self.verify:
+            return False
+        return None
+
+    def check_file_is_change(self, source, target, source_stat=None, target_stat=None, touch=True,
+                             source_digest=None):
+        # 传入了source_stat时(来自Walker)，target_stat为None表示目标不存在
+        # touch为True时，内容一致但修改时间不一致会修改目标的修改时间
+        # source_digest: 已经算好的原文件摘要(同一个原文件和多个目标比较时)，传入时不再读原文件
+        if source_stat is None:
+            try:
+                source_stat = os.stat(source)
+            except OSError:
+                return False
+            try:
+                target_stat = os.stat(target)
+            except OSError:
+                return True
+        changed = self.check_meta(source_stat, target_stat)
+        if changed is not None:
+            return changed
+        if self.hash_cache is not None or source_digest is not None:
+            # 有缓存时比较摘要，没改动过的文件不需要再读
+            source_digest = source_digest or self.get_file_hash(source, source_stat)
+            if source_digest != self.get_file_hash(target, target_stat):
+                return True
+        else:
+            self._add_io(source_stat.st_size * 2)
+            if not compare_files(source, target):
+                return True
+        same_mtime = abs(source_stat.st_mtime_ns - target_stat.st_mtime_ns) <= self.mtime_window_ns
+        if self.compare == 'meta' and not same_mtime and touch:
+            # 内容一致但修改时间不一致(比如之前用shutil.copy拷贝的)，同步修改时间，下次直接走元数据判断
+            try:
+                os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            except OSError as e:
+                logger.debug('[同步修改时间失败] %s, %s', target, e)
+        return False
+
+    def get_file_hash(self, file_path, file_stat=None):
+        if file_stat is None:
+            if not os.path.isfile(file_path):
+                return
+            file_stat = os.stat(file_path)
+        if self.hash_cache is not None:
+            digest = self.hash_cache.get(file_path, file_stat)
+            if digest is not None:
+                return digest
+        with self._timer('hash', file_stat.st_size):
+            digest = file_digest(file_path, self.hash_algo)
+        self._add_io(file_stat.st_size)
+        if self.hash_cache is not None:
+            self.hash_cache.put(file_path, file_stat, digest)
+        return digest
+
+
+def _is_under(path, root):
+    """
+    path是否是root或者在root下面(都是realpath)
+    """
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def parse_address(address):
+    """
+    :param address: host:port，host为空时表示本机(127.0.0.1)
+    :return: (host, port)
+    """
+    host, _, port = address.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
 
 
 if __name__ == '__main__':
@@ -185,10 +855,62 @@ if __name__ == '__main__':
             else os.path.join(os.getcwd(), 'spec', 'dist', 'config.ini')
     config = Config(config_file=config_file, config_type='ini', logger=logger)
     config.show()
-    pool = ThreadPool(config.Genernal.thread_size)
+    pool = ThreadPool(config.Genernal.thread_size, config.Genernal.queue_size)
+    hash_cache = HashCache(os.path.join(os.path.dirname(config_file), 'sync-tool.db'),
+                           algo=config.Genernal.hash_algo, logger=logger) if config.Genernal.hash_cache else None
+    snapshot = DirSnapshot(os.path.join(os.path.dirname(config_file), 'sync-tool.db'),
+                           logger=logger) if config.Genernal.incremental else None
+    journal = TransferJournal(os.path.join(os.path.dirname(config_file), 'sync-tool.db'),
+                              logger=logger) if config.Genernal.resume_min_size > 0 else None
+    pending = journal.pending() if journal is not None else []
+    if pending:
+        logger.info('[续传] 上次有{}个没有完成的拷贝'.format(len(pending)))
     start = time.time()
-    sync_tool = SyncTool(pool)
-    count = sync_tool.sync(config.Genernal.source, config.Genernal.target)
+    sync_tool = SyncTool(pool, **dict(config.Genernal.__dict__, hash_cache=hash_cache, snapshot=snapshot,
+                                      journal=journal))
+    source = config.Genernal.source
+    targets = [path.strip() for path in config.Genernal.targets.split('|') if path.strip()]
+    target = targets[0] if targets else config.Genernal.target
+    if config.Genernal.listen:
+        host, port = parse_address(config.Genernal.listen)
+        count = 0
+        try:
+            server = SyncServer(target, host, port, secret=config.Genernal.secret, logger=logger)
+        except (ValueError, OSError) as e:
+            logger.error('[同步服务] 启动失败: {}'.format(e))
+        else:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.shutdown()
+    elif config.Genernal.remote:
+        count = sync_tool.sync_remote(source, config.Genernal.remote, target or '')
+    elif len(targets) > 1:
+        if config.Genernal.load_plan or config.Genernal.dry_run or config.Genernal.plan_file or config.Genernal.watch:
+            logger.warning('[多个目标] 只支持直接同步, 忽略同步计划和监视模式')
+        count = sync_tool.sync_multi(source, targets)
+    elif config.Genernal.load_plan:
+        count = sync_tool.execute(Plan.load(config.Genernal.load_plan), config.Genernal.order)
+    elif config.Genernal.dry_run or config.Genernal.plan_file:
+        plan = sync_tool.plan(source, target)
+        logger.info('[同步计划] {}'.format(plan.summary()))
+        if config.Genernal.plan_file:
+            plan.save(config.Genernal.plan_file)
+            logger.info('[同步计划] 已保存到{}'.format(config.Genernal.plan_file))
+        count = 0 if config.Genernal.dry_run else sync_tool.execute(plan, config.Genernal.order)
+    elif config.Genernal.watch:
+        count = sync_tool.watch(source, target, delay=config.Genernal.watch_delay,
+                                backend=config.Genernal.watch_backend, poll_interval=config.Genernal.poll_interval)
+    else:
+        count = sync_tool.sync(source, target)
+    if hash_cache is not None:
+        hash_cache.close()
+    if snapshot is not None:
+        snapshot.close()
+    if journal is not None:
+        journal.close()
     logger.info('复制文件数: {}, 用时: {}'.format(count, time.time() - start))
-    input('输出回车退出')
+    if not config.Genernal.assume_yes:
+        logger.flush()
+        input('输出回车退出')
 
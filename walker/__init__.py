@@ -0,0 +1 @@
+from .walker import Walker, SyncEntry, ExtraEntry
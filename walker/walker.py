@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import stat
+import time
+import logging
+import threading
+from rule.rule import IGNORE_FILE
+from cache.snapshot import DirRecord
+from fileio.copier import TMP_SUFFIX, temp_name
+
+
+class SyncEntry(object):
+    """
+    遍历得到的一个同步条目
+        source_stat: 原文件(夹)的stat
+        target_stat: 目标文件(夹)的stat，为None表示目标不存在
+        matcher: 文件夹的忽略规则匹配器(DirMatcher)，文件为None
+    """
+    __slots__ = ('source', 'target', 'is_dir', 'source_stat', 'target_stat', 'matcher')
+
+    def __init__(self, source, target, is_dir, source_stat, target_stat, matcher=None):
+        self.source = source
+        self.target = target
+        self.is_dir = is_dir
+        self.source_stat = source_stat
+        self.target_stat = target_stat
+        self.matcher = matcher
+
+
+class ExtraEntry(object):
+    """
+    镜像模式下目标文件夹里多出来的条目(原文件夹里没有，且没有被忽略)
+        items: [(目标路径, 是否是文件夹)]
+        matcher: 所在文件夹的忽略规则匹配器，删除多出来的文件夹时用来跳过被忽略的内容
+    """
+    __slots__ = ('target', 'items', 'matcher')
+    is_dir = False
+
+    def __init__(self, target, items, matcher):
+        self.target = target
+        self.items = items
+        self.matcher = matcher
+
+
+class Walker(object):
+    """
+    基于os.scandir的遍历器，使用显式栈代替递归
+        1. 每个文件夹只调用一次scandir，同时列出对应的目标文件夹，目标是否存在不需要再单独判断
+        2. stat结果来自DirEntry(Windows下无需额外的系统调用)，并通过SyncEntry传给后面的比较和拷贝
+        3. 文件夹条目总是在其子条目之前生成，调用方可以在收到文件夹条目时创建目标文件夹
+        4. walk在当前线程遍历，scan用多个线程同时遍历不同的文件夹
+        5. 忽略规则的匹配器跟着文件夹往下传，被忽略的文件夹整个子树都不会遍历
+        6. 文件夹下有.syncignore时，在上级规则的基础上加上该文件的规则，并传给所有子文件夹
+        7. list_extras为True时(默认和mirror一样)，每个文件夹遍历完后，用两边列表的差集得到目标多出来的条目，
+           生成一个ExtraEntry; mirror只决定目标的stat是否跟随符号链接
+        8. 有文件夹快照(snapshot)时，两边文件夹都没变的直接复用上次的子文件夹列表，不再列出文件夹和比较文件
+        9. on_list(文件夹, 名字集合)在每次成功列出一个原文件夹或目标文件夹后调用(例如清理摘要缓存)，
+           复用快照的文件夹不会调用
+    """
+    def __init__(self, rule, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.rule = rule
+        self.mirror = kwargs.pop('mirror', False)
+        self.list_extras = kwargs.pop('list_extras', self.mirror)
+        self.snapshot = kwargs.pop('snapshot', None)
+        # 统计(Metrics)，为None时不统计
+        self.metrics = kwargs.pop('metrics', None)
+        self.on_list = kwargs.pop('on_list', None)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _target_stat(self, path):
+        """
+        镜像模式下不跟随目标的符号链接，指向文件夹的符号链接也当作文件，删除时只删除链接本身
+        """
+        try:
+            return os.lstat(path) if self.mirror else os.stat(path)
+        except OSError:
+            return None
+
+    def _entry_stat(self, item):
+        return item.stat(follow_symlinks=not self.mirror)
+
+    @staticmethod
+    def _same_entry(path, candidates):
+        """
+        :return: candidates里和path是同一个条目的DirEntry，没有时返回None
+        """
+        for candidate in candidates:
+            try:
+                if os.path.samestat(os.lstat(path), os.lstat(candidate.path)):
+                    return candidate
+            except OSError:
+                continue
+        return None
+
+    def walk(self, source, target, matcher=None):
+        """
+        :param matcher: source的匹配器，为None时根据规则计算
+        """
+        source = os.path.abspath(source)
+        target = os.path.abspath(target)
+        source_stat = self._stat(source)
+        if source_stat is None:
+            return
+        target_stat = self._stat(target)
+        if not stat.S_ISDIR(source_stat.st_mode):
+            if not self.rule.check_is_ignore(source):
+                yield SyncEntry(source, target, False, source_stat, target_stat)
+            return
+
+        root = SyncEntry(source, target, True, source_stat, target_stat, matcher or self.rule.dir_matcher(source))
+        yield root
+        stack = [root]
+        while stack:
+            for entry in self.scan_dir(stack.pop()):
+                yield entry
+                if entry.is_dir:
+                    stack.append(entry)
+
+    def scan(self, source, target, callback, threads=4, matcher=None):
+        """
+        多线程遍历，每个条目调用一次callback(entry)
+            1. callback会在多个扫描线程里被调用，需要是线程安全的
+            2. 文件夹条目的callback返回后才会遍历其子条目，callback抛出异常时不再遍历该文件夹
+        :param threads: 扫描线程数
+        :param matcher: source的匹配器，为None时根据规则计算
+        """
+        source = os.path.abspath(source)
+        target = os.path.abspath(target)
+        source_stat = self._stat(source)
+        if source_stat is None:
+            return
+        target_stat = self._stat(target)
+        if not stat.S_ISDIR(source_stat.st_mode):
+            if not self.rule.check_is_ignore(source):
+                callback(SyncEntry(source, target, False, source_stat, target_stat))
+            return
+        root = SyncEntry(source, target, True, source_stat, target_stat, matcher or self.rule.dir_matcher(source))
+        callback(root)
+
+        pending = [root]
+        cond = threading.Condition()
+        busy = [0]
+        if self.metrics is not None:
+            self.metrics.add_gauge('scan_queue', lambda: len(pending))
+
+        def _scan():
+            while True:
+                with cond:
+                    while not pending and busy[0] > 0:
+                        cond.wait()
+                    if not pending:
+                        cond.notify_all()
+                        return
+                    item = pending.pop()
+                    busy[0] += 1
+                try:
+                    for entry in self.scan_dir(item):
+                        try:
+                            callback(entry)
+                        except Exception as e:
+                            self.logger.error('[处理失败] {}, {}'.format(entry.source, e))
+                            if self.snapshot is not None:
+                                self.snapshot.invalidate(os.path.dirname(entry.source))
+                            continue
+                        if entry.is_dir:
+                            with cond:
+                                pending.append(entry)
+                                cond.notify()
+                finally:
+                    with cond:
+                        busy[0] -= 1
+                        cond.notify_all()
+
+        scanners = [threading.Thread(target=_scan, daemon=True) for _ in range(max(1, threads))]
+        for t in scanners:
+            t.start()
+        for t in scanners:
+            t.join()
+
+    def list_target(self, target_dir):
+        """
+        列出目标文件夹
+        :return: {名字: DirEntry}
+        """
+        try:
+            with os.scandir(target_dir) as it:
+                targets = {item.name: item for item in it}
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+        except OSError as e:
+            self.logger.error('[遍历目标文件夹失败] {}, {}'.format(target_dir, e))
+            return {}
+        if self.on_list is not None:
+            self.on_list(target_dir, targets)
+        return targets
+
+    def _reuse_dir(self, dir_entry):
+        """
+        两边文件夹和忽略规则都和上次同步完成时一样时，复用上次的子文件夹列表
+        :return: 子文件夹的SyncEntry列表，不能复用时返回None
+        """
+        source_dir, target_dir = dir_entry.source, dir_entry.target
+        record = self.snapshot.lookup(source_dir, target_dir, dir_entry.source_stat, dir_entry.target_stat)
+        if record is None:
+            return None
+        matcher = dir_entry.matcher
+        if record.has_ignore:
+            matcher = matcher.extend(source_dir, os.path.join(source_dir, IGNORE_FILE))
+        if matcher.fingerprint != record.fingerprint:
+            return None
+        entries = []
+        for name in record.dirs:
+            source = os.path.join(source_dir, name)
+            source_stat = self._stat(source)
+            if source_stat is None or not stat.S_ISDIR(source_stat.st_mode):
+                return None
+            target = os.path.join(target_dir, name)
+            entries.append(SyncEntry(source, target, True, source_stat, self._target_stat(target),
+                                     matcher.child(name)))
+        self.snapshot.record(record, hit=True)
+        return entries
+
+    def scan_dir(self, dir_entry):
+        """
+        列出一个文件夹下未被忽略的条目
+        :param dir_entry: 文件夹的SyncEntry，目标文件夹不存在时不需要列出目标文件夹
+        :return: 条目列表
+        """
+        if self.metrics is None:
+            return self._scan_dir(dir_entry)
+        start = time.perf_counter()
+        entries = self._scan_dir(dir_entry)
+        files = sum(1 for entry in entries if isinstance(entry, SyncEntry) and not entry.is_dir)
+        self.metrics.observe('scan', time.perf_counter() - start, len(entries))
+        self.metrics.incr('files', files)
+        return entries
+
+    def scan_dir_multi(self, dir_entries):
+        """
+        同一个原文件夹同步到多个目标时，原文件夹只列出一次，每个目标文件夹分别列出和匹配(不使用文件夹快照)
+        :param dir_entries: 原文件夹对应每个目标的SyncEntry，为None的目标跳过
+        :return: 每个目标的条目列表
+        """
+        first = next(entry for entry in dir_entries if entry is not None)
+        start = time.perf_counter()
+        listed = self._list_source(first.source, first.matcher)
+        if listed is None:
+            return [[] for _ in dir_entries]
+        matcher, names, kept, _, _ = listed
+        result = []
+        for dir_entry in dir_entries:
+            if dir_entry is None:
+                result.append([])
+                continue
+            targets = self.list_target(dir_entry.target) if dir_entry.target_stat is not None else {}
+            result.append(self._match_target(dir_entry.target, matcher, names, kept, targets))
+        if self.metrics is not None:
+            self.metrics.observe('scan', time.perf_counter() - start, len(kept))
+            self.metrics.incr('files', sum(1 for _, is_dir, _ in kept if not is_dir))
+        return result
+
+    def _scan_dir(self, dir_entry):
+        source_dir, target_dir = dir_entry.source, dir_entry.target
+        if self.snapshot is not None:
+            entries = self._reuse_dir(dir_entry)
+            if entries is not None:
+                return entries
+        targets = self.list_target(target_dir) if dir_entry.target_stat is not None else {}
+        listed = self._list_source(source_dir, dir_entry.matcher)
+        if listed is None:
+            return []
+        matcher, names, kept, has_ignore, complete = listed
+        entries = self._match_target(target_dir, matcher, names, kept, targets)
+        if self.snapshot is not None and complete:
+            dirs = [item.name for item, is_dir, _ in kept if is_dir]
+            self.snapshot.record(DirRecord(source_dir, target_dir, dir_entry.source_stat.st_mtime_ns, None,
+                                           matcher.fingerprint, has_ignore, dirs))
+        return entries
+
+    def _list_source(self, source_dir, matcher):
+        """
+        列出原文件夹并过滤被忽略的条目
+        :return: (加上.syncignore后的匹配器, 所有名字, [(DirEntry, 是否是文件夹, stat)], 是否有.syncignore, 是否完整)，
+                 列出失败时返回None
+        """
+        try:
+            with os.scandir(source_dir) as it:
+                items = list(it)
+        except OSError as e:
+            self.logger.error('[遍历文件夹失败] {}, {}'.format(source_dir, e))
+            return None
+        has_ignore = False
+        for item in items:
+            if item.name == IGNORE_FILE and item.is_file():
+                matcher = matcher.extend(source_dir, item.path)
+                has_ignore = True
+                break
+        if self.metrics is not None:
+            start = time.perf_counter()
+            kept = [item for item in items if not matcher.check(item.name)]
+            self.metrics.observe('rule', time.perf_counter() - start, len(items))
+        else:
+            kept = [item for item in items if not matcher.check(item.name)]
+        complete = True
+        result = []
+        for item in kept:
+            try:
+                is_dir = item.is_dir()
+                if not is_dir and not item.is_file():
+                    self.logger.debug('[跳过特殊文件] %s', item.path)
+                    continue
+                source_stat = item.stat()
+            except OSError as e:
+                self.logger.error('[获取文件信息失败] {}, {}'.format(item.path, e))
+                complete = False
+                continue
+            result.append((item, is_dir, source_stat))
+        names = set(item.name for item in items)
+        if self.on_list is not None:
+            self.on_list(source_dir, names)
+        return matcher, names, result, has_ignore, complete
+
+    def _match_target(self, target_dir, matcher, names, kept, targets):
+        """
+        根据目标文件夹的列表生成条目，list_extras为True时再加上目标多出来的条目
+        """
+        entries = []
+        matched = set()
+        folded = None
+        for item, is_dir, source_stat in kept:
+            target_item = targets.get(item.name)
+            if target_item is None and targets:
+                # 不区分大小写的文件系统(NTFS/APFS)上只改了大小写的名字还是同一个条目
+                if folded is None:
+                    folded = {}
+                    for name, candidate in targets.items():
+                        folded.setdefault(name.casefold(), []).append(candidate)
+                target_item = self._same_entry(os.path.join(target_dir, item.name),
+                                               folded.get(item.name.casefold(), ()))
+            if target_item is not None:
+                matched.add(target_item.name)
+            try:
+                target_stat = self._entry_stat(target_item) if target_item is not None else None
+            except OSError:
+                target_stat = None
+            entries.append(SyncEntry(item.path, os.path.join(target_dir, item.name), is_dir, source_stat,
+                                     target_stat, matcher.child(item.name) if is_dir else None))
+        if self.list_extras and targets:
+            # 被忽略的条目不会出现在差集里，目标里被忽略的内容永远不会被删除
+            extras = []
+            temps = None
+            for name, target_item in targets.items():
+                if name in names or name in matched or matcher.check(name):
+                    continue
+                if name.startswith('.') and name.endswith(TMP_SUFFIX):
+                    if temps is None:
+                        temps = set(temp_name(source_name) for source_name in names)
+                    if name in temps:
+                        # 没有完成的拷贝的临时文件，下次覆盖或者续传
+                        continue
+                try:
+                    extras.append((target_item.path, target_item.is_dir(follow_symlinks=False)))
+                except OSError:
+                    extras.append((target_item.path, False))
+            if extras:
+                entries.append(ExtraEntry(target_dir, extras, matcher))
+        return entries
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2019, Vinman, Inc.
+# All rights reserved.
+#
+# Author: Vinman <vinman.cub@gmail.com>
+
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+from rule.rule import IGNORE_FILE
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+# 事件回调的参数里，path为None表示事件丢失(比如inotify队列溢出)，需要全量同步
+OVERFLOW = None
+
+
+def _list_dirs(path, matcher):
+    """
+    列出文件夹下未被忽略的子文件夹和文件
+    :return: (文件夹的匹配器, [(路径, 名字, 是否是文件夹, DirEntry)])
+    """
+    with os.scandir(path) as it:
+        items = list(it)
+    for item in items:
+        if item.name == IGNORE_FILE and item.is_file():
+            matcher = matcher.extend(path, item.path)
+            break
+    result = []
+    for item in items:
+        if matcher.check(item.name):
+            continue
+        try:
+            is_dir = item.is_dir()
+        except OSError:
+            continue
+        result.append((item.path, item.name, is_dir, item))
+    return matcher, result
+
+
+class InotifyObserver(object):
+    """
+    基于inotify(通过ctypes调用)的文件夹监视，只在Linux下可用
+        1. 每个未被忽略的文件夹一个watch，记录文件夹路径和匹配器，事件的名字用该匹配器过滤
+        2. 新建或移入的文件夹会自动加上watch，移出或删除的文件夹会去掉watch
+    """
+    def __init__(self, root, matcher, logger):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on linux')
+        self.logger = logger
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._watches = {}
+        self._paths = {}
+        self.add_tree(root, matcher)
+
+    def close(self):
+        os.close(self.fd)
+
+    def _add_watch(self, path, matcher):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self.logger.error('[监视] watch数量达到上限，请调大/proc/sys/fs/inotify/max_user_watches')
+            raise OSError(err, os.strerror(err), path)
+        self._watches[wd] = (path, matcher)
+        self._paths[path] = wd
+
+    def add_tree(self, path, matcher):
+        """
+        给path和它下面所有未被忽略的文件夹加上watch
+        """
+        stack = [(path, matcher)]
+        while stack:
+            dir_path, dir_matcher = stack.pop()
+            try:
+                dir_matcher, items = _list_dirs(dir_path, dir_matcher)
+                self._add_watch(dir_path, dir_matcher)
+            except OSError as e:
+                self.logger.debug('[监视失败] {}, {}'.format(dir_path, e))
+                continue
+            for item_path, name, is_dir, _ in items:
+                if is_dir:
+                    stack.append((item_path, dir_matcher.child(name)))
+
+    def remove_tree(self, path):
+        prefix = path + os.sep
+        for dir_path in [p for p in self._paths if p == path or p.startswith(prefix)]:
+            wd = self._paths.pop(dir_path)
+            self._watches.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout, callback):
+        """
+        等待事件，最多等待timeout秒
+        :param callback: callback(path, is_dir, matcher)，matcher为文件夹的匹配器(文件为None)
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                callback(OVERFLOW, True, None)
+                continue
+            if mask & IN_IGNORED:
+                path = self._watches.pop(wd, (None, None))[0]
+                if path is not None and self._paths.get(path) == wd:
+                    self._paths.pop(path)
+                continue
+            watch = self._watches.get(wd)
+            if watch is None or not name:
+                continue
+            dir_path, matcher = watch
+            if matcher.check(name):
+                continue
+            path = os.path.join(dir_path, name)
+            is_dir = bool(mask & IN_ISDIR)
+            child = matcher.child(name) if is_dir else None
+            if is_dir:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.remove_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path, child)
+            callback(path, is_dir, child)
+
+
+class PollingObserver(object):
+    """
+    定时遍历比较的文件夹监视，所有平台都可用，开销和文件总数成正比
+    """
+    def __init__(self, root, matcher, logger, interval=5.0):
+        self.root = root
+        self.matcher = matcher
+        self.logger = logger
+        self.interval = interval
+        self._last = 0
+        self._state = self._snapshot()
+
+    def close(self):
+        pass
+
+    def _snapshot(self):
+        """
+        :return: {路径: (是否是文件夹, 大小, 修改时间, 文件夹的匹配器)}
+        """
+        state = {}
+        stack = [(self.root, self.matcher)]
+        while stack:
+            dir_path, dir_matcher = stack.pop()
+            try:
+                dir_matcher, items = _list_dirs(dir_path, dir_matcher)
+            except OSError:
+                continue
+            for item_path, name, is_dir, item in items:
+                if is_dir:
+                    child = dir_matcher.child(name)
+                    state[item_path] = (True, 0, 0, child)
+                    stack.append((item_path, child))
+                else:
+                    try:
+                        st = item.stat()
+                    except OSError:
+                        continue
+                    state[item_path] = (False, st.st_size, st.st_mtime_ns, None)
+        self._last = time.time()
+        return state
+
+    def read(self, timeout, callback):
+        wait = self._last + self.interval - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if time.time() < self._last + self.interval:
+                return
+        state = self._snapshot()
+        for path, value in state.items():
+            old = self._state.get(path)
+            if old is None or (not value[0] and old[:3] != value[:3]):
+                callback(path, value[0], value[3])
+        for path, value in self._state.items():
+            if path not in state:
+                callback(path, value[0], value[3])
+        self._state = state
+
+
+class Watcher(object):
+    """
+    持续监视原文件夹，把改动同步到目标文件夹
+        1. 同一个路径在delay秒内的多次事件会合并，最后一次事件delay秒后才处理
+        2. 处理时以文件当前的状态为准: 存在的文件交给线程池比较和拷贝，新的文件夹同步整个子树，
+           不存在的在镜像模式下删除目标
+        3. 事件丢失时做一次全量同步
+        4. 优先使用inotify，不可用时定时遍历比较(polling)
+    """
+    def __init__(self, sync_tool, source, target, **kwargs):
+        logger = kwargs.pop('logger', None)
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+            if not self.logger.handlers:
+                stream_hander = logging.StreamHandler(sys.stdout)
+                stream_hander.setLevel(logging.DEBUG)
+                self.logger.addHandler(stream_hander)
+            self.logger.setLevel(logging.DEBUG)
+        self.sync_tool = sync_tool
+        self.source = os.path.abspath(source)
+        self.target = os.path.abspath(target)
+        self.delay = kwargs.pop('delay', 1.0)
+        self.backend = kwargs.pop('backend', 'auto')
+        self.poll_interval = kwargs.pop('poll_interval', 5.0)
+        self.alive = False
+        self._pending = {}
+        self._overflow = False
+
+    def _create_observer(self):
+        rule = self.sync_tool.rule
+        matcher = rule.dir_matcher(self.source)
+        if self.backend in ('auto', 'inotify'):
+            try:
+                return InotifyObserver(self.source, matcher, self.logger)
+            except OSError as e:
+                if self.backend == 'inotify':
+                    raise
+                self.logger.warning('[监视] inotify不可用({}), 使用定时遍历'.format(e))
+        return PollingObserver(self.source, matcher, self.logger, self.poll_interval)
+
+    def _on_event(self, path, is_dir, matcher):
+        if path is OVERFLOW:
+            self._overflow = True
+            return
+        self._pending[path] = (time.time() + self.delay, is_dir, matcher)
+
+    def _target_path(self, path):
+        return os.path.join(self.target, os.path.relpath(path, self.source))
+
+    def _flush(self, now):
+        if self._overflow:
+            self._overflow = False
+            self._pending.clear()
+            self.logger.warning('[监视] 事件丢失，全量同步')
+            self.sync_tool.sync_tree(self.source, self.target)
+            return
+        ready = [path for path, (deadline, _, _) in self._pending.items() if deadline <= now]
+        # 父文件夹在前，父文件夹整体同步后就不需要再处理里面的条目
+        ready.sort()
+        synced = []
+        for path in ready:
+            _, is_dir, matcher = self._pending.pop(path)
+            if any(path.startswith(p + os.sep) for p in synced):
+                continue
+            target = self._target_path(path)
+            try:
+                self._handle(path, target, is_dir, matcher, synced)
+            except Exception as e:
+                self.logger.error('[监视同步失败] {}, {}'.format(path, e))
+
+    def _handle(self, path, target, is_dir, matcher, synced):
+        if os.path.isdir(path):
+            self.sync_tool.sync_tree(path, target, matcher or self.sync_tool.rule.dir_matcher(path))
+            synced.append(path)
+        elif os.path.isfile(path):
+            self.sync_tool.sync_file(path, target)
+        elif self.sync_tool.mirror:
+            self.sync_tool.remove_target(path, target, matcher if is_dir else None)
+
+    def stop(self):
+        self.alive = False
+
+    def run(self):
+        """
+        阻塞运行，直到调用stop或者按Ctrl+C
+        """
+        observer = self._create_observer()
+        self.alive = True
+        self.logger.info('[监视] 开始监视{}, 使用{}'.format(self.source, observer.__class__.__name__))
+        try:
+            while self.alive:
+                now = time.time()
+                if self._pending:
+                    timeout = max(0, min(deadline for deadline, _, _ in self._pending.values()) - now)
+                else:
+                    timeout = 1.0
+                observer.read(min(timeout, 1.0), self._on_event)
+                if self._pending or self._overflow:
+                    self._flush(time.time())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            observer.close()
+            self.logger.info('[监视] 停止监视{}'.format(self.source))